@@ -11,11 +11,22 @@ import seaborn as sns
 
 from .kaggle import SALARY_THRESHOLDS
 from .kaggle import REVERSE_SALARY_THRESHOLDS
+from .kaggle import ORDINAL_DOMAINS
+from .kaggle import register_ordinal_domain
+from .kaggle import to_ordinal
+from .kaggle import get_ordinal_codes
 from .kaggle import load_orig_kaggle_df
 from .kaggle import load_questions_df
+from .kaggle import load_question_schema
 from .kaggle import get_threshold
+from .kaggle import get_thresholds
 from .kaggle import load_thresholds_df
 from .kaggle import load_udf
+from .kaggle import build_udf
+from .kaggle import profile_udf_memory
+from .kaggle import FILTER_RULES
+from .kaggle import get_only_answered_demographics
+from .kaggle import get_filter_conditions
 from .kaggle import filter_df
 from .kaggle import load_role_df
 from .kaggle import keep_demo_cols
@@ -27,8 +38,88 @@ from .kaggle import fix_age_bin_distribution
 from .kaggle import get_age_bin_distribution_comparison
 from .kaggle import calc_avg_age_distribution
 from .kaggle import get_salary_distribution
+from .kaggle import SALARY_BINS
+from .kaggle import SALARY_AGGREGATE_SCHEME
+from .kaggle import get_salary_aggregate_distribution
+from .imputation import IMPUTATION_POOLS
+from .imputation import IMPUTATION_EXCLUDED_ROLES
+from .imputation import get_hot_deck_donors
+from .imputation import get_imputations
+from .imputation import impute_df
+from .imputation import load_imputed_udf
+from .modeling import MODEL_KINDS
+from .modeling import DesignMatrix
+from .modeling import get_row_products
+from .modeling import get_design_matrix
+from .modeling import fit_linear_salary_model
+from .modeling import fit_ordinal_salary_model
+from .modeling import fit_salary_models
+from .binning import AGE_BINS
+from .binning import ADJUSTED_AGE_BINS
+from .binning import SINGLE_YEAR_AGE_BINS
+from .binning import CODE_EXP_BINS
+from .binning import ML_EXP_BINS
+from .binning import EXP_BINS
+from .binning import get_bin_widths
+from .binning import get_overlap_matrix
+from .binning import get_bin_counts
+from .binning import rebin_counts
+from .currency import WORLD_BANK_COUNTRY_RENAMES
+from .currency import SALARY_LOWER_BOUNDS
+from .currency import load_world_bank_indicator_df
+from .currency import load_ppp_factors_df
+from .currency import get_ppp_factors
+from .currency import convert_to_usd
+from .currency import convert_usd_to_ppp
+from .currency import convert_salary_bins
+from .sampling import SAMPLE_WEIGHT
+from .sampling import get_stratified_sample
+from .sampling import get_sample_weights
+from .sampling import get_share_estimates
+from .sampling import get_value_count_errors
+from .sampling import get_median_estimate
+from .subset import Subset
+from .subset import as_subset
+from .schema import Question
+from .schema import QuestionSchema
+from .schema import build_question_schema
+from .cooccurrence import get_multi_select_columns
+from .cooccurrence import get_choice_label
+from .cooccurrence import get_indicator_matrix
+from .cooccurrence import get_cooccurrence_matrix
+from .cooccurrence import get_cooccurrence_df
+from .database import DATABASE
+from .database import export_sqlite
+from .database import connect_sqlite
+from .database import query_sql
+from .duplicates import load_answers_df
+from .duplicates import get_answer_hashes
+from .duplicates import get_exact_duplicate_clusters
+from .duplicates import get_minhash_signatures
+from .duplicates import get_near_duplicate_pairs
+from .duplicates import get_near_duplicate_clusters
+from .duplicates import load_duplicates_df
+from .duplicates import get_duplicate_clusters_df
+from .anomaly import get_anomaly_features
+from .anomaly import get_anomaly_scores
+from .anomaly import load_anomaly_scores_df
+from .cache import cached_frame
+from .cache import CACHE_REGISTRY
+from .cache import get_cache_info_df
+from .cache import invalidate_cache
+from .cache import clear_caches
+from .cache import set_cache_budget
+from .explorer import FILTER_PARAMETERS
+from .explorer import FilterExplorer
+from .memory import memory_stage
+from .memory import profile_memory
 from .paths import DATA
+from .prefetch import PREFETCH_ENV
+from .prefetch import is_prefetch_enabled
+from .prefetch import start_prefetch
+from .prefetch import get_prefetch_timings
 from .plots import sns_plot_value_count_comparison
+from .plots import sns_plot_value_count_heatmap
 from .plots import sns_plot_participants_vs_median_salary
 from .plots import PALETTE_INCOME_GROUP
 from .plots import PALETTE_ORIGINAL_VS_FILTERED
@@ -41,8 +132,18 @@ from .plots import sns_plot_salary_pde_comparison_per_income_group
 from .plots import sns_plot_salary_pde_comparison_per_role
 from .plots import sns_plot_pde_comparison
 from .plots import sns_plot_salary_distribution_comparison
+from .render_cache import enable_render_cache
+from .render_cache import disable_render_cache
+from .render_cache import clear_render_cache
+from .third_party import SourceSpec
+from .third_party import REFERENCE_SOURCES
+from .third_party import register_source
+from .third_party import load_source_df
 from .third_party import load_eurostat_df
+from .third_party import load_eurostat_net_df
 from .third_party import get_usd_eur_rate
+from .third_party import load_fx_rates_df
+from .third_party import get_fx_rates
 from .third_party import load_world_bank_groups
 from .third_party import load_world_bank_gdp_pc
 from .third_party import load_world_bank_gni_pc_atlas
@@ -50,11 +151,28 @@ from .third_party import load_oecd_df
 from .third_party import load_numbeo_df
 from .third_party import load_ilo_df
 from .third_party import load_mean_salary_comparison_df
+from .third_party import SURVEY_YEAR
+from .third_party import REFERENCE_WAGE_SOURCES
+from .third_party import build_reference_wages_panel_df
+from .third_party import load_reference_wages_panel_df
+from .third_party import asof_join_reference_wages
+from .utils import get_value_counts
+from .utils import get_weighted_median
 from .utils import get_value_count_df
 from .utils import stack_value_count_df
 from .utils import get_value_count_comparison
 from .utils import stack_value_count_comparison
 from .utils import stack_dataframe
 from .utils import get_stacked_value_count_comparison
+from .utils import get_top_k_stacked
+from .utils import get_label_order
 from .utils import get_complimentary_datasets
 from .utils import multi_merge
+from .wide_format import KAGGLE_SURVEY_CSV
+from .wide_format import write_kaggle_csv
+from .weighting import get_target_margin
+from .weighting import fit_ipf
+from .weighting import rake_weights
+
+if is_prefetch_enabled():
+    start_prefetch()
@@ -0,0 +1,63 @@
+import argparse
+import sys
+
+from typing import List
+from typing import Optional
+
+from . import database
+from . import pipeline
+from . import server
+from . import wide_format
+from .kaggle import filter_df
+from .kaggle import load_udf
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m kagglelib")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser("build", help="Build the pipeline stages (default: all of them)")
+    build_parser.add_argument(
+        "stages", nargs="*", metavar="stage", help=f"One of: {', '.join(pipeline.STAGES_BY_NAME)}"
+    )
+    build_parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of stages to run in parallel")
+    build_parser.add_argument("-f", "--force", action="store_true", help="Rebuild the stages even if they are cached")
+
+    export_parser = subparsers.add_parser("export", help="Export the cleaned survey to a SQLite database")
+    export_parser.add_argument("path", nargs="?", default=str(database.DATABASE))
+    export_parser.add_argument("--remove-duplicates", action="store_true", help="Flag the duplicate submissions")
+
+    csv_parser = subparsers.add_parser(
+        "export-csv", help="Write the filtered respondents in the original Kaggle format"
+    )
+    csv_parser.add_argument("path", help="The output CSV; gzipped if it ends with .gz")
+    csv_parser.add_argument("--remove-duplicates", action="store_true", help="Remove the duplicate submissions too")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve the survey aggregates as JSON over HTTP")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8050)
+    serve_parser.add_argument("--cache-size", type=int, default=256, help="Max number of cached responses")
+    serve_parser.add_argument("--workers", type=int, default=4, help="Number of threads computing the responses")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        try:
+            report = pipeline.build(args.stages or None, jobs=args.jobs, force=args.force)
+        except ValueError as exc:
+            parser.error(str(exc))
+        print(report.to_string(index=False))
+    elif args.command == "export":
+        path = database.export_sqlite(args.path, remove_duplicates=args.remove_duplicates)
+        print(f"Exported to {path}")
+    elif args.command == "export-csv":
+        filtered = filter_df(load_udf(), remove_duplicates=args.remove_duplicates)
+        written = wide_format.write_kaggle_csv(filtered, args.path)
+        print(f"Wrote {written} respondents to {args.path}")
+    elif args.command == "serve":
+        server.run_server(host=args.host, port=args.port, cache_size=args.cache_size, workers=args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Unsupervised anomaly scores of the respondents.
+
+The rules of `filter_df()` only catch the inconsistencies we thought of. An isolation forest, fitted on
+a numeric encoding of the demographics, flags the unusual combinations of answers regardless of which columns
+make them unusual. The score can be used as an additional filter:
+
+```
+kglib.load_anomaly_scores_df().sort_values("anomaly_score").tail()
+kglib.filter_df(uds, max_anomaly_score=0.6, print_filters=True)
+```
+"""
+import numpy as np
+import pandas as pd
+import sklearn.ensemble
+
+from .cache import cached_frame
+from .kaggle import ORDINAL_DOMAINS
+from .kaggle import get_ordinal_codes
+from .kaggle import load_question_schema
+from .kaggle import load_udf
+
+# Nominal answers are encoded by their frequency, i.e. rare answers are easier to isolate
+_NOMINAL_COLUMNS = ["gender", "country", "education", "role", "company_ml_use"]
+
+
+def get_anomaly_features(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return the numeric features of the anomaly model, one row per respondent.
+
+    - The rank of each ordinal answer; -1 for missing answers
+    - The frequency of each nominal answer
+    - The share of the (non demographic) questions that were answered
+    - The log of the duration, and of the ratio of the salary to the country average
+    """
+    features = {}
+    for name in ORDINAL_DOMAINS:
+        if name in df.columns:
+            features[f"{name}_rank"] = get_ordinal_codes(df[name]).to_numpy(dtype=float)
+    for name in _NOMINAL_COLUMNS:
+        if name in df.columns:
+            frequencies = df[name].map(df[name].value_counts(normalize=True))
+            features[f"{name}_frequency"] = frequencies.fillna(0).to_numpy(dtype=float)
+    question_columns = [column for column in df.columns if column in load_question_schema().column_index]
+    if question_columns:
+        features["completeness"] = df[question_columns].notna().to_numpy().mean(axis=1)
+    features["log_duration"] = np.log1p(df.duration.to_numpy(dtype=float))
+    if {"salary_threshold", "country_avg_salary"} <= set(df.columns):
+        ratio = np.log(df.salary_threshold.to_numpy(dtype=float) / df.country_avg_salary.to_numpy(dtype=float))
+        # A value outside of the range of the ratios, so that missing salaries form their own group
+        features["log_salary_ratio"] = np.where(np.isnan(ratio), np.nanmin(ratio) - 1, ratio)
+    return pd.DataFrame(features, index=df.index)
+
+
+def get_anomaly_scores(
+    df: pd.DataFrame,
+    n_estimators: int = 200,
+    max_samples: int = 256,
+    seed: int = 0,
+    n_jobs: int = -1,
+) -> pd.Series:
+    """
+    Fit an isolation forest on the features of `df` and return the anomaly score of each respondent.
+
+    The scores are in (0, 1); the higher the score, the fewer splits isolate the respondent. Scores above 0.5
+    are unusual and above ~0.6 clearly anomalous. The trees are built and evaluated by `n_jobs` workers.
+    """
+    features = get_anomaly_features(df)
+    model = sklearn.ensemble.IsolationForest(
+        n_estimators=n_estimators,
+        max_samples=min(max_samples, len(features)),
+        random_state=seed,
+        n_jobs=n_jobs,
+    )
+    model.fit(features.to_numpy())
+    scores = pd.Series(-model.score_samples(features.to_numpy()), index=df.index, name="anomaly_score")
+    return scores
+
+
+@cached_frame(maxsize=1, depends_on=[load_udf, load_question_schema])
+def load_anomaly_scores_df(n_estimators: int = 200, seed: int = 0) -> pd.DataFrame:
+    """ Return the anomaly score of each respondent. The index is aligned with `load_udf()`. """
+    udf = load_udf()
+    df = get_anomaly_scores(udf, n_estimators=n_estimators, seed=seed).to_frame()
+    return df
@@ -0,0 +1,140 @@
+"""
+Overlap-matrix rebinning of ordinal bins.
+
+A bin scheme maps each label to a half-open `[lower, upper)` interval. Converting counts between two schemes
+is a matrix product with the overlap matrix `M[i, j] = |src_i ∩ dst_j| / |src_i|`, i.e. we assume that the
+counts are uniformly distributed within each source bin. Zero-width bins (e.g. "never written code")
+are points; they are mapped to the zero-width bin at the same point or to the bin that contains them.
+
+```
+counts = kglib.get_bin_counts(df, "ml_exp", by="country")
+kglib.rebin_counts(counts, kglib.ML_EXP_BINS, kglib.EXP_BINS)
+```
+"""
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+BinScheme = Dict[str, Tuple[float, float]]
+
+AGE_BINS: BinScheme = {
+    "18-21": (18, 22),
+    "22-24": (22, 25),
+    "25-29": (25, 30),
+    "30-34": (30, 35),
+    "35-39": (35, 40),
+    "40-44": (40, 45),
+    "45-49": (45, 50),
+    "50-54": (50, 55),
+    "55-59": (55, 60),
+    "60-69": (60, 70),
+    "70+": (70, 80),
+}
+
+# Same as AGE_BINS, but the first two bins are aligned to the 5-year bins of the official datasets.
+ADJUSTED_AGE_BINS: BinScheme = {
+    "18-19": (18, 20),
+    "20-24": (20, 25),
+    **{label: interval for (label, interval) in AGE_BINS.items() if interval[0] >= 25},
+}
+
+SINGLE_YEAR_AGE_BINS: BinScheme = {str(age): (age, age + 1) for age in range(18, 80)}
+
+# Kaggle's code experience bins skip "2-3", i.e. "1-2" covers everything in [1, 3)
+CODE_EXP_BINS: BinScheme = {
+    "0": (0, 0),
+    "0-1": (0, 1),
+    "1-2": (1, 3),
+    "3-5": (3, 5),
+    "5-10": (5, 10),
+    "10-20": (10, 20),
+    "20+": (20, 30),
+}
+
+ML_EXP_BINS: BinScheme = {
+    "0": (0, 0),
+    "0-1": (0, 1),
+    "1-2": (1, 2),
+    "2-3": (2, 3),
+    "3-4": (3, 4),
+    "4-5": (4, 5),
+    "5-10": (5, 10),
+    "10-20": (10, 20),
+    "20+": (20, 30),
+}
+
+# Common experience bins that both `CODE_EXP_BINS` and `ML_EXP_BINS` map to exactly.
+EXP_BINS: BinScheme = {
+    "0": (0, 0),
+    "0-1": (0, 1),
+    "1-3": (1, 3),
+    "3-5": (3, 5),
+    "5-10": (5, 10),
+    "10-20": (10, 20),
+    "20+": (20, 30),
+}
+
+
+def get_bin_widths(scheme: BinScheme) -> Dict[str, float]:
+    return {label: upper - lower for (label, (lower, upper)) in scheme.items()}
+
+
+def get_overlap_matrix(src: BinScheme, dst: BinScheme) -> pd.DataFrame:
+    """ Return the (src labels x dst labels) matrix of the share of each source bin that falls in each target bin """
+    src_bounds = np.array(list(src.values()), dtype=float)
+    dst_bounds = np.array(list(dst.values()), dtype=float)
+    src_lower, src_upper = src_bounds[:, :1], src_bounds[:, 1:]
+    dst_lower, dst_upper = dst_bounds[:, 0][None, :], dst_bounds[:, 1][None, :]
+    overlap = np.clip(np.minimum(src_upper, dst_upper) - np.maximum(src_lower, dst_lower), 0, None)
+    widths = src_upper - src_lower
+    matrix = np.divide(overlap, widths, out=np.zeros_like(overlap), where=widths > 0)
+    # Point bins go to the point bin at the same location, or else to the interval that contains them
+    is_point_src = (widths == 0).ravel()
+    if is_point_src.any():
+        point = src_lower[is_point_src]
+        same_point = (dst_lower == point) & (dst_upper == point)
+        contains = (dst_lower <= point) & (point < dst_upper)
+        matrix[is_point_src] = np.where(same_point.any(axis=1, keepdims=True), same_point, contains)
+    return pd.DataFrame(matrix, index=list(src), columns=list(dst))
+
+
+def get_bin_counts(
+    df: pd.DataFrame,
+    column: str,
+    by: Optional[Union[str, pd.Series]] = None,
+    weights: Optional[pd.Series] = None,
+) -> pd.DataFrame:
+    """ Return the counts of `column` as a (groups x labels) frame; a single row if `by` is None """
+    groups = df[by] if isinstance(by, str) else by
+    if groups is None:
+        groups = pd.Series("all", index=df.index)
+    values = pd.Series(1.0, index=df.index) if weights is None else weights
+    counts = values.groupby([groups, df[column]]).sum().unstack(fill_value=0)
+    counts.columns = counts.columns.astype(str)
+    return counts
+
+
+def rebin_counts(
+    counts: Union[pd.Series, pd.DataFrame],
+    src: BinScheme,
+    dst: BinScheme,
+) -> Union[pd.Series, pd.DataFrame]:
+    """
+    Convert counts from the `src` bins to the `dst` bins.
+
+    `counts` is either a Series indexed by the `src` labels or a (groups x `src` labels) frame.
+    All the groups are converted at once with a single matrix product.
+    """
+    unknown = set(counts.index if isinstance(counts, pd.Series) else counts.columns) - set(src)
+    if unknown:
+        raise ValueError(f"Unknown bin labels: {sorted(unknown)}")
+    matrix = get_overlap_matrix(src, dst)
+    if isinstance(counts, pd.Series):
+        values = counts.reindex(list(src), fill_value=0).to_numpy(dtype=float)
+        return pd.Series(values @ matrix.to_numpy(), index=matrix.columns, name=counts.name)
+    values = counts.reindex(columns=list(src), fill_value=0).to_numpy(dtype=float)
+    return pd.DataFrame(values @ matrix.to_numpy(), index=counts.index, columns=matrix.columns)
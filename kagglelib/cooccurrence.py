@@ -0,0 +1,147 @@
+"""
+Co-occurrence and association of the answers to multi-select questions.
+
+The answers are turned into a sparse (respondents x choices) indicator matrix. The co-occurrence counts
+of any two blocks of questions are then a single sparse product `X_a.T @ X_b`, restricted
+to a segment by selecting the rows of the segment first.
+
+```
+kglib.get_cooccurrence_df(fds, ["Q7"], ["Q9", "Q14"], segment=fds.role == "Data Scientist")
+kglib.get_cooccurrence_matrix(fds, "Q7", "Q9", normalize="conditional")
+```
+"""
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .kaggle import load_question_schema
+
+Questions = Union[str, Sequence[str]]
+
+
+def get_multi_select_columns(df: pd.DataFrame, question: str) -> List[str]:
+    schema = load_question_schema()
+    if question not in schema.questions or schema[question].type != "multi":
+        raise ValueError(f"Not a multi-select question: {question}")
+    columns = [column for column in schema[question].columns if column in df.columns]
+    return columns
+
+
+def get_choice_label(column: str) -> str:
+    """ Return the choice of a multi-select column, e.g. "Q7_Part_1" -> "Python" """
+    return load_question_schema().choice_index[column]
+
+
+def get_indicator_matrix(
+    df: pd.DataFrame,
+    questions: Questions,
+    segment: Optional[pd.Series] = None,
+) -> Tuple[scipy.sparse.csc_matrix, pd.MultiIndex]:
+    """
+    Return the sparse (respondents x choices) indicator matrix of the multi-select `questions`.
+
+    - `segment` is an optional boolean mask on `df`, e.g. `df.role == "Data Scientist"`.
+    - The columns of the matrix are labeled by a (question, choice) MultiIndex.
+    """
+    if isinstance(questions, str):
+        questions = [questions]
+    if segment is not None:
+        df = df[segment.reindex(df.index, fill_value=False).to_numpy(dtype=bool)]
+    rows = []
+    cols = []
+    labels = []
+    for question in questions:
+        for column in get_multi_select_columns(df, question):
+            answered = np.flatnonzero(df[column].notna().to_numpy())
+            rows.append(answered)
+            cols.append(np.full(len(answered), len(labels)))
+            labels.append((question, get_choice_label(column)))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    matrix = scipy.sparse.coo_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(df), len(labels))
+    ).tocsc()
+    choices = pd.MultiIndex.from_tuples(labels, names=["question", "choice"])
+    return matrix, choices
+
+
+def _get_counts(
+    df: pd.DataFrame,
+    questions1: Questions,
+    questions2: Questions,
+    segment: Optional[pd.Series],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int, pd.MultiIndex, pd.MultiIndex]:
+    matrix1, choices1 = get_indicator_matrix(df, questions1, segment=segment)
+    matrix2, choices2 = get_indicator_matrix(df, questions2, segment=segment)
+    counts = (matrix1.T @ matrix2).toarray()
+    totals1 = np.asarray(matrix1.sum(axis=0)).ravel()
+    totals2 = np.asarray(matrix2.sum(axis=0)).ravel()
+    return counts, totals1, totals2, matrix1.shape[0], choices1, choices2
+
+
+def get_cooccurrence_matrix(
+    df: pd.DataFrame,
+    questions1: Questions,
+    questions2: Questions,
+    segment: Optional[pd.Series] = None,
+    normalize: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Return the (choices1 x choices2) co-occurrence matrix.
+
+    `normalize` is one of:
+
+    - `None`: the number of respondents that selected both choices
+    - "conditional": the share of the respondents of each row that also selected the choice of the column
+    - "lift": the ratio of the observed over the expected co-occurrence if the choices were independent
+    """
+    counts, totals1, totals2, size, choices1, choices2 = _get_counts(df, questions1, questions2, segment)
+    if normalize is None:
+        values = counts
+    elif normalize == "conditional":
+        values = np.divide(counts, totals1[:, None], out=np.full(counts.shape, np.nan), where=totals1[:, None] > 0)
+    elif normalize == "lift":
+        expected = np.outer(totals1, totals2) / max(size, 1)
+        values = np.divide(counts, expected, out=np.full(counts.shape, np.nan), where=expected > 0)
+    else:
+        raise ValueError(f"normalize should be one of <None>, <conditional> or <lift>, not: {normalize}")
+    return pd.DataFrame(values, index=choices1, columns=choices2)
+
+
+def get_cooccurrence_df(
+    df: pd.DataFrame,
+    questions1: Questions,
+    questions2: Questions,
+    segment: Optional[pd.Series] = None,
+    min_count: int = 1,
+) -> pd.DataFrame:
+    """
+    Return the association between each pair of choices of the two question blocks in long format.
+
+    The columns are `question1`, `choice1`, `question2`, `choice2`, `count`, `support` (share of all the
+    respondents), `confidence` (share of the respondents of `choice1` that also selected `choice2`) and `lift`.
+    Pairs with fewer than `min_count` respondents are dropped.
+    """
+    counts, totals1, totals2, size, choices1, choices2 = _get_counts(df, questions1, questions2, segment)
+    positions1, positions2 = np.nonzero(counts >= max(min_count, 1))
+    pair_counts = counts[positions1, positions2]
+    df = pd.DataFrame(
+        dict(
+            question1=choices1.get_level_values("question")[positions1],
+            choice1=choices1.get_level_values("choice")[positions1],
+            question2=choices2.get_level_values("question")[positions2],
+            choice2=choices2.get_level_values("choice")[positions2],
+            count=pair_counts,
+            support=pair_counts / size,
+            confidence=pair_counts / totals1[positions1],
+            lift=pair_counts * size / (totals1[positions1] * totals2[positions2]),
+        )
+    )
+    df = df.sort_values("lift", ascending=False).reset_index(drop=True)
+    return df
@@ -0,0 +1,138 @@
+"""
+Vectorized currency and PPP normalization.
+
+All the functions operate on whole (country, year) arrays: the factors are looked up once
+and applied with a single array multiplication.
+
+```
+ppp = kglib.load_ppp_factors_df()
+df = kglib.convert_salary_bins(kglib.load_udf(), ppp=ppp)
+```
+"""
+
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from .cache import cached_frame
+from .kaggle import SALARY_THRESHOLDS
+from .paths import DATA
+from .third_party import SURVEY_YEAR
+from .third_party import get_fx_rates
+
+ArrayLike = Union[float, Sequence[float], np.ndarray, pd.Series]
+
+# World Bank country names vs the names that we use in the survey
+WORLD_BANK_COUNTRY_RENAMES = {
+    "Egypt, Arab Rep.": "Egypt",
+    "United Kingdom": "UK",
+    "Iran, Islamic Rep.": "Iran",
+    "Korea, Rep.": "Korea, Republic of",
+    "Russian Federation": "Russia",
+    "Slovak Republic": "Slovakia",
+    "United States": "USA",
+    "Vietnam": "Viet Nam",
+    "Yemen, Rep.": "Yemen",
+}
+
+# Lower bounds of the salary bins, e.g. "1000-1999" -> 1000
+SALARY_LOWER_BOUNDS = {label: int(label.split("-")[0]) for label in SALARY_THRESHOLDS}
+
+
+def load_world_bank_indicator_df(filename: str, name: str) -> pd.DataFrame:
+    """
+    Return a World Bank indicator in long format, i.e. one row per country and year.
+
+    `filename` must be a file in the World Bank "bulk download" CSV layout (e.g. `wb_gdp_pc.csv`).
+    """
+    df = pd.read_csv(DATA / filename, skiprows=4)
+    year_columns = [column for column in df.columns if column.isdigit()]
+    df = df.rename(columns={"Country Name": "country"})
+    df = df.melt(id_vars="country", value_vars=year_columns, var_name="year", value_name=name)
+    df = df.dropna(subset=[name]).astype({"year": int})
+    df.country = df.country.replace(WORLD_BANK_COUNTRY_RENAMES)
+    df = df.reset_index(drop=True)
+    return df
+
+
+@cached_frame(maxsize=1)
+def load_ppp_factors_df(filename: str = "wb_ppp_price_level_ratio.csv") -> pd.DataFrame:
+    """
+    Return the price level ratio (PPP conversion factor over market exchange rate) per country and year.
+
+    The repo does not ship PPP data. Download the World Bank indicator `PA.NUS.PPPC.RF`
+    and store it in `data/` as `filename`.
+    """
+    path = DATA / filename
+    if not path.exists():
+        raise FileNotFoundError(f"Download the World Bank PA.NUS.PPPC.RF indicator and store it as: {path}")
+    df = load_world_bank_indicator_df(filename, name="price_level")
+    return df
+
+
+def get_ppp_factors(
+    ppp: pd.DataFrame,
+    countries: Union[str, Sequence[str], np.ndarray, pd.Series],
+    years: Union[int, Sequence[int], np.ndarray, pd.Series] = SURVEY_YEAR,
+) -> np.ndarray:
+    """
+    Return the price level ratio of each (country, year) pair; NaN when `ppp` has no such pair.
+
+    `ppp` needs `country`, `year` and `price_level` columns. The lookup is a single `get_indexer()` call.
+    """
+    countries, years = np.broadcast_arrays(np.asarray(countries, dtype=object), np.asarray(years))
+    index = pd.MultiIndex.from_arrays([ppp.country, ppp.year.astype(int)])
+    keys = pd.MultiIndex.from_arrays([countries.ravel(), years.ravel().astype(int)])
+    positions = index.get_indexer(keys)
+    factors = np.where(positions >= 0, ppp.price_level.to_numpy(dtype=float)[positions], np.nan)
+    return factors.reshape(countries.shape)
+
+
+def convert_to_usd(
+    values: ArrayLike,
+    currencies: Union[str, Sequence[str], np.ndarray],
+    years: Union[int, Sequence[int], np.ndarray],
+) -> np.ndarray:
+    return np.asarray(values, dtype=float) * get_fx_rates(currencies, years)
+
+
+def convert_usd_to_ppp(
+    values: ArrayLike,
+    countries: Union[str, Sequence[str], np.ndarray, pd.Series],
+    years: Union[int, Sequence[int], np.ndarray, pd.Series],
+    ppp: pd.DataFrame,
+) -> np.ndarray:
+    """ Convert market rate USD to international (PPP) USD. Pairs without a PPP factor become NaN """
+    return np.asarray(values, dtype=float) / get_ppp_factors(ppp, countries, years)
+
+
+def convert_salary_bins(
+    df: pd.DataFrame,
+    ppp: Optional[pd.DataFrame] = None,
+    year: Union[int, str] = SURVEY_YEAR,
+) -> pd.DataFrame:
+    """
+    Add the lower and upper bounds of the salary bins, optionally in PPP USD.
+
+    The survey salaries are in USD. `year` is either the survey year or the name of a column
+    holding the year of each respondent (e.g. for pooled multi-year datasets).
+
+    The added columns are `salary_lower` and `salary_upper`; with `ppp`, also `salary_lower_ppp`,
+    `salary_upper_ppp` and `salary_threshold_ppp`.
+    """
+    lower = df.salary.map(SALARY_LOWER_BOUNDS).to_numpy(dtype=float)
+    upper = df.salary.map(SALARY_THRESHOLDS).to_numpy(dtype=float)
+    columns = dict(salary_lower=lower, salary_upper=upper)
+    if ppp is not None:
+        years = df[year].to_numpy() if isinstance(year, str) else year
+        factors = get_ppp_factors(ppp, df.country.to_numpy(), years)
+        columns.update(
+            salary_lower_ppp=lower / factors,
+            salary_upper_ppp=upper / factors,
+            salary_threshold_ppp=df.salary_threshold.to_numpy(dtype=float) / factors,
+        )
+    df = df.assign(**columns)
+    return df
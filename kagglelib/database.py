@@ -0,0 +1,249 @@
+"""
+Export of the cleaned survey to a local SQLite database, for ad-hoc SQL without pandas.
+
+Tables:
+
+- `countries`: one row per country with its income group, average salary and filter thresholds
+- `respondents`: the demographic answers; `country_id` references `countries`. The ordinal answers
+  (e.g. `age`, `salary`) also have a `<name>_rank` column, their rank within `ORDINAL_DOMAINS`,
+  so that ranges and sorting are integer comparisons
+- `filter_flags`: one 0/1 column per rule of `FILTER_RULES` and `kept`, i.e. the rows of `filter_df()`
+- `questions` and `question_columns`: the question schema
+- `answers`: the non-missing answers to the other questions in long format
+
+```
+python -m kagglelib export
+kglib.query_sql(
+    "SELECT c.country, COUNT(*) AS n FROM respondents r JOIN countries c USING (country_id) "
+    "JOIN filter_flags f USING (respondent_id) WHERE f.kept AND r.role = ? GROUP BY c.country",
+    params=["Data Scientist"],
+)
+```
+"""
+import contextlib
+import os
+import pathlib
+import sqlite3
+
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from .kaggle import FILTER_RULES
+from .kaggle import ORDINAL_DOMAINS
+from .kaggle import get_filter_conditions
+from .kaggle import get_ordinal_codes
+from .kaggle import keep_demo_cols
+from .kaggle import load_question_schema
+from .kaggle import load_thresholds_df
+from .kaggle import load_udf
+from .paths import DATA
+
+DATABASE = DATA / "kaggle_survey_2020.sqlite"
+
+_COUNTRY_COLUMNS = [
+    "country",
+    "income_group",
+    "country_avg_salary",
+    "too_low_salary",
+    "low_salary_high_exp",
+    "high_salary_low_exp",
+]
+
+# The demographic keys of the segment queries
+_INDEXES = {
+    "respondents": [
+        "country_id, role",
+        "role",
+        "gender",
+        "education",
+        "age_rank",
+        "code_exp_rank",
+        "ml_exp_rank",
+        "salary_rank",
+    ],
+    "filter_flags": ["kept"],
+    "answers": ["question_id, value", "respondent_id"],
+}
+
+_SQL_TYPES = {"i": "INTEGER", "u": "INTEGER", "b": "INTEGER", "f": "REAL"}
+
+
+def _get_sql_type(sr: pd.Series) -> str:
+    return _SQL_TYPES.get(sr.dtype.kind, "TEXT")
+
+
+def _get_rows(df: pd.DataFrame) -> List[Tuple[Any, ...]]:
+    """ Return the rows of `df` as tuples of python scalars, with `None` for the missing values """
+    columns = []
+    for (_, sr) in df.items():
+        values = sr.astype(object).to_numpy()
+        values[sr.isna().to_numpy()] = None
+        columns.append(values)
+    return list(zip(*columns))
+
+
+def _create_table(
+    connection: sqlite3.Connection,
+    name: str,
+    df: pd.DataFrame,
+    primary_key: Optional[str] = None,
+    references: Optional[Dict[str, str]] = None,
+) -> None:
+    references = references or {}
+    definitions = []
+    for (column, sr) in df.items():
+        definition = f'"{column}" {_get_sql_type(sr)}'
+        if column == primary_key:
+            definition += " PRIMARY KEY"
+        if column in references:
+            definition += f" REFERENCES {references[column]}"
+        definitions.append(definition)
+    connection.execute(f"CREATE TABLE {name} ({', '.join(definitions)})")
+    placeholders = ", ".join("?" * len(df.columns))
+    connection.executemany(f"INSERT INTO {name} VALUES ({placeholders})", _get_rows(df))
+
+
+def _build_tables(udf: pd.DataFrame, remove_duplicates: bool) -> Dict[str, pd.DataFrame]:
+    countries = load_thresholds_df()[_COUNTRY_COLUMNS].reset_index(drop=True)
+    countries.insert(0, "country_id", np.arange(len(countries)))
+    respondent_ids = udf.index.to_numpy()
+    demographics = keep_demo_cols(udf).drop(columns=_COUNTRY_COLUMNS[1:], errors="ignore")
+    respondents = pd.DataFrame({"respondent_id": respondent_ids}, index=udf.index)
+    for (name, sr) in demographics.items():
+        if name == "country":
+            respondents["country_id"] = pd.Index(countries.country).get_indexer(sr)
+        elif name in ORDINAL_DOMAINS:
+            # e.g. `spend_ds` has integer categories
+            is_numeric = sr.cat.categories.dtype.kind in "iu"
+            respondents[name] = sr.astype(float).astype("Int64") if is_numeric else sr.astype(object)
+            codes = get_ordinal_codes(sr)
+            respondents[f"{name}_rank"] = codes.where(codes >= 0).astype("Int64")
+        else:
+            respondents[name] = sr
+    conditions = get_filter_conditions(udf, remove_duplicates=remove_duplicates)
+    filter_flags = pd.DataFrame({"respondent_id": respondent_ids}, index=udf.index)
+    for (rule, mask) in conditions.items():
+        filter_flags[rule] = mask.fillna(False).astype(int)
+    filter_flags["kept"] = 1 - filter_flags[list(FILTER_RULES)].max(axis=1)
+    schema = load_question_schema()
+    questions = pd.DataFrame(
+        [(q.id, q.number, q.type, q.text, q.section) for q in schema.questions.values()],
+        columns=["question_id", "number", "type", "text", "section"],
+    )
+    question_columns = pd.DataFrame(
+        [
+            (column, question_id, schema.choice_index.get(column))
+            for (column, question_id) in schema.column_index.items()
+        ],
+        columns=["column", "question_id", "choice"],
+    )
+    answer_columns = [column for column in udf.columns if column in schema.column_index]
+    answers = udf[answer_columns].stack().rename("value")
+    answers = answers.rename_axis(["respondent_id", "column"]).reset_index()
+    answers.insert(1, "question_id", answers["column"].map(schema.column_index))
+    tables = dict(
+        countries=countries,
+        respondents=respondents,
+        filter_flags=filter_flags,
+        questions=questions,
+        question_columns=question_columns,
+        answers=answers,
+    )
+    return tables
+
+
+def export_sqlite(
+    path: Union[str, pathlib.Path] = DATABASE,
+    udf: Optional[pd.DataFrame] = None,
+    remove_duplicates: bool = False,
+) -> pathlib.Path:
+    """
+    Write the cleaned survey (by default `load_udf()`) to the SQLite database at `path`.
+
+    The database is written to a temporary file with all the inserts in a single transaction
+    and the indexes are created after the inserts. It then replaces `path`, i.e. concurrent readers never see
+    a partial database.
+    """
+    path = pathlib.Path(path)
+    udf = load_udf() if udf is None else udf
+    tables = _build_tables(udf, remove_duplicates=remove_duplicates)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    connection = sqlite3.connect(str(tmp_path))
+    try:
+        # A crash can't corrupt the database, since it only replaces `path` when it is complete
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        with connection:
+            _create_table(connection, "countries", tables["countries"], primary_key="country_id")
+            _create_table(
+                connection,
+                "respondents",
+                tables["respondents"],
+                primary_key="respondent_id",
+                references=dict(country_id="countries"),
+            )
+            _create_table(
+                connection,
+                "filter_flags",
+                tables["filter_flags"],
+                primary_key="respondent_id",
+                references=dict(respondent_id="respondents"),
+            )
+            _create_table(connection, "questions", tables["questions"], primary_key="question_id")
+            _create_table(
+                connection,
+                "question_columns",
+                tables["question_columns"],
+                primary_key="column",
+                references=dict(question_id="questions"),
+            )
+            _create_table(
+                connection,
+                "answers",
+                tables["answers"],
+                references=dict(respondent_id="respondents", question_id="questions", column="question_columns"),
+            )
+            for (table, indexes) in _INDEXES.items():
+                for columns in indexes:
+                    index_name = f"idx_{table}_" + "_".join(column.strip() for column in columns.split(","))
+                    connection.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
+        connection.execute("ANALYZE")
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    return path
+
+
+@contextlib.contextmanager
+def connect_sqlite(path: Union[str, pathlib.Path] = DATABASE) -> Iterator[sqlite3.Connection]:
+    """ Open a read-only connection to the database """
+    path = pathlib.Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"No database at {path}; create it with `python -m kagglelib export`")
+    connection = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+def query_sql(
+    sql: str,
+    params: Optional[Union[Sequence[Any], Dict[str, Any]]] = None,
+    path: Union[str, pathlib.Path] = DATABASE,
+) -> pd.DataFrame:
+    """ Run a (read-only) query on the database and return the result as a DataFrame """
+    with connect_sqlite(path) as connection:
+        df = pd.read_sql_query(sql, connection, params=params)
+    return df
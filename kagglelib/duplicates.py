@@ -0,0 +1,285 @@
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from .cache import cached_frame
+from .kaggle import load_orig_kaggle_df
+
+# Mersenne-like prime that is larger than any 32bit token.
+# With `a < 2**31` and `x < 2**32`, `a * x + b` never overflows uint64.
+_MINHASH_PRIME = np.uint64(4294967311)
+_MAX_HASH = np.uint64(np.iinfo(np.uint64).max)
+
+
+def load_answers_df() -> pd.DataFrame:
+    # The "answers" are all the columns of the original dataset except from the duration.
+    # The duration is practically unique per submission and it would hide duplicates.
+    orig = load_orig_kaggle_df()
+    answers = orig.iloc[1:, 1:].reset_index(drop=True)
+    return answers
+
+
+def get_answer_hashes(answers: pd.DataFrame) -> pd.Series:
+    """ Return a 64bit hash of the answer vector of each respondent """
+    hashes = pd.util.hash_pandas_object(answers, index=False)
+    return hashes
+
+
+def get_exact_duplicate_clusters(answers: pd.DataFrame) -> pd.Series:
+    """
+    Return the exact duplicate cluster of each respondent.
+
+    Respondents with identical answer vectors share the same cluster id.
+    The cluster id is the index of the first respondent of the cluster.
+    """
+    hashes = get_answer_hashes(answers)
+    positions = pd.Series(answers.index, index=answers.index)
+    clusters = positions.groupby(hashes.to_numpy()).transform("first")
+    return clusters.rename("exact_cluster")
+
+
+def get_answer_tokens(answers: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the selected answers of each respondent as (row, token) arrays.
+
+    Each token is a 32bit hash of the (column, answer) pair.
+    Missing answers and the "None" choice of the multi-select questions are skipped.
+    The arrays are sorted by row.
+    """
+    values = answers.to_numpy(dtype=object)
+    selected = ~(pd.isnull(values) | (values == "None") | (values == ""))
+    rows, cols = np.nonzero(selected)
+    column_salt = pd.util.hash_array(answers.columns.to_numpy(dtype=object))
+    tokens = pd.util.hash_array(values[rows, cols]) ^ column_salt[cols]
+    tokens = (tokens >> np.uint64(32)) ^ (tokens & np.uint64(0xFFFFFFFF))
+    return rows, tokens
+
+
+def get_minhash_signatures(
+    answers: pd.DataFrame,
+    num_perm: int = 128,
+    seed: int = 0,
+    chunk_size: int = 16,
+) -> np.ndarray:
+    """
+    Return a (respondents x num_perm) MinHash signature matrix of the selected answers.
+
+    Respondents without any selected answer get a signature of `_MAX_HASH`.
+    """
+    rows, tokens = get_answer_tokens(answers)
+    signatures = np.full((len(answers), num_perm), _MAX_HASH, dtype=np.uint64)
+    if not len(rows):
+        return signatures
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2 ** 31, size=num_perm, dtype=np.int64).astype(np.uint64)
+    b = rng.randint(0, 2 ** 31, size=num_perm, dtype=np.int64).astype(np.uint64)
+    # `reduceat` needs the start offset of each (non empty) row
+    non_empty_rows, starts = np.unique(rows, return_index=True)
+    for offset in range(0, num_perm, chunk_size):
+        a_chunk = a[offset:offset + chunk_size, None]
+        b_chunk = b[offset:offset + chunk_size, None]
+        permuted = (a_chunk * tokens[None, :] + b_chunk) % _MINHASH_PRIME
+        signatures[non_empty_rows, offset:offset + chunk_size] = np.minimum.reduceat(permuted, starts, axis=1).T
+    return signatures
+
+
+def _get_buckets(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Return the positions sorted by key, and the start and the size of each bucket (i.e. key) in that order """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    boundaries = np.flatnonzero(np.diff(sorted_keys)) + 1
+    starts = np.concatenate(([0], boundaries))
+    sizes = np.diff(np.concatenate((starts, [len(keys)])))
+    return order, starts, sizes
+
+
+def _get_bucket_pairs(
+    order: np.ndarray,
+    starts: np.ndarray,
+    sizes: np.ndarray,
+    max_bucket_size: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return all the (i, j) pairs, i < j, of the positions that share a bucket of at most `max_bucket_size` positions.
+
+    The number of pairs is at most `len(order) * max_bucket_size / 2`, so is their memory.
+    """
+    left, right = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    # Buckets of the same size are processed together as a (buckets x size) matrix
+    for size in np.unique(sizes[(sizes > 1) & (sizes <= max_bucket_size)]):
+        bucket_starts = starts[sizes == size]
+        members = order[bucket_starts[:, None] + np.arange(size)[None, :]]
+        iu, ju = np.triu_indices(size, k=1)
+        left.append(members[:, iu].ravel())
+        right.append(members[:, ju].ravel())
+    left, right = np.concatenate(left), np.concatenate(right)
+    swap = left > right
+    left[swap], right[swap] = right[swap], left[swap]
+    return left, right
+
+
+def _get_similar_pairs(
+    signatures: np.ndarray,
+    members: np.ndarray,
+    threshold: float,
+    max_elements: int = 2 ** 24,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the (i, j) pairs, i < j, of `members` whose estimated similarity is at least `threshold`.
+
+    The members are compared a chunk of rows at a time, so at most `max_elements` signature values are compared
+    at once, whatever the number of members.
+    """
+    members = np.sort(members)
+    member_signatures = signatures[members]
+    chunk_size = max(1, max_elements // (len(members) * signatures.shape[1]))
+    left, right = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for offset in range(0, len(members), chunk_size):
+        chunk = member_signatures[offset:offset + chunk_size]
+        similarity = (chunk[:, None, :] == member_signatures[None, :, :]).mean(axis=2)
+        rows, cols = np.nonzero(similarity >= threshold)
+        upper = cols > rows + offset
+        left.append(members[rows[upper] + offset])
+        right.append(members[cols[upper]])
+    return np.concatenate(left), np.concatenate(right)
+
+
+def _get_pair_similarities(
+    signatures: np.ndarray,
+    left: np.ndarray,
+    right: np.ndarray,
+    max_elements: int = 2 ** 24,
+) -> np.ndarray:
+    """ Return the estimated similarity of each (left, right) pair, comparing `max_elements` values at a time """
+    chunk_size = max(1, max_elements // signatures.shape[1])
+    similarity = np.empty(len(left))
+    for offset in range(0, len(left), chunk_size):
+        chunk = slice(offset, offset + chunk_size)
+        similarity[chunk] = (signatures[left[chunk]] == signatures[right[chunk]]).mean(axis=1)
+    return similarity
+
+
+def get_near_duplicate_pairs(
+    signatures: np.ndarray,
+    bands: int = 16,
+    threshold: float = 0.9,
+    seed: int = 0,
+    max_bucket_size: int = 64,
+) -> pd.DataFrame:
+    """
+    Return the pairs of respondents whose estimated Jaccard similarity is at least `threshold`.
+
+    Candidate pairs are the ones that share at least one LSH bucket, i.e. we never compare all the pairs.
+    With `r = num_perm / bands` rows per band, the detection probability of a pair with similarity `s`
+    is `1 - (1 - s ** r) ** bands`.
+
+    The number of candidate pairs (and their memory) doesn't grow with the square of the bucket sizes:
+
+    - Respondents with identical signatures (e.g. exact duplicates) are only paired with the first of them,
+      which gives the same connected components as all of their pairs.
+    - The pairs of the buckets with more than `max_bucket_size` respondents are not enumerated.
+      Each such bucket is checked on its own, in chunks, and only its similar pairs are kept.
+    """
+    num_rows, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"The number of permutations must be a multiple of the bands: {num_perm} vs {bands}")
+    rows_per_band = num_perm // bands
+    rng = np.random.RandomState(seed)
+    multipliers = rng.randint(1, 2 ** 62, size=rows_per_band, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+    has_answers = signatures[:, 0] != _MAX_HASH
+    answered = np.flatnonzero(has_answers)
+    _, first, inverse = np.unique(signatures[answered], axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    copies = np.flatnonzero(first[inverse] != np.arange(len(answered)))
+    pair_codes = [answered[first[inverse[copies]]].astype(np.int64) * num_rows + answered[copies]]
+    candidates = answered[np.sort(first)]
+    with np.errstate(over="ignore"):
+        for band in range(bands):
+            band_signatures = signatures[candidates, band * rows_per_band:(band + 1) * rows_per_band]
+            keys = (band_signatures * multipliers).sum(axis=1)
+            order, starts, sizes = _get_buckets(keys)
+            left, right = _get_bucket_pairs(order, starts, sizes, max_bucket_size)
+            pair_codes.append(candidates[left].astype(np.int64) * num_rows + candidates[right])
+            for (start, size) in zip(starts[sizes > max_bucket_size], sizes[sizes > max_bucket_size]):
+                left, right = _get_similar_pairs(signatures, candidates[order[start:start + size]], threshold)
+                pair_codes.append(left.astype(np.int64) * num_rows + right)
+            # The bands find many of the same pairs
+            pair_codes = [np.unique(np.concatenate(pair_codes))]
+    left, right = np.divmod(pair_codes[0], num_rows)
+    similarity = _get_pair_similarities(signatures, left, right)
+    keep = similarity >= threshold
+    df = pd.DataFrame({"left": left[keep], "right": right[keep], "similarity": similarity[keep]})
+    return df
+
+
+def get_near_duplicate_clusters(answers: pd.DataFrame, pairs: pd.DataFrame) -> pd.Series:
+    """ Return the connected components of the near duplicate graph as cluster ids """
+    num_rows = len(answers)
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs.left.to_numpy(), pairs.right.to_numpy())),
+        shape=(num_rows, num_rows),
+    )
+    _, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    # Use the first respondent of each component as the cluster id
+    first_member = pd.Series(np.arange(num_rows)).groupby(labels).transform("min").to_numpy()
+    clusters = pd.Series(answers.index[first_member], index=answers.index, name="near_cluster")
+    return clusters
+
+
+@cached_frame(maxsize=1, depends_on=[load_orig_kaggle_df])
+def load_duplicates_df(
+    threshold: float = 0.9,
+    num_perm: int = 128,
+    bands: int = 16,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Return the exact and near duplicate clusters of each respondent.
+
+    The index is aligned with `load_udf()`. The first respondent of each cluster is not flagged as duplicate.
+    """
+    answers = load_answers_df()
+    exact = get_exact_duplicate_clusters(answers)
+    signatures = get_minhash_signatures(answers, num_perm=num_perm, seed=seed)
+    pairs = get_near_duplicate_pairs(signatures, bands=bands, threshold=threshold, seed=seed)
+    near = get_near_duplicate_clusters(answers, pairs)
+    df = pd.DataFrame({"exact_cluster": exact, "near_cluster": near})
+    df = df.assign(
+        exact_cluster_size=df.groupby("exact_cluster").exact_cluster.transform("size"),
+        near_cluster_size=df.groupby("near_cluster").near_cluster.transform("size"),
+        is_exact_duplicate=df.exact_cluster != df.index,
+        is_near_duplicate=df.near_cluster != df.index,
+    )
+    return df
+
+
+def get_duplicate_clusters_df(
+    duplicates_df: Optional[pd.DataFrame] = None,
+    kind: str = "near",
+) -> pd.DataFrame:
+    """
+    Return a report with one row per duplicate cluster (i.e. clusters with at least 2 respondents).
+
+    ```
+    report = kglib.get_duplicate_clusters_df(kind="exact")
+    ```
+    """
+    if kind not in ("exact", "near"):
+        raise ValueError(f"kind should be either <exact> or <near>, not: {kind}")
+    if duplicates_df is None:
+        duplicates_df = load_duplicates_df()
+    column = f"{kind}_cluster"
+    df = duplicates_df[duplicates_df[f"{column}_size"] > 1]
+    report = (
+        df.reset_index()
+        .groupby(column)["index"]
+        .agg(size="size", respondents=list)
+        .sort_values("size", ascending=False)
+        .rename_axis("cluster")
+        .reset_index()
+    )
+    return report
@@ -0,0 +1,248 @@
+"""
+Interactive tuning of the filters of `filter_df()`.
+
+`FilterExplorer` precomputes everything that does not depend on the threshold parameters. On every change,
+only the masks of the rules that depend on the changed parameters are recomputed, the distributions are
+`np.bincount()`s of the kept rows, and the bars of the (ipympl) figure are updated in place.
+
+```
+%matplotlib widget
+explorer = kglib.FilterExplorer()
+explorer.show()
+```
+
+Without the widgets, the same state can be driven from code:
+
+```
+explorer.set_parameters(low_salary_percentage=0.3, threshold_offset=1)
+explorer.set_rule("too_low_salary", False)
+explorer.get_removed_counts()
+```
+"""
+import time
+
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from .kaggle import FILTER_RULES
+from .kaggle import SALARY_THRESHOLDS
+from .kaggle import build_thresholds_df
+from .kaggle import get_filter_conditions
+from .kaggle import get_ordinal_codes
+from .kaggle import load_udf
+from .plots import PALETTE_ORIGINAL_VS_FILTERED
+from .third_party import load_mean_salary_comparison_df
+
+# The defaults of `load_thresholds_df()`
+FILTER_PARAMETERS = dict(low_salary_percentage=0.4, threshold_offset=2, high_salary_low_exp_threshold=500000)
+
+# The parameters each rule depends on. The masks of the other rules never change.
+RULE_PARAMETERS: Dict[str, Tuple[str, ...]] = {
+    "too_young_for_experience": (),
+    "too_young_for_salary": ("high_salary_low_exp_threshold",),
+    "too_low_salary": ("low_salary_percentage", "threshold_offset"),
+    "low_salary_high_exp": ("threshold_offset",),
+    "high_salary_low_exp": ("high_salary_low_exp_threshold",),
+    "only_answered_demographics": (),
+    "duplicate": (),
+    "anomaly": (),
+}
+
+_RULE_COLUMNS = ["age", "code_exp", "ml_exp", "salary_threshold"]
+_THRESHOLD_COLUMNS = ["too_low_salary", "low_salary_high_exp", "high_salary_low_exp"]
+
+
+def _get_percentages(counts: np.ndarray) -> np.ndarray:
+    total = counts.sum()
+    return counts * 100 / total if total else np.zeros(len(counts))
+
+
+class FilterExplorer:
+    def __init__(
+        self,
+        udf: Optional[pd.DataFrame] = None,
+        remove_duplicates: bool = False,
+        min_no_participants: float = 1.0,
+        max_anomaly_score: Optional[float] = None,
+    ) -> None:
+        udf = load_udf() if udf is None else udf
+        self.parameters: Dict[str, Any] = dict(FILTER_PARAMETERS)
+        self.enabled = {rule: rule not in ("duplicate", "anomaly") for rule in FILTER_RULES}
+        self.enabled.update(duplicate=remove_duplicates, anomaly=max_anomaly_score is not None)
+        self.max_anomaly_score = 0.6 if max_anomaly_score is None else max_anomaly_score
+        self.last_update_ms = 0.0
+        self._frame = udf[_RULE_COLUMNS]
+        self._mean_salary_df = load_mean_salary_comparison_df()
+        countries = build_thresholds_df(self._mean_salary_df).country
+        self._threshold_positions = pd.Index(countries).get_indexer(udf.country)
+        self._thresholds: Dict[Tuple[Any, ...], pd.DataFrame] = {}
+        # rule -> (the parameters it was computed with, mask)
+        self._masks: Dict[str, Tuple[Tuple[Any, ...], np.ndarray]] = {}
+        # The distributions of the unfiltered dataset; the filtered ones are bincounts of the kept rows
+        self.salary_labels = list(SALARY_THRESHOLDS)
+        self._salary_codes = get_ordinal_codes(udf.salary).to_numpy()
+        country_codes, country_labels = pd.factorize(udf.country, sort=True)
+        self._country_codes = country_codes
+        country_percentages = _get_percentages(np.bincount(country_codes[country_codes >= 0]))
+        self._shown_countries = np.flatnonzero(country_percentages > min_no_participants)
+        self.country_labels = list(country_labels[self._shown_countries])
+        self._original_salary = self._get_salary_percentages(np.ones(len(udf), dtype=bool))
+        self._original_countries = country_percentages[self._shown_countries]
+
+    def set_parameters(self, **parameters: Any) -> None:
+        unknown = set(parameters) - set(FILTER_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown filter parameters: {sorted(unknown)}")
+        self.parameters.update(parameters)
+
+    def set_rule(self, rule: str, enabled: bool) -> None:
+        if rule not in FILTER_RULES:
+            raise ValueError(f"Unknown filter rule: {rule}")
+        self.enabled[rule] = enabled
+
+    def _get_rule_frame(self) -> pd.DataFrame:
+        key = tuple(self.parameters[name] for name in FILTER_PARAMETERS)
+        if key not in self._thresholds:
+            self._thresholds[key] = build_thresholds_df(self._mean_salary_df, **self.parameters)
+        thresholds = self._thresholds[key]
+        columns = {column: thresholds[column].to_numpy()[self._threshold_positions] for column in _THRESHOLD_COLUMNS}
+        return self._frame.assign(**columns)
+
+    def get_masks(self) -> Dict[str, np.ndarray]:
+        """ Return the mask of the removed participants of each rule, recomputing only the stale ones """
+        keys = {rule: tuple(self.parameters[name] for name in names) for (rule, names) in RULE_PARAMETERS.items()}
+        # The duplicates and the anomaly scores are only computed once their rule gets enabled
+        keys["duplicate"] = (self.enabled["duplicate"],)
+        keys["anomaly"] = (self.enabled["anomaly"], self.max_anomaly_score)
+        stale = [rule for (rule, key) in keys.items() if rule not in self._masks or self._masks[rule][0] != key]
+        if stale:
+            needs_thresholds = any(RULE_PARAMETERS[rule] for rule in stale)
+            frame = self._get_rule_frame() if needs_thresholds else self._frame
+            conditions = get_filter_conditions(
+                frame,
+                remove_duplicates=self.enabled["duplicate"],
+                rules=stale,
+                max_anomaly_score=self.max_anomaly_score if self.enabled["anomaly"] else None,
+            )
+            for (rule, mask) in conditions.items():
+                self._masks[rule] = (keys[rule], mask.fillna(False).to_numpy(dtype=bool))
+        return {rule: self._masks[rule][1] for rule in FILTER_RULES}
+
+    def get_kept(self) -> np.ndarray:
+        masks = self.get_masks()
+        removed = np.zeros(len(self._frame), dtype=bool)
+        for (rule, mask) in masks.items():
+            if self.enabled[rule]:
+                removed |= mask
+        return ~removed
+
+    def get_removed_counts(self) -> pd.Series:
+        """ Return the participants removed by each rule (enabled or not) and by the enabled rules combined """
+        counts = {FILTER_RULES[rule]: int(mask.sum()) for (rule, mask) in self.get_masks().items()}
+        counts["All conditions combined"] = int(len(self._frame) - self.get_kept().sum())
+        return pd.Series(counts, name="removed")
+
+    def _get_salary_percentages(self, kept: np.ndarray) -> np.ndarray:
+        codes = self._salary_codes[kept]
+        return _get_percentages(np.bincount(codes[codes >= 0], minlength=len(self.salary_labels)))
+
+    def _get_country_percentages(self, kept: np.ndarray) -> np.ndarray:
+        codes = self._country_codes[kept]
+        counts = np.bincount(codes[codes >= 0], minlength=self._country_codes.max() + 1)
+        return _get_percentages(counts)[self._shown_countries]
+
+    def get_salary_comparison(self) -> pd.DataFrame:
+        """ Return the % of the participants per salary bin, before and after the filters """
+        filtered = self._get_salary_percentages(self.get_kept())
+        return pd.DataFrame(dict(original=self._original_salary, filtered=filtered), index=self.salary_labels)
+
+    def get_participants_comparison(self) -> pd.DataFrame:
+        """ Return the % of the participants per country, before and after the filters """
+        filtered = self._get_country_percentages(self.get_kept())
+        return pd.DataFrame(dict(original=self._original_countries, filtered=filtered), index=self.country_labels)
+
+    def _draw(self, axes: Any) -> Dict[str, Any]:
+        bars = {}
+        for (ax, name, labels, original) in [
+            (axes[0], "salary", self.salary_labels, self._original_salary),
+            (axes[1], "countries", self.country_labels, self._original_countries),
+        ]:
+            x = np.arange(len(labels))
+            ax.bar(x - 0.2, original, width=0.4, color=PALETTE_ORIGINAL_VS_FILTERED[0], label="Unfiltered")
+            bars[name] = ax.bar(x + 0.2, original, width=0.4, color=PALETTE_ORIGINAL_VS_FILTERED[1], label="Filtered")
+            ax.set_xticks(x)
+            ax.set_xticklabels(labels, rotation=90)
+            ax.set_ylabel("% of participants")
+            ax.legend(loc="upper right")
+        return bars
+
+    def _update_artists(self, fig: Any, axes: Any, bars: Dict[str, Any], kept: np.ndarray) -> None:
+        for (ax, name, original, filtered) in [
+            (axes[0], "salary", self._original_salary, self._get_salary_percentages(kept)),
+            (axes[1], "countries", self._original_countries, self._get_country_percentages(kept)),
+        ]:
+            for (bar, height) in zip(bars[name], filtered):
+                bar.set_height(height)
+            ax.set_ylim(0, 1.1 * max(original.max(initial=0), filtered.max(initial=0), 1))
+        fig.canvas.draw_idle()
+
+    def show(self, figsize: Tuple[float, float] = (14, 10)) -> Any:
+        """ Return the widget: the parameter sliders, a checkbox per rule, the removed counts and the plots """
+        import ipywidgets
+
+        was_interactive = plt.isinteractive()
+        plt.ioff()
+        try:
+            fig, axes = plt.subplots(nrows=2, figsize=figsize, constrained_layout=True)
+        finally:
+            if was_interactive:
+                plt.ion()
+        axes[0].set_title("Salary distribution")
+        axes[1].set_title("Participants per country")
+        bars = self._draw(axes)
+        sliders = dict(
+            low_salary_percentage=ipywidgets.FloatSlider(
+                value=self.parameters["low_salary_percentage"], min=0.05, max=1, step=0.05, description="Low salary %"
+            ),
+            threshold_offset=ipywidgets.IntSlider(
+                value=self.parameters["threshold_offset"], min=0, max=5, description="Offset"
+            ),
+            high_salary_low_exp_threshold=ipywidgets.SelectionSlider(
+                options=[(f"{value:,}", value) for value in SALARY_THRESHOLDS.values()],
+                value=self.parameters["high_salary_low_exp_threshold"],
+                description="High salary",
+            ),
+        )
+        anomaly_slider = ipywidgets.FloatSlider(
+            value=self.max_anomaly_score, min=0.5, max=0.85, step=0.01, description="Max anomaly"
+        )
+        checkboxes = {
+            rule: ipywidgets.Checkbox(value=self.enabled[rule], description=label)
+            for (rule, label) in FILTER_RULES.items()
+        }
+        summary = ipywidgets.HTML()
+
+        def refresh(change: Optional[Dict[str, Any]] = None) -> None:
+            start = time.perf_counter()
+            self.set_parameters(**{name: slider.value for (name, slider) in sliders.items()})
+            self.max_anomaly_score = anomaly_slider.value
+            for (rule, checkbox) in checkboxes.items():
+                self.set_rule(rule, checkbox.value)
+            kept = self.get_kept()
+            self._update_artists(fig, axes, bars, kept)
+            summary.value = self.get_removed_counts().to_frame().to_html()
+            self.last_update_ms = (time.perf_counter() - start) * 1000
+            summary.value += f"<p>Updated in {self.last_update_ms:.0f} ms</p>"
+
+        sliders_box = ipywidgets.VBox(list(sliders.values()) + [anomaly_slider])
+        for widget in list(sliders_box.children) + list(checkboxes.values()):
+            widget.observe(refresh, names="value")
+        refresh()
+        controls = ipywidgets.HBox([sliders_box, ipywidgets.VBox(list(checkboxes.values())), summary])
+        return ipywidgets.VBox([controls, fig.canvas])
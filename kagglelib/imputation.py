@@ -0,0 +1,186 @@
+"""
+Hot-deck imputation of missing answers, e.g. the salary.
+
+Each respondent with a missing answer (the recipient) gets the answer of a random respondent (the donor)
+of the same pool. The pools are tried from the most to the least specific, e.g. same country, role and coding
+experience first, then same country and role etc., until a pool has at least `min_donors` donors.
+
+The draws are vectorized: the donors are sorted by pool once, so each pool is a contiguous slice
+of the cumulative donor weights and all the draws of all the replicates are a single `np.searchsorted()`.
+
+```
+imputations = kglib.get_imputations(udf, "salary", replicates=5)
+ids = kglib.impute_df(udf, columns=["salary", "ml_exp"], replicate=0)
+ids = kglib.load_imputed_udf(replicate=1)
+```
+"""
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from .cache import cached_frame
+from .kaggle import ML_EXP_LEVELS
+from .kaggle import SALARY_THRESHOLDS
+from .kaggle import load_udf
+from .subset import Subset
+from .subset import as_subset
+
+# From the most to the least specific. The last pool is the whole dataset.
+IMPUTATION_POOLS: Tuple[Tuple[str, ...], ...] = (
+    ("country", "role", "code_level"),
+    ("country", "role"),
+    ("country",),
+    (),
+)
+
+# Respondents without a job have no salary to impute; they neither receive nor donate one
+IMPUTATION_EXCLUDED_ROLES: Dict[str, Tuple[str, ...]] = {
+    "salary": ("Student", "Currently not employed"),
+}
+
+# Columns derived from the imputed ones
+_DERIVED_COLUMNS = {
+    "salary": ("salary_threshold", SALARY_THRESHOLDS),
+    "ml_exp": ("ml_level", ML_EXP_LEVELS),
+}
+
+
+def _get_pool_codes(df: Union[pd.DataFrame, Subset], keys: Sequence[str]) -> np.ndarray:
+    if not keys:
+        return np.zeros(len(df), dtype=np.int64)
+    frame = as_subset(df).materialize(list(keys))
+    return frame.groupby(list(keys), sort=False, dropna=False, observed=True).ngroup().to_numpy()
+
+
+def get_hot_deck_donors(
+    df: pd.DataFrame,
+    column: str,
+    pools: Sequence[Sequence[str]] = IMPUTATION_POOLS,
+    replicates: int = 5,
+    min_donors: int = 5,
+    seed: int = 0,
+    eligible: Optional[np.ndarray] = None,
+    weights: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Return the positions of the recipients, the pool of each recipient (-1 if there is no donor at all)
+    and the (replicates x recipients) positions of their donors.
+
+    - `eligible` is a boolean mask of the respondents that can receive or donate an answer (default: all).
+    - With `weights` (e.g. sampling weights), the donors are drawn with probability proportional to their weight.
+    - The last pool only needs a single donor.
+    """
+    missing = df[column].isna().to_numpy()
+    eligible = np.ones(len(df), dtype=bool) if eligible is None else np.asarray(eligible, dtype=bool)
+    weights = np.ones(len(df)) if weights is None else np.asarray(weights, dtype=float)
+    donors = np.flatnonzero(eligible & ~missing)
+    recipients = np.flatnonzero(eligible & missing)
+    levels = np.full(len(recipients), -1)
+    draws = np.full((replicates, len(recipients)), -1)
+    uniforms = np.random.default_rng(seed).random((replicates, len(recipients)))
+    for (level, keys) in enumerate(pools):
+        pending = np.flatnonzero(levels < 0)
+        if len(pending) == 0 or len(donors) == 0:
+            break
+        codes = _get_pool_codes(df, keys)
+        counts = np.bincount(codes[donors], minlength=codes.max() + 1)
+        recipient_codes = codes[recipients[pending]]
+        threshold = min_donors if level < len(pools) - 1 else 1
+        selected = pending[counts[recipient_codes] >= threshold]
+        if len(selected) == 0:
+            continue
+        # Grouped cumulative weights: the donors of each pool are contiguous in `order`
+        order = donors[np.argsort(codes[donors], kind="stable")]
+        cumulative = np.concatenate([[0.0], np.cumsum(weights[order])])
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        pool = codes[recipients[selected]]
+        lower, upper = cumulative[starts[pool]], cumulative[ends[pool]]
+        targets = lower + uniforms[:, selected] * (upper - lower)
+        positions = np.searchsorted(cumulative, targets, side="right") - 1
+        # Guard against the rounding of the cumulative sums
+        positions = np.clip(positions, starts[pool], ends[pool] - 1)
+        draws[:, selected] = order[positions]
+        levels[selected] = level
+    return recipients, levels, draws
+
+
+def get_imputations(
+    df: Union[pd.DataFrame, Subset],
+    column: str = "salary",
+    pools: Sequence[Sequence[str]] = IMPUTATION_POOLS,
+    replicates: int = 5,
+    min_donors: int = 5,
+    seed: int = 0,
+    weights: Optional[pd.Series] = None,
+) -> pd.DataFrame:
+    """
+    Return the imputed values of `column`: one row per recipient and one column per replicate.
+
+    The `pool` column is the pool the donors were drawn from, e.g. "country+role", or NaN if there was no donor.
+    The respondents of `IMPUTATION_EXCLUDED_ROLES[column]` are left out.
+    """
+    excluded_roles = IMPUTATION_EXCLUDED_ROLES.get(column, ())
+    eligible = ~df.role.isin(excluded_roles).to_numpy() if excluded_roles else None
+    recipients, levels, draws = get_hot_deck_donors(
+        df,
+        column,
+        pools=pools,
+        replicates=replicates,
+        min_donors=min_donors,
+        seed=seed,
+        eligible=eligible,
+        weights=None if weights is None else weights.reindex(df.index).fillna(0).to_numpy(dtype=float),
+    )
+    pool_names = np.array(["+".join(keys) or "all" for keys in pools] + [np.nan], dtype=object)
+    values = df[column].array
+    imputations = pd.DataFrame({"pool": pool_names[levels]}, index=df.index[recipients])
+    for replicate in range(replicates):
+        imputations[replicate] = values.take(draws[replicate], allow_fill=True)
+    return imputations
+
+
+def impute_df(
+    df: Union[pd.DataFrame, Subset],
+    columns: Sequence[str] = ("salary",),
+    replicate: int = 0,
+    replicates: int = 5,
+    seed: int = 0,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Return `df` with the missing values of `columns` replaced by the imputations of `replicate`.
+
+    The derived columns (e.g. `salary_threshold`) are updated too and an `<column>_imputed` column flags
+    the imputed rows. Replicates of the same `seed` are consistent with each other, i.e. they are
+    the replicates of a single multiple imputation.
+    """
+    if not 0 <= replicate < replicates:
+        raise ValueError(f"replicate should be in [0, {replicates}), not: {replicate}")
+    # The result has all the columns, so a subset is materialized in full
+    df = as_subset(df).materialize()
+    assignments = {}
+    for column in columns:
+        imputations = get_imputations(df, column, replicates=replicates, seed=seed, **kwargs)
+        imputations = imputations[imputations.pool.notna()]
+        sr = df[column].copy()
+        sr.loc[imputations.index] = imputations[replicate]
+        assignments[column] = sr
+        if column in _DERIVED_COLUMNS:
+            (derived, mapping) = _DERIVED_COLUMNS[column]
+            assignments[derived] = sr.astype(object).map(mapping)
+        assignments[f"{column}_imputed"] = df.index.isin(imputations.index)
+    df = df.assign(**assignments)
+    return df
+
+
+@cached_frame(maxsize=2, depends_on=[load_udf])
+def load_imputed_udf(replicate: int = 0, replicates: int = 5, seed: int = 0) -> pd.DataFrame:
+    """ Return the unfiltered dataset with imputed salaries """
+    df = impute_df(load_udf(), columns=["salary"], replicate=replicate, replicates=replicates, seed=seed)
+    return df
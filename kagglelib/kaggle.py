@@ -1,33 +1,45 @@
 import functools
-import textwrap
+import operator
 
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Sequence
 from typing import Union
 
-import natsort
 import numpy as np
 import pandas as pd
-
+import scipy.stats
+
+from .binning import AGE_BINS
+from .binning import ADJUSTED_AGE_BINS
+from .binning import CODE_EXP_BINS
+from .binning import ML_EXP_BINS
+from .binning import get_bin_widths
+from .binning import rebin_counts
+from .cache import cached_frame
+from .memory import memory_stage
+from .memory import profile_memory
 from .paths import DATA
+from .sampling import SAMPLE_WEIGHT
+from .sampling import STRATA
+from .sampling import STRATUM_SIZE
+from .sampling import get_median_estimate
+from .sampling import get_stratified_sample
+from .sampling import get_value_count_errors
+from .schema import QuestionSchema
+from .schema import build_question_schema
+from .subset import Subset
+from .subset import as_subset
 from .third_party import load_mean_salary_comparison_df
+from .utils import get_value_counts
+from .utils import get_weighted_median
 from .utils import stack_dataframe
 from .utils import stack_value_count_df
 from .utils import stack_value_count_comparison
 
-YEARS_PER_BIN = {
-    "18-21": 4,
-    "22-24": 3,
-    "25-29": 5,
-    "30-34": 5,
-    "35-39": 5,
-    "40-44": 5,
-    "45-49": 5,
-    "50-54": 5,
-    "55-59": 5,
-    "60-69": 10,
-    "70+": 10
-}
+YEARS_PER_BIN = get_bin_widths(AGE_BINS)
 
 SALARY_THRESHOLDS = {
     "0-999": 1000,
@@ -59,6 +71,8 @@ SALARY_THRESHOLDS = {
 
 REVERSE_SALARY_THRESHOLDS = {v: k for (k, v) in SALARY_THRESHOLDS.items()}
 
+SALARY_BINS = {label: (int(label.split("-")[0]), threshold) for (label, threshold) in SALARY_THRESHOLDS.items()}
+
 SALARY_AGGREGATE_BINS = {
     "$0-999": 5000,
     "1,000-1,999": 5000,
@@ -87,6 +101,13 @@ SALARY_AGGREGATE_BINS = {
     "> $500,000": 1000000,
 }
 
+# The coarser salary bins of `SALARY_AGGREGATE_BINS` as a bin scheme, e.g. "60000-79999"
+_SALARY_AGGREGATE_BOUNDS = [0] + sorted(set(SALARY_AGGREGATE_BINS.values()))
+SALARY_AGGREGATE_SCHEME = {
+    f"{lower}-{upper - 1}": (lower, upper)
+    for (lower, upper) in zip(_SALARY_AGGREGATE_BOUNDS[:-1], _SALARY_AGGREGATE_BOUNDS[1:])
+}
+
 CODE_EXP_LEVELS={
     "0": "1. low XP",
     "0-1": "1. low XP",
@@ -109,6 +130,42 @@ ML_EXP_LEVELS={
     "20+": "3. high XP",
 }
 
+# Ordered categorical dtypes of the ordinal answers. The categories are in increasing order,
+# therefore comparisons and sorting use the integer codes instead of the (lexicographic) labels
+ORDINAL_DOMAINS: Dict[str, pd.CategoricalDtype] = {}
+
+
+def register_ordinal_domain(name: str, labels: Sequence[Any]) -> pd.CategoricalDtype:
+    dtype = pd.CategoricalDtype(categories=list(labels), ordered=True)
+    ORDINAL_DOMAINS[name] = dtype
+    return dtype
+
+
+register_ordinal_domain("age", AGE_BINS)
+register_ordinal_domain("salary", SALARY_THRESHOLDS)
+register_ordinal_domain("code_exp", CODE_EXP_BINS)
+register_ordinal_domain("ml_exp", ML_EXP_BINS)
+register_ordinal_domain("employees", ["0-49", "50-249", "250-999", "1000-9999", "10000+"])
+register_ordinal_domain("team_ds", ["0", "1-2", "3-4", "5-9", "10-14", "15-19", "20+"])
+register_ordinal_domain("spend_ds", [0, 100, 1000, 10000, 100000, 1000000])
+
+
+def to_ordinal(sr: pd.Series, domain: Optional[str] = None) -> pd.Series:
+    """ Convert `sr` to the ordered categorical of `domain` (by default the name of `sr`) """
+    dtype = ORDINAL_DOMAINS[domain or sr.name]
+    unknown = set(sr.dropna().unique()) - set(dtype.categories)
+    if unknown:
+        raise ValueError(f"Unknown values for <{domain or sr.name}>: {sorted(unknown, key=str)}")
+    return sr.astype(dtype)
+
+
+def get_ordinal_codes(sr: pd.Series) -> pd.Series:
+    """ Return the rank of each value within its domain; -1 for missing values """
+    if not isinstance(sr.dtype, pd.CategoricalDtype):
+        sr = to_ordinal(sr)
+    return sr.cat.codes
+
+
 _KAGGLE_ROLES = set(
     [
         "Business Analyst",
@@ -144,7 +201,7 @@ _KAGGLE_RENAMES = {
 }
 
 
-@functools.lru_cache(maxsize=1)
+@cached_frame(maxsize=1)
 def load_orig_kaggle_df() -> pd.DataFrame:
     df = pd.read_csv(
         DATA / "kaggle_survey_2020_responses.csv",
@@ -154,13 +211,20 @@ def load_orig_kaggle_df() -> pd.DataFrame:
     return df
 
 
-@functools.lru_cache(maxsize=1)
+@cached_frame(maxsize=1, depends_on=[load_orig_kaggle_df])
 def load_questions_df() -> pd.DataFrame:
     orig = load_orig_kaggle_df()
     questions_df = orig.loc[0].reset_index(drop=True)
     return questions_df
 
 
+@cached_frame(maxsize=1, depends_on=[load_orig_kaggle_df, load_questions_df])
+def load_question_schema() -> QuestionSchema:
+    orig = load_orig_kaggle_df()
+    schema = build_question_schema(orig.columns, load_questions_df())
+    return schema
+
+
 def get_threshold(value: float, offset: int):
     thresholds = list(SALARY_THRESHOLDS.values())
     for i, threshold in enumerate(thresholds):
@@ -170,115 +234,166 @@ def get_threshold(value: float, offset: int):
     return thresholds[index]
 
 
-@functools.lru_cache(maxsize=1)
-def load_thresholds_df(
+def get_thresholds(values: Union[Sequence[float], np.ndarray], offset: int) -> np.ndarray:
+    """ Vectorized `get_threshold()` """
+    thresholds = np.array(list(SALARY_THRESHOLDS.values()))
+    # The first threshold >= value, or the last one if there is none (e.g. for NaN)
+    positions = np.minimum(np.searchsorted(thresholds, values, side="left"), len(thresholds) - 1)
+    return thresholds[np.maximum(0, positions - offset)]
+
+
+def build_thresholds_df(
+    mean_salary_df: pd.DataFrame,
     low_salary_percentage: float = 0.4,
     threshold_offset: int = 2,
     high_salary_low_exp_threshold: int = 500000,
 ) -> pd.DataFrame:
-    df = load_mean_salary_comparison_df()
-    df = df[["country", "income_group", "country_avg_salary"]]
+    df = mean_salary_df[["country", "income_group", "country_avg_salary"]]
     df = df.append(dict(country="Other", country_avg_salary=3500), ignore_index=True)
     df = df.assign(
-        too_low_salary=(low_salary_percentage * df.country_avg_salary).apply(lambda x: get_threshold(x, threshold_offset)),
-        low_salary_high_exp=df.country_avg_salary.apply(lambda x: get_threshold(x, threshold_offset)),
+        too_low_salary=get_thresholds(low_salary_percentage * df.country_avg_salary, threshold_offset),
+        low_salary_high_exp=get_thresholds(df.country_avg_salary, threshold_offset),
         high_salary_low_exp=high_salary_low_exp_threshold,
     )
     return df
 
 
-@functools.lru_cache(maxsize=1)
-def load_udf() -> pd.DataFrame:
-    orig = load_orig_kaggle_df()
-
-    # The first row is the "questions". Not real data, so drop it.
-    df = orig.loc[1:].reset_index(drop=True)
-
-    # Rename columns to something more convenient
-    df = df.rename(columns=_KAGGLE_RENAMES)
-
-    # Cast duration to an integer
-    df = df.assign(duration=df.duration.apply(int))
-
-    # Align country names to the Official datasets' names
-    # There are two different choices for 'Korea' in Kaggle dataset.
-    # We assume that both choices refer to the country in the southern part of the Peninsula.
-    df.country = df.country.replace(
-        {
-            "United States of America": "USA",
-            "United Kingdom of Great Britain and Northern Ireland": "UK",
-            "Iran, Islamic Republic of...": "Iran",
-            "Republic of Korea": "Korea, Republic of",
-            "South Korea": "Korea, Republic of",
-        }
+@cached_frame(maxsize=8, depends_on=[load_mean_salary_comparison_df])
+def load_thresholds_df(
+    low_salary_percentage: float = 0.4,
+    threshold_offset: int = 2,
+    high_salary_low_exp_threshold: int = 500000,
+) -> pd.DataFrame:
+    df = build_thresholds_df(
+        mean_salary_df=load_mean_salary_comparison_df(),
+        low_salary_percentage=low_salary_percentage,
+        threshold_offset=threshold_offset,
+        high_salary_low_exp_threshold=high_salary_low_exp_threshold,
     )
+    return df
 
-    df.education = df.education.replace(
-        {
-            "Some college/university study without earning a bachelor’s degree": "Studies without a degree",
-            "No formal education past high school": "High school",
-            "I prefer not to answer": "No answer"
-        }
-    ).str.replace(" degree", "")
-
-    df.gender = df.gender.replace(
-        {
-            "Prefer to self-describe": "Self-describe",
-            "Prefer not to say": "No answer"
-        }
-    )
 
-    # Columns about experience have different ranges and different format.
-    # Modify format to be similar and DNRY
-    # This way, we minimize errors that may be caused by human typing,
-    # e.g. in the executive summary p. 10, machine learning experience class from 10-20 years is referenced as 10-15 years
-    df.code_exp = df.code_exp.replace({"< 1 years": "0-1", "I have never written code": "0"}).str.replace(" years", "")
-    df.ml_exp = df.ml_exp.replace(
-        {"Under 1 year": "0-1", "20 or more years": "20+", "I do not use machine learning methods": "0"}
-    ).str.replace(" years", "")
-    # Add code_level and ml_level columns
-    df = df.assign(
-        code_level=df.code_exp.map(CODE_EXP_LEVELS),
-        ml_level=df.ml_exp.map(ML_EXP_LEVELS),
-    )
+def build_udf(orig: pd.DataFrame, thresholds: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return the cleaned dataset.
 
-    # Refine Company employment size values
-    df.employees = (
-        df.employees.replace(
+    Only the demographic columns are transformed, therefore we work on a view of `orig` and collect the new columns
+    in a dict. The frame is assembled once at the end, i.e. the only full copy of the data is the final frame.
+    """
+    # The first row is the "questions". Not real data, so drop it.
+    with memory_stage("slice"):
+        rows = orig.iloc[1:]
+        # Rename columns to something more convenient
+        columns = {_KAGGLE_RENAMES.get(column, column): rows[column] for column in orig.columns}
+
+    with memory_stage("clean"):
+        # Cast duration to an integer
+        columns["duration"] = columns["duration"].astype(int)
+
+        # Align country names to the Official datasets' names
+        # There are two different choices for 'Korea' in Kaggle dataset.
+        # We assume that both choices refer to the country in the southern part of the Peninsula.
+        columns["country"] = columns["country"].replace(
             {
-                "10,000 or more employees": "10000+",
+                "United States of America": "USA",
+                "United Kingdom of Great Britain and Northern Ireland": "UK",
+                "Iran, Islamic Republic of...": "Iran",
+                "Republic of Korea": "Korea, Republic of",
+                "South Korea": "Korea, Republic of",
             }
         )
-        .str.replace(" employees", "")
-        .str.replace(",", "")
-    )
 
-    # Reformat salary bins by removing symbols and "," from salary ranges.
-    df.salary = df.salary.replace(
-        {
-            "$0-999": "0-999",
-            "> $500,000": "500,000-999,999",
-            "300,000-500,000": "300,000-499,999",
-        }
-    ).str.replace(",", "")
-
-    # create salary upper bound thresholds for comparison operations.
-    df = df.assign(salary_threshold=df.salary.map(SALARY_THRESHOLDS))
-    # convert spend_ds ranges to upper bounds (i.e. integers):
-    df.spend_ds = df.spend_ds.replace(
-        {
-            "$0 ($USD)": 0,
-            "$1-$99": 100,
-            "$100-$999": 1000,
-            "$1000-$9,999": 10000,
-            "$10,000-$99,999": 100000,
-            "$100,000 or more ($USD)": 1000000,
-        }
-    )
+        columns["education"] = columns["education"].replace(
+            {
+                "Some college/university study without earning a bachelor’s degree": "Studies without a degree",
+                "No formal education past high school": "High school",
+                "I prefer not to answer": "No answer"
+            }
+        ).str.replace(" degree", "")
+
+        columns["gender"] = columns["gender"].replace(
+            {
+                "Prefer to self-describe": "Self-describe",
+                "Prefer not to say": "No answer"
+            }
+        )
 
-    # Merge df with the threshold values and keep the same index
-    thresholds = load_thresholds_df()
-    df = pd.merge(df, thresholds, how="left", on="country")
+        # Columns about experience have different ranges and different format.
+        # Modify format to be similar and DNRY
+        # This way, we minimize errors that may be caused by human typing,
+        # e.g. in the executive summary p. 10, machine learning experience class from 10-20 years
+        # is referenced as 10-15 years
+        columns["code_exp"] = columns["code_exp"].replace(
+            {"< 1 years": "0-1", "I have never written code": "0"}
+        ).str.replace(" years", "")
+        columns["ml_exp"] = columns["ml_exp"].replace(
+            {"Under 1 year": "0-1", "20 or more years": "20+", "I do not use machine learning methods": "0"}
+        ).str.replace(" years", "")
+
+        # Refine Company employment size values
+        columns["employees"] = (
+            columns["employees"].replace(
+                {
+                    "10,000 or more employees": "10000+",
+                }
+            )
+            .str.replace(" employees", "")
+            .str.replace(",", "")
+        )
+
+        # Reformat salary bins by removing symbols and "," from salary ranges.
+        columns["salary"] = columns["salary"].replace(
+            {
+                "$0-999": "0-999",
+                "> $500,000": "500,000-999,999",
+                "300,000-500,000": "300,000-499,999",
+            }
+        ).str.replace(",", "")
+
+        # convert spend_ds ranges to upper bounds (i.e. integers):
+        columns["spend_ds"] = columns["spend_ds"].replace(
+            {
+                "$0 ($USD)": 0,
+                "$1-$99": 100,
+                "$100-$999": 1000,
+                "$1000-$9,999": 10000,
+                "$10,000-$99,999": 100000,
+                "$100,000 or more ($USD)": 1000000,
+            }
+        )
+
+        # Add code_level and ml_level columns
+        columns["code_level"] = columns["code_exp"].map(CODE_EXP_LEVELS)
+        columns["ml_level"] = columns["ml_exp"].map(ML_EXP_LEVELS)
+        # create salary upper bound thresholds for comparison operations.
+        columns["salary_threshold"] = columns["salary"].map(SALARY_THRESHOLDS)
+        # Rank the ordinal answers once, instead of comparing strings on every call
+        for name in ORDINAL_DOMAINS:
+            columns[name] = to_ordinal(columns[name], name)
+
+    # Add the threshold values of each country. A lookup per column instead of merging the whole frame.
+    with memory_stage("thresholds"):
+        if not thresholds.country.is_unique:
+            raise ValueError("The thresholds must have one row per country")
+        positions = pd.Index(thresholds.country).get_indexer(columns["country"])
+        for column in thresholds.columns.drop("country"):
+            values = thresholds[column].to_numpy()[positions]
+            if (positions < 0).any():
+                values = np.where(positions >= 0, values, np.nan)
+            columns[column] = pd.Series(values, index=rows.index)
+
+    # Fill a single pre-allocated block with the object columns and insert the (few) numeric ones.
+    # `pd.DataFrame(columns)` would allocate the block several times over while consolidating.
+    with memory_stage("assemble"):
+        object_columns = [name for (name, sr) in columns.items() if sr.dtype == object]
+        # pandas stores the columns as rows of the block
+        block = np.empty((len(object_columns), len(rows)), dtype=object)
+        for (i, name) in enumerate(object_columns):
+            block[i] = columns[name].to_numpy()
+        df = pd.DataFrame(block.T, columns=object_columns, copy=False)
+        for (position, (name, sr)) in enumerate(columns.items()):
+            if sr.dtype != object:
+                df.insert(position, name, sr.values)
     assert len(df) == 20036, f"The length of df is not 20036: {len(df)}"
     assert list(df.country.tail(3)) == list(orig.Q3.tail(3)), set(df.country.tail(3)) - set(orig.Q3.tail(3))
     assert df.country_avg_salary.isna().sum() == 0, "There are misspelled countries"
@@ -286,56 +401,130 @@ def load_udf() -> pd.DataFrame:
     return df
 
 
-def filter_df(df: pd.DataFrame, print_filters=False) -> pd.DataFrame:
+@cached_frame(maxsize=4, depends_on=[load_orig_kaggle_df, load_thresholds_df])
+def load_udf(preview: Optional[float] = None, seed: int = 0) -> pd.DataFrame:
+    """
+    Return the unfiltered dataset.
+
+    With `preview`, return a reproducible stratified sample (per country and role) of that fraction of the rows,
+    with `sample_weight` and `stratum_size` columns for the estimators of the `sampling` module.
+    """
+    if preview is not None:
+        df = get_stratified_sample(load_udf(), fraction=preview, seed=seed)
+        return df
+    df = build_udf(orig=load_orig_kaggle_df(), thresholds=load_thresholds_df())
+    return df
+
+
+def profile_udf_memory(max_peak_ratio: float = 2.0) -> pd.DataFrame:
+    """
+    Return the allocations (MB) of each stage of `build_udf()`.
+
+    Raise a `MemoryError` if the peak exceeds `max_peak_ratio` times the size of the resulting frame.
+    """
+    udf, stages = profile_memory(build_udf, orig=load_orig_kaggle_df(), thresholds=load_thresholds_df())
+    udf_mb = udf.memory_usage(index=True).sum() / 2 ** 20
+    peak_mb = stages.peak_mb.iloc[-1]
+    if peak_mb > max_peak_ratio * udf_mb:
+        target_mb = max_peak_ratio * udf_mb
+        raise MemoryError(f"The peak memory of build_udf() is {peak_mb:.1f} MB; the target is {target_mb:.1f} MB")
+    return stages
+
+
+FILTER_RULES = {
+    "too_young_for_experience": "Too young for experience",
+    "too_young_for_salary": "Too young for salary",
+    "too_low_salary": "Too low salary",
+    "low_salary_high_exp": "Too low salary high exp",
+    "high_salary_low_exp": "Too high salary low exp",
+    "only_answered_demographics": "Only answered demographics",
+    "duplicate": "Duplicate submissions",
+    "anomaly": "Anomalous answers",
+}
+
+
+def get_only_answered_demographics(df: Union[pd.DataFrame, Subset]) -> pd.Series:
     # Remove participants who only answered "demographic" questions
     # Q7 is the first non-demographic question
-    # We use the "original" dataframe instead of `df` because we add a bunch of extra
-    # columns in `df` (e.g. `salary_threshold`) and we would need to be updating
-    # the index on iloc each time a new column was added.
+    # We use the "original" dataframe instead of `df` because some of the non-demographic
+    # questions have been renamed in `df` (e.g. Q24 -> `salary`).
     orig = load_orig_kaggle_df()
-    temp_df = orig.iloc[1:, 7:].reset_index(drop=True)
-    only_answer_demographic = ((temp_df == "None") | temp_df.isnull()).all(axis=1)
+    schema = load_question_schema()
+    temp_df = orig.loc[1:, schema.get_columns(schema.get_question_ids(min_number=7))].reset_index(drop=True)
+    only_answer_demographic = ((temp_df == "None") | temp_df.isnull()).all(axis=1).reindex(df.index)
+    return only_answer_demographic
+
+
+def get_filter_conditions(
+    df: Union[pd.DataFrame, Subset],
+    remove_duplicates: bool = False,
+    rules: Optional[Sequence[str]] = None,
+    max_anomaly_score: Optional[float] = None,
+) -> Dict[str, pd.Series]:
+    """
+    Return the mask of the participants removed by each of the `rules` of `FILTER_RULES` (default: all of them).
+
+    The salary rules compare against the threshold columns of `df` (e.g. `too_low_salary`), i.e. replacing
+    these columns is enough to evaluate other thresholds. The "duplicate" rule is all False unless `remove_duplicates`
+    and the "anomaly" rule is all False unless `max_anomaly_score` (see `load_anomaly_scores_df()`).
+    """
+    rules = list(FILTER_RULES) if rules is None else list(rules)
+    unknown = set(rules) - set(FILTER_RULES)
+    if unknown:
+        raise ValueError(f"Unknown filter rules: {sorted(unknown)}")
     # Basic conditions
     low_exp_bins = ["0", "0-1", "1-2", np.nan]
-    is_low_exp = df.code_exp.isin(low_exp_bins) & (df.ml_exp.isin(low_exp_bins) | df.ml_exp.isna())
     high_exp_bins = ["10-20", "20+"]
-    is_high_exp = df.code_exp.isin(high_exp_bins) | df.ml_exp.isin(high_exp_bins)
-    is_too_low_salary = df.salary_threshold <= df.too_low_salary
-    # complex conditions
-    is_too_young_for_experience = (df.age <= "24") & ((df.code_exp == "20+") | (df.ml_exp == "20+"))
-    is_too_young_for_salary = (df.age <= "24") & (df.salary_threshold >= df.high_salary_low_exp)
-    is_low_salary_high_exp = is_high_exp & (df.salary_threshold < df.low_salary_high_exp)
-    is_high_salary_low_exp = is_low_exp & (df.salary_threshold >= df.high_salary_low_exp)
-    # Create dataframe
-    conditions = (
-        ~is_too_young_for_experience
-        & ~is_too_young_for_salary
-        & ~is_too_low_salary
-        & ~is_low_salary_high_exp
-        & ~is_high_salary_low_exp
-        & ~only_answer_demographic
-    )
+    conditions = {}
+    for rule in rules:
+        if rule == "too_young_for_experience":
+            mask = (df.age <= "22-24") & ((df.code_exp == "20+") | (df.ml_exp == "20+"))
+        elif rule == "too_young_for_salary":
+            mask = (df.age <= "22-24") & (df.salary_threshold >= df.high_salary_low_exp)
+        elif rule == "too_low_salary":
+            mask = df.salary_threshold <= df.too_low_salary
+        elif rule == "low_salary_high_exp":
+            is_high_exp = df.code_exp.isin(high_exp_bins) | df.ml_exp.isin(high_exp_bins)
+            mask = is_high_exp & (df.salary_threshold < df.low_salary_high_exp)
+        elif rule == "high_salary_low_exp":
+            is_low_exp = df.code_exp.isin(low_exp_bins) & (df.ml_exp.isin(low_exp_bins) | df.ml_exp.isna())
+            mask = is_low_exp & (df.salary_threshold >= df.high_salary_low_exp)
+        elif rule == "only_answered_demographics":
+            mask = get_only_answered_demographics(df)
+        elif rule == "duplicate" and remove_duplicates:
+            # Duplicate submissions. The first submission of each cluster is kept.
+            from .duplicates import load_duplicates_df
+
+            mask = load_duplicates_df().is_near_duplicate.reindex(df.index)
+        elif rule == "anomaly" and max_anomaly_score is not None:
+            from .anomaly import load_anomaly_scores_df
+
+            mask = load_anomaly_scores_df().anomaly_score.reindex(df.index) > max_anomaly_score
+        else:
+            mask = pd.Series(False, index=df.index)
+        conditions[rule] = mask
+    return conditions
+
+
+def filter_df(
+    df: Union[pd.DataFrame, Subset],
+    print_filters=False,
+    remove_duplicates: bool = False,
+    max_anomaly_score: Optional[float] = None,
+) -> Union[pd.DataFrame, Subset]:
+    """ Return the participants that pass all the filter rules; a `Subset` of the same frame if `df` is a `Subset` """
+    removed = get_filter_conditions(df, remove_duplicates=remove_duplicates, max_anomaly_score=max_anomaly_score)
+    conditions = ~functools.reduce(operator.or_, removed.values())
     # print summary
     if print_filters:
-        print(
-            textwrap.dedent(
-                f"""
-                Too young for experience   : {is_too_young_for_experience.sum()}
-                Too young for salary       : {is_too_young_for_salary.sum()}
-                Too low salary             : {is_too_low_salary.sum()}
-                Too low salary high exp    : {is_low_salary_high_exp.sum()}
-                Too high salary low exp    : {is_high_salary_low_exp.sum()}
-                Only answered demographics : {only_answer_demographic.sum()}
-                ---------------------------------
-                All conditions combined    : {len(df) - conditions.sum()}
-                """
-            )
-        )
+        lines = [f"{FILTER_RULES[rule]:<27}: {mask.sum()}" for (rule, mask) in removed.items()]
+        lines += ["-" * 33, f"{'All conditions combined':<27}: {len(df) - conditions.sum()}"]
+        print("\n" + "\n".join(lines) + "\n")
     df = df[conditions]
     return df
 
 
-def load_role_df(df: pd.DataFrame, role: str) -> pd.DataFrame:
+def load_role_df(df: Union[pd.DataFrame, Subset], role: str) -> Union[pd.DataFrame, Subset]:
     if role not in _KAGGLE_ROLES:
         raise ValueError(f"Unknown role: {role}")
     df = df[df.role == role]
@@ -343,7 +532,8 @@ def load_role_df(df: pd.DataFrame, role: str) -> pd.DataFrame:
 
 
 def keep_demo_cols(df: pd.DataFrame) -> pd.DataFrame:
-    columns_to_keep = [col for col in df.columns if not col.startswith("Q")]
+    question_columns = load_question_schema().column_index
+    columns_to_keep = [col for col in df.columns if col not in question_columns]
     df = df[columns_to_keep]
     return df
 
@@ -352,22 +542,39 @@ def fix_median_salary_thresholds(df: pd.DataFrame, column: str = "salary_thresho
     # Some countries, e.g. Russia, have an even number of participants,
     # Therefore the median is e.g. 22500 while we only have 20000 and 25000 in `SALARY_THRESHOLDS`
     # Therefore we round up these values to the next threshold
+    # The input is not modified; a new frame is returned
     nan_labels = ~df[column].isin(SALARY_THRESHOLDS.values())
     if nan_labels.any():
-        df.loc[nan_labels, column] = df.loc[nan_labels, column].apply(lambda v: get_threshold(v, offset=0))
+        fixed = df.loc[nan_labels, column].apply(lambda v: get_threshold(v, offset=0))
+        df = df.assign(**{column: df[column].mask(nan_labels, fixed)})
     return df
 
 
 def load_salary_medians_df(
-    dataset1: pd.DataFrame,
-    dataset2: pd.DataFrame,
+    dataset1: Union[pd.DataFrame, Subset],
+    dataset2: Union[pd.DataFrame, Subset],
     countries: List[str],
     label1: str = "Unfiltered",
     label2: str = "Filtered",
+    weights1: Optional[pd.Series] = None,
+    weights2: Optional[pd.Series] = None,
 ) -> pd.DataFrame:
+    """
+    Return the median salary per country of the two datasets.
+
+    If `weights1`/`weights2` are given (e.g. from `rake_weights()`), weighted medians are returned.
+    """
+    def get_medians(dataset: Union[pd.DataFrame, Subset], weights: Optional[pd.Series]) -> pd.Series:
+        dataset = as_subset(dataset)
+        # Only copy the columns of the aggregation
+        dataset = dataset[dataset.country.isin(countries)][["country", "salary_threshold"]]
+        if weights is not None:
+            return get_weighted_median(dataset, "salary_threshold", weights=weights, by="country")
+        return dataset.groupby("country").salary_threshold.median()
+
     df = pd.DataFrame({
-        label1: dataset1[dataset1.country.isin(countries)].groupby("country").salary_threshold.median(),
-        label2: dataset2[dataset2.country.isin(countries)].groupby("country").salary_threshold.median(),
+        label1: get_medians(dataset1, weights1),
+        label2: get_medians(dataset2, weights2),
     }).reset_index().reindex(columns=["country", label2, label1])
     df = stack_dataframe(df, key_column="country", values_column="salary_threshold", order=countries)
     df = fix_median_salary_thresholds(df, "salary_threshold")
@@ -386,15 +593,21 @@ def load_participants_per_country_df(original: pd.DataFrame, filtered: pd.DataFr
 
 
 def load_aggregate_per_XP_level_df(
-    dataset: pd.DataFrame,
+    dataset: Union[pd.DataFrame, Subset],
     column: str,
     income_group: Optional[str] = None,
     countries: Optional[str] = None,
-    no_participants: bool = False
+    no_participants: bool = False,
+    weights: Optional[pd.Series] = None,
+    confidence: Optional[float] = None,
 ) -> None:
     """
     Return median salary or no participants per XP level
 
+    If `confidence` is given (e.g. 0.95), the `lower` and `upper` columns hold the design-based confidence bounds,
+    i.e. zero-width on the full dataset (see `get_median_estimate()` and `get_value_count_errors()`).
+    For a preview, pass its `get_sample_weights()` as `weights`, so that the values are estimates too.
+
     ```
     # Choose XP level type
     kglib.load_median_salary_per_XP_level_df(uds, column="code_level", income_group="3")
@@ -407,12 +620,19 @@ def load_aggregate_per_XP_level_df(
     kglib.load_median_salary_per_XP_level_df(uds, column="ml_level", countries="USA")
     # Multiple countries
     kglib.load_median_salary_per_XP_level_df(uds, column="ml_level", countries=["USA", "India"])
+    # Weighted, e.g. with the weights of `rake_weights()`
+    kglib.load_median_salary_per_XP_level_df(uds, column="ml_level", income_group="3", weights=uds_weights)
+    # Confidence bounds of a preview
+    kglib.load_median_salary_per_XP_level_df(
+        pds, column="ml_level", income_group="3", weights=kglib.get_sample_weights(pds), confidence=0.95
+    )
     ```
     """
     if column not in ("code_level", "ml_level"):
         raise ValueError(f"column should be either <code_level> or <ml_level>, not: {column}")
     if not (countries or income_group):
         raise ValueError("You must specify at least one of <income_group> and <countries>")
+    dataset = as_subset(dataset)
     if income_group:
         variable = "income_group"
         if income_group == "all":
@@ -424,16 +644,38 @@ def load_aggregate_per_XP_level_df(
             countries = [countries]
         variable = "country"
         condition = (dataset.country.isin(countries))
-    dataset = dataset[~dataset.salary.isna() & condition]
+    # Only copy the columns of the aggregation
+    columns = [column, variable, "salary_threshold"]
+    if confidence is not None:
+        # The sampling design of the bounds
+        design_columns = [*STRATA, SAMPLE_WEIGHT, STRATUM_SIZE]
+        columns += [name for name in design_columns if name in dataset.columns and name not in columns]
+    dataset = dataset[~dataset.salary.isna() & condition][columns]
     gb = dataset.groupby([column, variable])
     if no_participants:
         values_column = "no_participants"
-        df = gb.size().reset_index()
+        if weights is not None:
+            df = weights.reindex(dataset.index).groupby([dataset[column], dataset[variable]]).sum().reset_index()
+        else:
+            df = gb.size().reset_index()
+        df.columns = [column, variable, values_column]
+        if confidence is not None:
+            # The groups are numbered in the order of the rows of `df`
+            se = get_value_count_errors(dataset, gb.ngroup()).reindex(np.arange(len(df))).to_numpy()
+            z = scipy.stats.norm.ppf(0.5 + confidence / 2)
+            df = df.assign(lower=df[values_column] - z * se, upper=df[values_column] + z * se)
     else:
         values_column = "salary_threshold"
-        df = gb.salary_threshold.median().reset_index()
-        df = fix_median_salary_thresholds(df, values_column)
-    df.columns = [column, "region", values_column]
+        if weights is not None:
+            df = get_weighted_median(dataset, "salary_threshold", weights=weights, by=[column, variable]).reset_index()
+        else:
+            df = gb.salary_threshold.median().reset_index()
+        if confidence is not None:
+            bounds = get_median_estimate(dataset, "salary_threshold", by=[column, variable], confidence=confidence)
+            df = df.merge(bounds.drop(columns="median"), on=[column, variable], how="left")
+        for fixed_column in [values_column] if confidence is None else [values_column, "lower", "upper"]:
+            df = fix_median_salary_thresholds(df, fixed_column)
+    df = df.rename(columns={variable: "region"})
     # Fix order according to what the user specified
     if countries:
         df = df.set_index([column, "region"]).reindex(countries, level=1).reset_index()
@@ -448,6 +690,8 @@ def load_median_salary_comparison_df(
     countries: Optional[Union[str, List[str]]] = None,
     label1: str = "filtered",
     label2: str = "unfiltered",
+    weights1: Optional[pd.Series] = None,
+    weights2: Optional[pd.Series] = None,
 ) -> pd.DataFrame:
     """
     ## Examples
@@ -459,8 +703,12 @@ def load_median_salary_comparison_df(
         )
     """
     assert column in ("code_level", "ml_level"), "column should be in {'code_level', 'ml_level'}, not: %s" % column
-    df1 = load_aggregate_per_XP_level_df(dataset=dataset1, column=column, income_group=income_group, countries=countries)
-    df2 = load_aggregate_per_XP_level_df(dataset=dataset2, column=column, income_group=income_group, countries=countries)
+    df1 = load_aggregate_per_XP_level_df(
+        dataset=dataset1, column=column, income_group=income_group, countries=countries, weights=weights1
+    )
+    df2 = load_aggregate_per_XP_level_df(
+        dataset=dataset2, column=column, income_group=income_group, countries=countries, weights=weights2
+    )
     df = pd.merge(df1, df2, on=[column, "region"])
     df = df.drop(columns="region")
     df.columns = [column, label1, label2]
@@ -469,13 +717,20 @@ def load_median_salary_comparison_df(
 
 
 def fix_age_bin_distribution(df: pd.DataFrame, rename_index: bool = True) -> pd.Series:
-    age_bins = df.age.value_counts(True).sort_index() * 100
-    value = age_bins.at["18-21"]
-    age_bins.at["18-21"] = value / 2
-    age_bins.at["22-24"] += value / 2
+    # The "18-21" bin is split uniformly between "18-19" and "20-24"
+    age_bins = get_value_counts(df.age, normalize=True).sort_index() * 100
+    adjusted = rebin_counts(age_bins, AGE_BINS, ADJUSTED_AGE_BINS)
+    adjusted.index = list(AGE_BINS)
+    adjusted = adjusted.reindex(age_bins.index).rename(age_bins.name)
     if rename_index:
-        age_bins = age_bins.rename(index={"18-21": "18-19", "22-24": "20-24"})
-    return age_bins
+        adjusted = adjusted.rename(index=dict(zip(AGE_BINS, ADJUSTED_AGE_BINS)))
+    return adjusted
+
+
+def get_salary_aggregate_distribution(dataset: pd.DataFrame) -> pd.Series:
+    """ Return the salary distribution (%) over the coarser `SALARY_AGGREGATE_SCHEME` bins """
+    distribution = get_value_counts(dataset.salary, normalize=True) * 100
+    return rebin_counts(distribution, SALARY_BINS, SALARY_AGGREGATE_SCHEME)
 
 
 def get_age_bin_distribution_comparison(
@@ -494,18 +749,15 @@ def get_age_bin_distribution_comparison(
     return df
 
 
-def calc_avg_age_distribution(df: pd.DataFrame, rename_index: bool = True) -> pd.Series:
-    df = df.groupby(["age"]).size()
-    df = df.reset_index(name="participants")
-    df = df.assign(years_per_bin = df.age.map(YEARS_PER_BIN))
-    df = df.assign(avg_participants = df.participants / df.years_per_bin)
-    df = df.drop(["participants", "years_per_bin"], axis=1).set_index("age")
-    series = pd.Series(df.avg_participants, index=df.index)
+def calc_avg_age_distribution(df: Union[pd.DataFrame, Subset], rename_index: bool = True) -> pd.Series:
+    participants = as_subset(df).materialize(["age"]).groupby("age", observed=True).size()
+    years_per_bin = participants.index.map(YEARS_PER_BIN).to_numpy(dtype=float)
+    series = (participants / years_per_bin).rename("avg_participants")
     return series
 
 
 def get_salary_distribution(dataset: pd.DataFrame, name: str = "") -> pd.DataFrame:
-    df = (dataset.salary.value_counts(True) * 100).round(2).reset_index()
+    df = (get_value_counts(dataset.salary, normalize=True) * 100).round(2).reset_index()
     df = df.rename(columns={"salary": name or "percentage", "index": "salary"})
-    df = df.sort_values("salary", key=natsort.natsort_key, ascending=False)
+    df = df.sort_values("salary", ascending=False)
     return df
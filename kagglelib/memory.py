@@ -0,0 +1,74 @@
+"""
+Per-stage memory measurements based on `tracemalloc`.
+
+Functions mark their stages with `memory_stage()`, which is a no-op unless they run under `profile_memory()`.
+
+```
+udf, stages = kglib.profile_memory(kglib.build_udf, kglib.load_orig_kaggle_df(), kglib.load_thresholds_df())
+stages  # allocated and peak MB per stage
+```
+"""
+import contextlib
+import contextvars
+import tracemalloc
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pandas as pd
+
+_MB = 2 ** 20
+
+_RECORDS: "contextvars.ContextVar[Optional[List[Dict[str, Any]]]]" = contextvars.ContextVar(
+    "memory_records", default=None
+)
+
+
+@contextlib.contextmanager
+def memory_stage(name: str) -> Iterator[None]:
+    records = _RECORDS.get()
+    if records is None or not tracemalloc.is_tracing():
+        yield
+        return
+    # `reset_peak()` is only available on python 3.9+; without it, the peak is the peak so far
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    first_nested = len(records)
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        # Nested stages reset the peak, so take theirs into account too
+        peak = max([peak] + [record["peak"] for record in records[first_nested:]])
+        records.append(
+            dict(stage=name, allocated_mb=(current - start) / _MB, peak_mb=(peak - start) / _MB, peak=peak)
+        )
+
+
+def profile_memory(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Tuple[Any, pd.DataFrame]:
+    """
+    Call `func` under `tracemalloc` and return its result together with the per-stage allocations.
+
+    The last row ("total") covers the whole call. The memory is relative to the memory in use before the call,
+    i.e. objects that already exist (e.g. cached frames) are not counted.
+    """
+    records: List[Dict[str, Any]] = []
+    token = _RECORDS.set(records)
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        with memory_stage("total"):
+            result = func(*args, **kwargs)
+    finally:
+        _RECORDS.reset(token)
+        if not was_tracing:
+            tracemalloc.stop()
+    df = pd.DataFrame(records, columns=["stage", "allocated_mb", "peak_mb"])
+    return result, df
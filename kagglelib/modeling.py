@@ -0,0 +1,313 @@
+"""
+Sparse design matrices and salary models.
+
+`get_design_matrix()` builds a scipy sparse design matrix straight from the encoded survey:
+
+- a single-choice column (e.g. "country", "age") becomes one indicator per answer that occurs in `df`;
+  the first of them is the reference level, unless `drop_first=False`
+- a numeric column (e.g. "duration") is used as it is
+- a multi-select question (e.g. "Q7") becomes one indicator per choice
+- an interaction ("role:Q7") is the row-wise product of the indicators of its terms
+
+Nothing is ever dense, so blocks of multi-select questions and their interactions stay cheap.
+The models are fitted per segment, in parallel:
+
+```
+kglib.fit_salary_models(fds, ["country", "role", "code_level", "Q7", "role:code_level"], by="income_group")
+kglib.fit_salary_models(fds, ["age", "code_exp", "education"], by="role", kind="ordinal", jobs=4)
+```
+"""
+import concurrent.futures
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import scipy.optimize
+import scipy.sparse
+import scipy.special
+import sklearn.linear_model
+
+from .cooccurrence import get_indicator_matrix
+from .cooccurrence import get_multi_select_columns
+from .kaggle import get_ordinal_codes
+from .kaggle import load_question_schema
+from .subset import Subset
+from .subset import as_subset
+
+MODEL_KINDS = ("linear", "ordinal")
+
+
+class DesignMatrix(NamedTuple):
+    matrix: scipy.sparse.csr_matrix
+    columns: List[str]
+    index: pd.Index
+    # The term of each column, e.g. "role:Q7"
+    terms: List[str]
+    # The reference level of each single-choice column, e.g. {"role": "Business Analyst"}
+    references: Dict[str, Any]
+
+
+TermMatrix = Tuple[scipy.sparse.csr_matrix, List[str], Optional[Any]]
+
+
+def _get_indicators(sr: pd.Series, drop_first: bool) -> TermMatrix:
+    """ One indicator per answer of a single-choice column; missing answers are all zeros """
+    if isinstance(sr.dtype, pd.CategoricalDtype):
+        codes, levels = sr.cat.codes.to_numpy(), list(sr.cat.categories)
+        # Keep the categories that occur, so that the reference level always does
+        present = np.unique(codes[codes >= 0])
+        codes = np.where(codes >= 0, np.searchsorted(present, codes), -1)
+        levels = [levels[code] for code in present]
+    else:
+        codes, levels = pd.factorize(sr, sort=True)
+        levels = list(levels)
+    reference = None
+    if drop_first and levels:
+        codes, reference, levels = codes - 1, levels[0], levels[1:]
+    rows = np.flatnonzero(codes >= 0)
+    matrix = scipy.sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, codes[rows])), shape=(len(sr), len(levels))
+    )
+    return matrix, [f"{sr.name}[{level}]" for level in levels], reference
+
+
+def _get_term_matrix(df: pd.DataFrame, term: str, drop_first: bool) -> TermMatrix:
+    if term in df.columns:
+        sr = df[term]
+        if sr.dtype.kind in "iufb":
+            values = sr.to_numpy(dtype=float)
+            return scipy.sparse.csr_matrix(np.nan_to_num(values)[:, None]), [term], None
+        return _get_indicators(sr, drop_first=drop_first)
+    if term not in load_question_schema().questions:
+        raise ValueError(f"Unknown term: {term}")
+    # Raises a ValueError if `term` is not a multi-select question
+    matrix, choices = get_indicator_matrix(df, term)
+    return matrix.tocsr().astype(float), [f"{question}[{choice}]" for (question, choice) in choices], None
+
+
+def get_row_products(a: scipy.sparse.csr_matrix, b: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    """
+    Return the row-wise Kronecker product of `a` and `b`, i.e. column `i * b.shape[1] + j` is `a[:, i] * b[:, j]`.
+
+    The non-zeros of each row are all the pairs of the non-zeros of `a` and `b` in that row.
+    """
+    a, b = a.tocsr(), b.tocsr()
+    a_counts, b_counts = np.diff(a.indptr), np.diff(b.indptr)
+    pairs = a_counts * b_counts
+    offsets = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+    b_repeated = np.repeat(b_counts, pairs)
+    a_positions = np.repeat(a.indptr[:-1], pairs) + offsets // np.maximum(b_repeated, 1)
+    b_positions = np.repeat(b.indptr[:-1], pairs) + offsets % np.maximum(b_repeated, 1)
+    matrix = scipy.sparse.csr_matrix(
+        (
+            a.data[a_positions] * b.data[b_positions],
+            a.indices[a_positions] * b.shape[1] + b.indices[b_positions],
+            np.concatenate([[0], np.cumsum(pairs)]),
+        ),
+        shape=(a.shape[0], a.shape[1] * b.shape[1]),
+    )
+    return matrix
+
+
+def get_design_matrix(
+    df: pd.DataFrame,
+    terms: Sequence[str],
+    intercept: bool = True,
+    drop_first: bool = True,
+    min_count: int = 1,
+) -> DesignMatrix:
+    """
+    Return the sparse design matrix of `terms` (see the module docstring), one row per respondent.
+
+    Columns with fewer than `min_count` non-zero rows are dropped, e.g. the interactions that never occur.
+    """
+    blocks = []
+    columns: List[str] = []
+    column_terms: List[str] = []
+    references: Dict[str, Any] = {}
+    if intercept:
+        blocks.append(scipy.sparse.csr_matrix(np.ones((len(df), 1))))
+        columns.append("intercept")
+        column_terms.append("intercept")
+    for term in terms:
+        matrix, names = None, None
+        for part in term.split(":"):
+            other, other_names, reference = _get_term_matrix(df, part, drop_first=drop_first)
+            if reference is not None:
+                references[part] = reference
+            if matrix is None:
+                matrix, names = other, other_names
+            else:
+                matrix = get_row_products(matrix, other)
+                names = [f"{name}:{other_name}" for name in names for other_name in other_names]
+        blocks.append(matrix)
+        columns.extend(names)
+        column_terms.extend([term] * len(names))
+    matrix = scipy.sparse.hstack(blocks, format="csr")
+    counts = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    keep = counts >= min_count
+    if intercept:
+        keep[0] = True
+    if not keep.all():
+        matrix = matrix[:, np.flatnonzero(keep)]
+        columns = [column for (column, kept) in zip(columns, keep) if kept]
+        column_terms = [term for (term, kept) in zip(column_terms, keep) if kept]
+    return DesignMatrix(matrix=matrix, columns=columns, index=df.index, terms=column_terms, references=references)
+
+
+def fit_linear_salary_model(x: scipy.sparse.csr_matrix, y: np.ndarray, alpha: float = 1.0) -> np.ndarray:
+    """ Return the ridge coefficients of the log salary; `x` contains the intercept """
+    model = sklearn.linear_model.Ridge(alpha=alpha, fit_intercept=False, solver="sparse_cg")
+    model.fit(x, np.log(y))
+    return model.coef_
+
+
+def _get_ordinal_loss(
+    params: np.ndarray,
+    x: scipy.sparse.csr_matrix,
+    y: np.ndarray,
+    num_levels: int,
+    alpha: float,
+) -> Tuple[float, np.ndarray]:
+    """ The penalized negative log-likelihood of the proportional odds model and its gradient """
+    num_features = x.shape[1]
+    beta, raw = params[:num_features], params[num_features:]
+    # The thresholds are increasing: the first one plus cumulative positive steps
+    steps = np.concatenate([[1.0], np.exp(raw[1:])])
+    thresholds = np.cumsum(np.concatenate([raw[:1], steps[1:]]))
+    bounds = np.concatenate([[-np.inf], thresholds, [np.inf]])
+    eta = x @ beta
+    upper, lower = bounds[y + 1] - eta, bounds[y] - eta
+    cdf_upper, cdf_lower = scipy.special.expit(upper), scipy.special.expit(lower)
+    probabilities = np.maximum(cdf_upper - cdf_lower, 1e-12)
+    pdf_upper, pdf_lower = cdf_upper * (1 - cdf_upper), cdf_lower * (1 - cdf_lower)
+    loss = -np.log(probabilities).sum() + alpha / 2 * beta @ beta
+    gradient_eta = (pdf_upper - pdf_lower) / probabilities
+    gradient_beta = x.T @ gradient_eta + alpha * beta
+    # d(loss)/d(threshold k): the rows whose upper bound is k, minus the ones whose lower bound is k
+    gradient_thresholds = -np.bincount(y, pdf_upper / probabilities, minlength=num_levels)[: num_levels - 1]
+    gradient_thresholds += np.bincount(y, pdf_lower / probabilities, minlength=num_levels)[1:]
+    # Back to the raw parameters: threshold j depends on the raw parameters 0..j
+    gradient_raw = np.cumsum(gradient_thresholds[::-1])[::-1] * steps
+    return loss, np.concatenate([gradient_beta, gradient_raw])
+
+
+def fit_ordinal_salary_model(
+    x: scipy.sparse.csr_matrix,
+    y: np.ndarray,
+    num_levels: int,
+    alpha: float = 1.0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit a proportional odds (ordered logit) model of the salary bins `y` (0..num_levels - 1).
+
+    `x` must not contain an intercept. Return the coefficients and the `num_levels - 1` thresholds.
+    """
+    params = np.zeros(x.shape[1] + num_levels - 1)
+    params[x.shape[1]] = -num_levels / 4
+    result = scipy.optimize.minimize(
+        _get_ordinal_loss, params, args=(x, y, num_levels, alpha), jac=True, method="L-BFGS-B"
+    )
+    beta, raw = result.x[: x.shape[1]], result.x[x.shape[1]:]
+    thresholds = np.cumsum(np.concatenate([raw[:1], np.exp(raw[1:])]))
+    return beta, thresholds
+
+
+def _fit_segment(
+    x: scipy.sparse.csr_matrix,
+    y: np.ndarray,
+    kind: str,
+    num_levels: int,
+    alpha: float,
+) -> np.ndarray:
+    if kind == "linear":
+        return fit_linear_salary_model(x, y, alpha=alpha)
+    beta, _ = fit_ordinal_salary_model(x, y, num_levels=num_levels, alpha=alpha)
+    return beta
+
+
+def _get_model_columns(df: Union[pd.DataFrame, Subset], terms: Sequence[str], by: List[str]) -> List[str]:
+    """ Return the columns that the models of `terms` read, so that a subset only copies those """
+    schema = load_question_schema()
+    columns = ["salary", "salary_threshold"] + by
+    for term in terms:
+        for part in term.split(":"):
+            if part in df.columns:
+                columns.append(part)
+            elif part in schema.questions and schema[part].type == "multi":
+                columns.extend(get_multi_select_columns(df, part))
+    return list(dict.fromkeys(columns))
+
+
+def fit_salary_models(
+    df: Union[pd.DataFrame, Subset],
+    terms: Sequence[str],
+    by: Optional[Union[str, List[str]]] = None,
+    kind: str = "linear",
+    alpha: float = 1.0,
+    min_count: int = 5,
+    jobs: int = 4,
+) -> pd.DataFrame:
+    """
+    Fit a salary model per segment of `by` (or a single one) and return the coefficients in long format.
+
+    - `kind` is "linear" (ridge regression of the log salary threshold) or "ordinal" (ordered logit of the bins).
+    - Respondents without a salary are left out; use `impute_df()` first to include them.
+    - The design matrix is built per segment, so the reference level of each single-choice column is the first
+      one that occurs in the segment (see the `reference` column). Columns with fewer than `min_count` non-zero
+      rows in a segment are not estimated there; their coefficient is NaN.
+    - The segments are fitted in parallel by `jobs` processes.
+    """
+    if kind not in MODEL_KINDS:
+        raise ValueError(f"kind should be one of <linear> or <ordinal>, not: {kind}")
+    by_columns = [] if by is None else [by] if isinstance(by, str) else list(by)
+    df = as_subset(df)
+    df = df.where(df.salary.notna().to_numpy()).materialize(_get_model_columns(df, terms, by_columns))
+    intercept = kind == "linear"
+    num_levels = len(df.salary.cat.categories) if isinstance(df.salary.dtype, pd.CategoricalDtype) else 0
+    y = df.salary_threshold.to_numpy(dtype=float) if kind == "linear" else get_ordinal_codes(df.salary).to_numpy()
+    if by is None:
+        segments = {"all": np.arange(len(df))}
+    else:
+        segments = {key: positions for (key, positions) in df.groupby(by, sort=True, observed=True).indices.items()}
+    designs = {
+        key: get_design_matrix(df.iloc[positions], terms, intercept=intercept, min_count=min_count)
+        for (key, positions) in segments.items()
+    }
+    tasks = {
+        key: (designs[key].matrix, y[positions], kind, num_levels, alpha) for (key, positions) in segments.items()
+    }
+    if jobs > 1 and len(tasks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+            futures = {key: executor.submit(_fit_segment, *args) for (key, args) in tasks.items()}
+            coefficients = {key: future.result() for (key, future) in futures.items()}
+    else:
+        coefficients = {key: _fit_segment(*args) for (key, args) in tasks.items()}
+    # The columns of all the segments, in the order of the design matrix of the whole dataset
+    design = get_design_matrix(df, terms, intercept=intercept)
+    frames = []
+    for (key, beta) in coefficients.items():
+        references = designs[key].references
+        frame = pd.DataFrame(
+            dict(
+                term=design.columns,
+                coefficient=pd.Series(beta, index=designs[key].columns).reindex(design.columns).to_numpy(),
+                reference=[
+                    ":".join(str(references[part]) for part in term.split(":") if part in references) or None
+                    for term in design.terms
+                ],
+                n=len(segments[key]),
+            )
+        )
+        frame.insert(0, "segment", [key] * len(frame))
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+    return df
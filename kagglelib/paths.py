@@ -3,3 +3,4 @@ import pathlib
 
 ROOT = pathlib.Path(__file__).parent.parent
 DATA = ROOT / "data"
+CACHE = ROOT / ".cache"
@@ -0,0 +1,289 @@
+"""
+Explicit pipeline graph of the datasets used in the analysis.
+
+Each stage declares the stages and the data files it depends on. The output of each stage is stored in
+`CACHE / "pipeline"` keyed by a content hash of its data files, its parameters, its code and the keys of its inputs.
+The code is the source file of the module that defines the function and of all the package modules that it imports,
+directly or not (including the imports inside functions). Therefore, modifying a single reference CSV only rebuilds
+the stages that depend on it, while editing e.g. `utils.py` rebuilds the stages whose module imports it, even if
+their function is defined in `kaggle.py` (and everything downstream). Editing e.g. `plots.py` rebuilds nothing.
+
+```
+python -m kagglelib build
+python -m kagglelib build udf --jobs 4
+```
+"""
+import ast
+import concurrent.futures
+import dataclasses
+import hashlib
+import importlib.util
+import json
+import pathlib
+import pickle
+import time
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+import pandas as pd
+
+from .kaggle import build_thresholds_df
+from .kaggle import build_udf
+from .kaggle import filter_df
+from .kaggle import get_salary_distribution
+from .kaggle import load_participants_per_country_df
+from .paths import CACHE
+from .paths import DATA
+from .third_party import build_mean_salary_comparison_df
+from .third_party import SURVEY_YEAR
+from .third_party import load_source_df
+from .utils import get_file_hash
+from .utils import multi_merge
+
+PIPELINE_CACHE = CACHE / "pipeline"
+PACKAGE_DIR = pathlib.Path(__file__).parent
+
+
+@dataclasses.dataclass(frozen=True)
+class Stage:
+    name: str
+    func: Callable[..., Any]
+    inputs: Tuple[str, ...] = ()
+    files: Tuple[str, ...] = ()
+    params: Tuple[Tuple[str, Any], ...] = ()
+
+
+def _read_orig_kaggle_df() -> pd.DataFrame:
+    return pd.read_csv(DATA / "kaggle_survey_2020_responses.csv", header=0, low_memory=False)
+
+
+def _build_salary_distributions_df(udf: pd.DataFrame, filtered: pd.DataFrame) -> pd.DataFrame:
+    df = multi_merge(
+        [get_salary_distribution(udf, name="Unfiltered"), get_salary_distribution(filtered, name="Filtered")],
+        on="salary",
+        how="outer",
+    )
+    return df
+
+
+_USD_EUR_FILE = "ecb_usd_euro_avg_exch_rate_filtered.csv"
+
+
+def _source_stage(name: str, source: str, *files: str) -> Stage:
+    # Bypass the in-process cache; the stage must read the files
+    return Stage(name, load_source_df.__wrapped__, files=files, params=(("name", source),))
+
+
+STAGES = [
+    Stage("orig", _read_orig_kaggle_df, files=("kaggle_survey_2020_responses.csv",)),
+    _source_stage("world_bank_groups", "world_bank_groups", "wb_country_income_groups.csv"),
+    _source_stage("eurostat", "eurostat", "eurostat_gross_earnings_euros_2019_filtered.csv", _USD_EUR_FILE),
+    _source_stage("eurostat_net", "eurostat_net", "eurostat_EARN_NT_NET.xlsx", _USD_EUR_FILE),
+    _source_stage("world_bank_gni_pc_atlas", "wb_gni_pc_atlas", "wb_gni_pc_atlas_filtered.csv"),
+    _source_stage("world_bank_gdp_pc", "wb_gdp_pc", "wb_gdp_pc_filtered.csv"),
+    _source_stage("oecd", "oecd_ppp", "oecd_ann_avg_wage_2019.csv"),
+    _source_stage("ilo", "ilo", "ilo_mean_nom_wage_usd.csv"),
+    _source_stage("numbeo", "numbeo", "numbeo.csv"),
+    Stage(
+        "mean_salary_comparison",
+        build_mean_salary_comparison_df,
+        inputs=(
+            "world_bank_groups",
+            "eurostat",
+            "world_bank_gni_pc_atlas",
+            "world_bank_gdp_pc",
+            "oecd",
+            "ilo",
+            "numbeo",
+        ),
+        params=(("survey_year", SURVEY_YEAR),),
+    ),
+    Stage(
+        "thresholds",
+        build_thresholds_df,
+        inputs=("mean_salary_comparison",),
+        params=(("low_salary_percentage", 0.4), ("threshold_offset", 2), ("high_salary_low_exp_threshold", 500000)),
+    ),
+    Stage("udf", build_udf, inputs=("orig", "thresholds")),
+    # `filter_df` reads the original dataset, therefore it depends on the original file, too.
+    Stage("filtered", filter_df, inputs=("udf",), files=("kaggle_survey_2020_responses.csv",)),
+    Stage("salary_distributions", _build_salary_distributions_df, inputs=("udf", "filtered")),
+    Stage(
+        "participants_per_country",
+        load_participants_per_country_df,
+        inputs=("udf", "filtered"),
+        params=(("min_no_participants", 1),),
+    ),
+]
+
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+def get_dependencies(targets: Optional[Sequence[str]] = None) -> List[str]:
+    """ Return the names of the `targets` and all of their upstream stages in topological order """
+    if targets is None:
+        targets = list(STAGES_BY_NAME)
+    ordered: List[str] = []
+
+    def visit(name: str) -> None:
+        if name not in STAGES_BY_NAME:
+            raise ValueError(f"Unknown stage: {name}")
+        if name in ordered:
+            return
+        for input_name in STAGES_BY_NAME[name].inputs:
+            visit(input_name)
+        ordered.append(name)
+
+    for target in targets:
+        visit(target)
+    return ordered
+
+
+def _get_module_path(module: str) -> pathlib.Path:
+    name = module[len(__package__) + 1 :] if module != __package__ else "__init__"
+    return PACKAGE_DIR / f"{name}.py"
+
+
+def get_package_imports() -> Dict[str, Set[str]]:
+    """ Return the package modules that each module of the package imports, including the imports inside functions """
+    modules = {f"{__package__}.{path.stem}": path for path in PACKAGE_DIR.glob("*.py") if path.stem != "__init__"}
+    modules[__package__] = PACKAGE_DIR / "__init__.py"
+    imports: Dict[str, Set[str]] = {}
+    for (module, path) in modules.items():
+        names = set()
+        for node in ast.walk(ast.parse(path.read_text(encoding="utf-8"))):
+            if isinstance(node, ast.ImportFrom):
+                base = importlib.util.resolve_name("." * node.level + (node.module or ""), __package__)
+                if node.module:
+                    names.add(base)
+                # `from . import x` imports the submodule `x`
+                names.update(f"{base}.{alias.name}" for alias in node.names)
+            elif isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+        imports[module] = names & set(modules) - {module}
+    return imports
+
+
+def get_code_hashes(module: str, imports: Optional[Dict[str, Set[str]]] = None) -> Dict[str, str]:
+    """ Return the hash of the source file of `module` and of the package modules it imports, directly or not """
+    imports = get_package_imports() if imports is None else imports
+    modules = set()
+    pending = [module]
+    while pending:
+        current = pending.pop()
+        if current not in modules:
+            modules.add(current)
+            pending.extend(imports.get(current, ()))
+    return {name: get_file_hash(_get_module_path(name)) for name in sorted(modules)}
+
+
+def get_stage_keys(targets: Optional[Sequence[str]] = None) -> Dict[str, str]:
+    keys: Dict[str, str] = {}
+    imports = get_package_imports()
+    for name in get_dependencies(targets):
+        stage = STAGES_BY_NAME[name]
+        description = {
+            "name": stage.name,
+            "func": f"{stage.func.__module__}.{stage.func.__qualname__}",
+            "code": get_code_hashes(stage.func.__module__, imports),
+            "params": [list(param) for param in stage.params],
+            "files": {filename: get_file_hash(DATA / filename) for filename in stage.files},
+            "inputs": {input_name: keys[input_name] for input_name in stage.inputs},
+        }
+        keys[name] = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+def get_stage_path(name: str, key: str) -> pathlib.Path:
+    return PIPELINE_CACHE / f"{name}-{key[:16]}.pkl"
+
+
+def _load_output(path: pathlib.Path) -> Any:
+    with open(path, "rb") as fd:
+        return pickle.load(fd)
+
+
+def _store_output(path: pathlib.Path, value: Any) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first, so that an interrupted build never leaves a corrupted output behind
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as fd:
+        pickle.dump(value, fd, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(path)
+
+
+def build(
+    targets: Optional[Sequence[str]] = None,
+    jobs: int = 4,
+    force: bool = False,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """
+    Build the `targets` (by default all the stages) and return a report of what was (re)built.
+
+    Independent stages run in parallel in a thread pool of `jobs` workers.
+    Stages whose output is already stored are not executed; their output is only read from disk
+    if some downstream stage needs to be rebuilt.
+    """
+    keys = get_stage_keys(targets)
+    paths = {name: get_stage_path(name, key) for (name, key) in keys.items()}
+    to_run = {name for name in keys if force or not paths[name].exists()}
+    results: Dict[str, Any] = {}
+    report: List[Dict[str, Any]] = [
+        dict(stage=name, status="cached", seconds=0.0, key=keys[name][:16]) for name in keys if name not in to_run
+    ]
+
+    def get_input(name: str) -> Any:
+        if name not in results:
+            results[name] = _load_output(paths[name])
+        return results[name]
+
+    def run(name: str) -> Tuple[str, Any, float]:
+        stage = STAGES_BY_NAME[name]
+        start = time.perf_counter()
+        args = [get_input(input_name) for input_name in stage.inputs]
+        value = stage.func(*args, **dict(stage.params))
+        _store_output(paths[name], value)
+        return name, value, time.perf_counter() - start
+
+    pending = [name for name in keys if name in to_run]
+    running: Dict[concurrent.futures.Future, str] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            ready = [
+                name for name in pending
+                if all(dep not in to_run or dep in results for dep in STAGES_BY_NAME[name].inputs)
+            ]
+            for name in ready:
+                pending.remove(name)
+                running[executor.submit(run, name)] = name
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                name, value, seconds = future.result()
+                results[name] = value
+                report.append(dict(stage=name, status="built", seconds=round(seconds, 3), key=keys[name][:16]))
+                if verbose:
+                    print(f"built  {name:<28} {seconds:8.3f}s")
+    order = {name: i for (i, name) in enumerate(keys)}
+    df = pd.DataFrame(report, columns=["stage", "status", "seconds", "key"])
+    df = df.sort_values("stage", key=lambda sr: sr.map(order)).reset_index(drop=True)
+    return df
+
+
+def load_stage_output(name: str, build_missing: bool = True) -> Any:
+    """ Return the stored output of stage `name`, building it (and its inputs) if necessary """
+    keys = get_stage_keys([name])
+    path = get_stage_path(name, keys[name])
+    if not path.exists():
+        if not build_missing:
+            raise FileNotFoundError(f"The output of stage <{name}> has not been built: {path}")
+        build([name])
+    return _load_output(path)
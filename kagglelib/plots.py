@@ -9,7 +9,6 @@ from typing import Union
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-import natsort
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -19,10 +18,14 @@ from importlib_metadata import version
 from matplotlib.transforms import Bbox
 
 from .paths import DATA
+from .render_cache import cached_figure
 from .kaggle import SALARY_THRESHOLDS
 from .kaggle import REVERSE_SALARY_THRESHOLDS
 from .kaggle import fix_age_bin_distribution
 from .kaggle import calc_avg_age_distribution
+from .utils import get_label_order
+from .utils import get_top_k_stacked
+from .utils import get_value_counts
 
 
 #PALETTE_USA_VS_ROW = [sns.desaturate("green", 0.75), "peru"]
@@ -51,11 +54,14 @@ MPL_RC = {
 sns.set_style("dark", {'axes.linewidth': 0.5})
 
 
-def check_df_is_stacked(df: pd.DataFrame) -> None:
+def check_df_is_stacked(df: pd.DataFrame, max_rows: Optional[int] = 50) -> None:
     if len(df.columns) < 3:
         raise ValueError(f"The stacked dataframes need at least 3 columns: {df.columns}")
-    if len(df) > 50:
-        raise ValueError(f"You probably don't want to create a Bar plot with 50+ bins: {len(df)}")
+    if max_rows is not None and len(df) > max_rows:
+        raise ValueError(
+            f"You probably don't want to create a Bar plot with {max_rows}+ bins: {len(df)}. "
+            "Use <top_k> and/or kind='heatmap'"
+        )
 
 
 def get_mpl_rc(rc: Dict[str, Any]) -> Dict[str, Any]:
@@ -169,6 +175,7 @@ def _set_bar_width(bar, width: float) -> None:
     bar.set_x(bar.get_x() + diff / 2)  # we recenter the bar
 
 
+@cached_figure
 def sns_plot_value_count_comparison(
     df: pd.DataFrame,
     width: Optional[float] = None,
@@ -186,12 +193,38 @@ def sns_plot_value_count_comparison(
     title_wrap_length: Optional[int] = None,
     palette: sns.palettes._ColorPalette = PALETTE_ORIGINAL_VS_FILTERED,
     annotation_mapping: Optional[Dict[Any, str]] = None,
+    top_k: Optional[int] = None,
+    top_k_by: str = "max",
+    kind: str = "bar",
+    max_annotations: int = 50,
 ) -> None:
+    """
+    Plot a stacked value count comparison (e.g. from `get_stacked_value_count_comparison()`).
+
+    For high-cardinality columns (e.g. countries):
+
+    - `top_k` keeps the `k` largest keys according to `top_k_by` and folds the rest into an "Other (n)" bar.
+    - `kind` is "bar", "heatmap" or "auto"; "auto" draws a heatmap if there are still more than 50 rows.
+    - Only plots with up to `max_annotations` bars are annotated.
+    """
     if orientation not in {"horizontal", "vertical", "h", "v"}:
         raise ValueError(f"Orientation must be one of {'horizontal', 'vertical'}, not: {orientation}")
+    if kind not in {"bar", "heatmap", "auto"}:
+        raise ValueError(f"kind must be one of {'bar', 'heatmap', 'auto'}, not: {kind}")
     if not ax:
         if not (width and height):
             raise ValueError("You must specify either an <ax> or both <width> and <height>")
+    if top_k:
+        df = get_top_k_stacked(df, k=top_k, by=top_k_by)
+        # The ranking is the order; natural sorting would mix "Other (n)" with the rest of the labels
+        order_by_labels = False
+    if kind == "auto":
+        kind = "heatmap" if len(df) > 50 else "bar"
+    if kind == "heatmap":
+        sns_plot_value_count_heatmap(
+            df, width=width, height=height, ax=ax, title=title, fmt=fmt, rc=rc, title_wrap_length=title_wrap_length,
+        )
+        return
     check_df_is_stacked(df)
     if fmt is None:
         fmt = "{:.1f}" if df.dtypes[-1] == 'float64' else "{:.0f}"
@@ -203,12 +236,12 @@ def sns_plot_value_count_comparison(
         x = df.columns[-1]
         y = df.columns[0]
         annotate_func = _annotate_horizontal_bar
-        order = natsort.natsorted(df[y].unique())
+        order = get_label_order(df[y])
     else:
         x = df.columns[0]
         y = df.columns[-1]
         annotate_func = _annotate_vertical_bar
-        order = natsort.natsorted(df[x].unique())
+        order = get_label_order(df[x])
     with sns.plotting_context("notebook", rc=get_mpl_rc(rc)):
         if ax is None:
             fig, ax = plt.subplots(figsize=(width, height))
@@ -242,12 +275,58 @@ def sns_plot_value_count_comparison(
         else:
             ax.legend(loc=legend_location, title="")
         ax.set_title(title)
+        annotate = len(ax.patches) <= max_annotations
         for bar in ax.patches:
-            annotate_func(bar=bar, ax=ax, fmt=fmt, annotation_mapping=annotation_mapping)
+            if annotate:
+                annotate_func(bar=bar, ax=ax, fmt=fmt, annotation_mapping=annotation_mapping)
             if bar_width:
                 _set_bar_width(bar, width=bar_width)
 
 
+def sns_plot_value_count_heatmap(
+    df: pd.DataFrame,
+    width: Optional[float] = None,
+    height: Optional[float] = None,
+    ax: Optional[mpl.axes.Axes] = None,
+    title: Optional[str] = None,
+    fmt: Optional[str] = None,
+    rc: Optional[Dict[str, Any]] = None,
+    title_wrap_length: Optional[int] = None,
+    max_annotations: int = 200,
+) -> None:
+    """ Plot a stacked dataframe as a (keys x sources) heatmap; a single image instead of one patch per bar """
+    if not ax:
+        if not (width and height):
+            raise ValueError("You must specify either an <ax> or both <width> and <height>")
+    check_df_is_stacked(df, max_rows=None)
+    key, source, value = df.columns[0], df.columns[1], df.columns[-1]
+    if title is None:
+        title = key
+    if title_wrap_length:
+        title = "\n".join(wrap(title, title_wrap_length))
+    wide = df.set_index([key, source])[value].unstack(source)
+    wide = wide.reindex(index=df[key].unique(), columns=df[source].unique())
+    if fmt is None:
+        fmt = "{:.1f}" if wide.dtypes.iloc[-1] == "float64" else "{:.0f}"
+    # Format the annotations ourselves, so that `fmt` can be any format string, e.g. "{:.0f}%"
+    annot = wide.applymap(lambda value: "" if pd.isna(value) else fmt.format(value))
+    with sns.plotting_context("notebook", rc=get_mpl_rc(rc)):
+        if ax is None:
+            fig, ax = plt.subplots(figsize=(width, height))
+        sns.heatmap(
+            wide,
+            ax=ax,
+            cmap=sns.cubehelix_palette(as_cmap=True, rot=-.25, light=.95),
+            annot=annot if wide.size <= max_annotations else False,
+            fmt="",
+            cbar=True,
+        )
+        ax.set_xlabel("")
+        ax.set_ylabel("")
+        ax.set_title(title)
+
+
+@cached_figure
 def sns_plot_participants_vs_median_salary(
     no_participants_df: pd.DataFrame,
     median_salary_df: pd.DataFrame,
@@ -284,6 +363,7 @@ def sns_plot_participants_vs_median_salary(
         plt.tight_layout()
 
 
+@cached_figure
 def sns_plot_salary_medians(
     df: pd.DataFrame, title: Optional[str] = None, rc: Optional[Dict[str, Any]] = None
 ) -> None:
@@ -342,6 +422,7 @@ def sns_plot_salary_medians(
             )
 
 
+@cached_figure
 def sns_plot_age_distribution(
     df: pd.DataFrame,
     width: float = 14,
@@ -355,7 +436,7 @@ def sns_plot_age_distribution(
 ) -> None:
     if title_wrap_length:
         title = "\n".join(wrap(title, title_wrap_length))
-    default_distribution = (df.age.value_counts(True) * 100).sort_index().round(2)
+    default_distribution = (get_value_counts(df.age, normalize=True) * 100).sort_index().round(2)
     proposed_distribution = fix_age_bin_distribution(df, rename_index=True)
     avg_bin_distribution = calc_avg_age_distribution(df, rename_index=True)
     with sns.plotting_context("notebook", rc=get_mpl_rc(rc)):
@@ -409,6 +490,7 @@ def sns_plot_age_distribution(
                 bar.set_color("darkcyan")
 
 
+@cached_figure
 def sns_plot_global_salary_distribution_comparison(
     df1: pd.DataFrame,
     df2: pd.DataFrame,
@@ -427,9 +509,9 @@ def sns_plot_global_salary_distribution_comparison(
 ) -> None:
     if title_wrap_length:
         title = "\n".join(wrap(title, title_wrap_length))
-    vc1 = (df1.salary.value_counts(True) * 100).round(2).sort_index().reset_index().rename(columns={"salary": "percentage", "index": "salary"})
-    vc2 = (df2.salary.value_counts(True) * 100).round(2).sort_index().reset_index().rename(columns={"salary": "percentage", "index": "salary"})
-    order = natsort.natsorted(vc1.salary.unique(), reverse=True)
+    vc1 = (get_value_counts(df1.salary, normalize=True) * 100).round(2).sort_index().reset_index().rename(columns={"salary": "percentage", "index": "salary"})
+    vc2 = (get_value_counts(df2.salary, normalize=True) * 100).round(2).sort_index().reset_index().rename(columns={"salary": "percentage", "index": "salary"})
+    order = get_label_order(vc1.salary, reverse=True)
 
     with sns.plotting_context("notebook", rc=get_mpl_rc(rc)):
         #with sns.axes_style("dark", {'axes.linewidth': 0.5}):
@@ -477,6 +559,7 @@ def sns_plot_global_salary_distribution_comparison(
             plt.tight_layout()
 
 
+@cached_figure
 def sns_plot_salary_pde_comparison_per_income_group(
     dataset: pd.DataFrame,
     width: float = 18,
@@ -534,6 +617,7 @@ def sns_plot_salary_pde_comparison_per_income_group(
         plt.tight_layout()
 
 
+@cached_figure
 def sns_plot_pde_comparison(
     series: Union[pd.Series, List[pd.Series]],
     width: float = 18,
@@ -572,6 +656,7 @@ def sns_plot_pde_comparison(
         plt.tight_layout()
 
 
+@cached_figure
 def sns_plot_salary_pde_comparison_per_role(
     dataset: pd.DataFrame,
     width: float = 18,
@@ -634,6 +719,7 @@ def sns_plot_salary_pde_comparison_per_role(
         plt.tight_layout()
 
 
+@cached_figure
 def sns_plot_salary_distribution_comparison(
     df: pd.DataFrame,
     width: float,
@@ -0,0 +1,118 @@
+"""
+Opt-in background loading of the survey and of the reference data.
+
+With `KAGGLELIB_PREFETCH=1` in the environment, importing `kagglelib` starts loading the survey
+and all the reference sources in background threads (the sources concurrently), followed by
+`load_thresholds_df()` and `load_udf()`. The loaders are single-flight (see `cached_frame`), so a foreground
+call only waits for whatever isn't loaded yet, e.g. `load_udf()` in the first cell of a notebook.
+
+```
+KAGGLELIB_PREFETCH=1 jupyter lab
+kglib.get_prefetch_timings()  # seconds per source
+```
+"""
+import concurrent.futures
+import os
+import threading
+import time
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import pandas as pd
+
+from .kaggle import load_orig_kaggle_df
+from .kaggle import load_thresholds_df
+from .kaggle import load_udf
+from .third_party import REFERENCE_SOURCES
+from .third_party import load_mean_salary_comparison_df
+from .third_party import load_source_df
+
+PREFETCH_ENV = "KAGGLELIB_PREFETCH"
+
+
+class Prefetch:
+    def __init__(self, max_workers: int = 8) -> None:
+        self.start = time.perf_counter()
+        self.timings: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self.futures: Dict[str, "concurrent.futures.Future[Any]"] = {}
+
+    def _run(self, task: str, func: Callable[..., Any], *args: Any) -> None:
+        started = time.perf_counter()
+        error = None
+        try:
+            func(*args)
+        except Exception as exc:
+            # The foreground call will retry and raise the error itself
+            error = f"{type(exc).__name__}: {exc}"
+        finished = time.perf_counter()
+        with self._lock:
+            self.timings.append(
+                dict(
+                    task=task,
+                    start=started - self.start,
+                    seconds=finished - started,
+                    thread=threading.current_thread().name,
+                    error=error,
+                )
+            )
+
+    def submit(self, task: str, func: Callable[..., Any], *args: Any) -> "concurrent.futures.Future[Any]":
+        future = self._executor.submit(self._run, task, func, *args)
+        self.futures[task] = future
+        return future
+
+    def _load_derived(self, sources: List["concurrent.futures.Future[Any]"]) -> None:
+        concurrent.futures.wait(sources)
+        self._run("load_mean_salary_comparison_df", load_mean_salary_comparison_df)
+        self._run("load_thresholds_df", load_thresholds_df)
+        self._run("load_udf", load_udf)
+
+    def run(self) -> "Prefetch":
+        self.submit("load_orig_kaggle_df", load_orig_kaggle_df)
+        sources = [self.submit(f"load_source_df({name})", load_source_df, name) for name in REFERENCE_SOURCES]
+        self.submit("derived", self._load_derived, sources)
+        self._executor.shutdown(wait=False)
+        return self
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures.values())
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        _, not_done = concurrent.futures.wait(list(self.futures.values()), timeout=timeout)
+        return not not_done
+
+    def get_timings_df(self) -> pd.DataFrame:
+        with self._lock:
+            records = list(self.timings)
+        df = pd.DataFrame(records, columns=["task", "start", "seconds", "thread", "error"])
+        return df
+
+
+_PREFETCH: Optional[Prefetch] = None
+
+
+def is_prefetch_enabled() -> bool:
+    return os.environ.get(PREFETCH_ENV, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def start_prefetch(max_workers: int = 8) -> Prefetch:
+    """ Start loading the survey and the reference data in the background; a no-op if it already started """
+    global _PREFETCH
+    if _PREFETCH is None:
+        _PREFETCH = Prefetch(max_workers=max_workers).run()
+    return _PREFETCH
+
+
+def get_prefetch_timings() -> pd.DataFrame:
+    """ Return the start (relative to the start of the prefetch) and the duration in seconds of each load """
+    if _PREFETCH is None:
+        raise ValueError(f"The prefetch has not started; set {PREFETCH_ENV}=1 or call start_prefetch()")
+    return _PREFETCH.get_timings_df()
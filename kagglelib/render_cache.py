@@ -0,0 +1,156 @@
+"""
+Figure-level render cache for the `sns_plot_*` functions.
+
+When enabled, each call is fingerprinted using the input DataFrames, the arguments, the matplotlib rc,
+the versions of the plotting libraries and the source file of the plot function (e.g. `plots.py`). On a hit, the stored image is displayed instead of
+re-rendering the figure. The cache directory is bounded by size; the least recently used images are evicted.
+
+```
+kglib.enable_render_cache(max_bytes=200 * 2 ** 20, fmt="svg")
+kglib.sns_plot_salary_pde_comparison_per_role(fds)  # rendered and stored
+kglib.sns_plot_salary_pde_comparison_per_role(fds)  # displayed from the cache
+```
+"""
+import functools
+import hashlib
+import inspect
+import os
+import pathlib
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from importlib_metadata import version
+
+from .paths import CACHE
+from .subset import Subset
+from .utils import get_file_hash
+
+RENDER_CACHE = CACHE / "figures"
+
+_SETTINGS: Dict[str, Any] = dict(enabled=False, max_bytes=500 * 2 ** 20, fmt="png", dpi=100)
+_LIBRARIES = ("matplotlib", "seaborn", "pandas", "numpy", "dsml_survey_20")
+
+
+def enable_render_cache(max_bytes: int = 500 * 2 ** 20, fmt: str = "png", dpi: int = 100) -> None:
+    if fmt not in ("png", "svg"):
+        raise ValueError(f"fmt should be either <png> or <svg>, not: {fmt}")
+    _SETTINGS.update(enabled=True, max_bytes=max_bytes, fmt=fmt, dpi=dpi)
+
+
+def disable_render_cache() -> None:
+    _SETTINGS.update(enabled=False)
+
+
+def clear_render_cache() -> None:
+    for path in RENDER_CACHE.glob("*"):
+        path.unlink()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_library_versions() -> str:
+    versions = []
+    for library in _LIBRARIES:
+        try:
+            versions.append(f"{library}={version(library)}")
+        except Exception:
+            versions.append(f"{library}=unknown")
+    return ",".join(versions)
+
+
+def _update_fingerprint(digest: "hashlib._Hash", value: Any) -> None:
+    if isinstance(value, pd.DataFrame):
+        digest.update(repr((list(value.columns), list(value.dtypes.astype(str)))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, pd.Series):
+        digest.update(repr((value.name, str(value.dtype))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, Subset):
+        # The base frame and the selected rows; its repr() would only be the row count
+        _update_fingerprint(digest, value.base)
+        _update_fingerprint(digest, value.positions)
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.dtype, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=repr):
+            digest.update(repr(key).encode())
+            _update_fingerprint(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}[{len(value)}]".encode())
+        for item in value:
+            _update_fingerprint(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+
+def get_figure_fingerprint(func: Callable[..., Any], *args: Any, **kwargs: Any) -> str:
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    digest = hashlib.sha256()
+    digest.update(f"{func.__module__}.{func.__qualname__}".encode())
+    # The package version is fixed, so editing the plot code must change the fingerprint by itself
+    digest.update(get_file_hash(pathlib.Path(inspect.getsourcefile(inspect.unwrap(func)))).encode())
+    digest.update(_get_library_versions().encode())
+    digest.update(repr(sorted((key, repr(value)) for (key, value) in mpl.rcParams.items())).encode())
+    _update_fingerprint(digest, dict(bound.arguments))
+    return digest.hexdigest()
+
+
+def _display_image(path: pathlib.Path) -> None:
+    from IPython.display import Image
+    from IPython.display import SVG
+    from IPython.display import display
+
+    display(SVG(filename=str(path)) if path.suffix == ".svg" else Image(filename=str(path)))
+
+
+def evict_render_cache(max_bytes: int) -> None:
+    """ Remove the least recently used images until the cache is smaller than `max_bytes` """
+    entries = sorted(((path.stat().st_mtime, path.stat().st_size, path) for path in RENDER_CACHE.glob("*.*")))
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, path) in entries:
+        if total <= max_bytes:
+            break
+        path.unlink()
+        total -= size
+
+
+def cached_figure(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorator for plotting functions that create their own figure.
+
+    Calls that draw on a user-provided `ax` are never cached, since they are part of a bigger figure.
+    """
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if not _SETTINGS["enabled"]:
+            return func(*args, **kwargs)
+        if inspect.signature(func).bind(*args, **kwargs).arguments.get("ax") is not None:
+            return func(*args, **kwargs)
+        key = get_figure_fingerprint(func, *args, **kwargs)
+        path = RENDER_CACHE / f"{func.__name__}-{key[:24]}.{_SETTINGS['fmt']}"
+        if path.exists():
+            # Touch the file so that the eviction is LRU and not FIFO
+            os.utime(path)
+            _display_image(path)
+            return None
+        existing_figures = set(plt.get_fignums())
+        result = func(*args, **kwargs)
+        new_figures = [number for number in plt.get_fignums() if number not in existing_figures]
+        if new_figures:
+            RENDER_CACHE.mkdir(parents=True, exist_ok=True)
+            figure = plt.figure(new_figures[-1])
+            tmp_path = path.with_name(f"tmp-{path.name}")
+            figure.savefig(tmp_path, format=_SETTINGS["fmt"], dpi=_SETTINGS["dpi"], bbox_inches="tight")
+            tmp_path.replace(path)
+            evict_render_cache(_SETTINGS["max_bytes"])
+        return result
+
+    return wrapper
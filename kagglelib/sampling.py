@@ -0,0 +1,261 @@
+"""
+Stratified preview samples and design-based error bounds.
+
+A preview is a reproducible stratified subsample (by default per country and role). Each row carries its
+`sample_weight` (N_h / n_h) and the size of its stratum, so the estimates of the full dataset and their
+standard errors can be computed from the preview alone. On the full dataset the same functions return the exact
+values with zero-width bounds, i.e. the final run uses the same code path.
+
+```
+pds = kglib.filter_df(kglib.load_udf(preview=0.1))
+kglib.get_share_estimates(pds, "role")
+kglib.get_median_estimate(pds, "salary_threshold", by="country")
+kglib.get_value_count_comparison(uds.gender, pds.gender, True, weights2=kglib.get_sample_weights(pds), design2=pds)
+kglib.load_aggregate_per_XP_level_df(
+    pds, column="code_level", income_group="3", weights=kglib.get_sample_weights(pds), confidence=0.95
+)
+```
+"""
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from .subset import Subset
+from .subset import as_subset
+from .utils import get_weighted_quantiles
+
+SAMPLE_WEIGHT = "sample_weight"
+STRATUM_SIZE = "stratum_size"
+STRATA = ("country", "role")
+
+
+def _get_strata_codes(df: Union[pd.DataFrame, Subset], strata: Sequence[str]) -> np.ndarray:
+    frame = as_subset(df).materialize(list(strata))
+    return frame.groupby(list(strata), sort=False, dropna=False, observed=True).ngroup().to_numpy()
+
+
+def get_stratified_sample(
+    df: Union[pd.DataFrame, Subset],
+    fraction: float,
+    strata: Sequence[str] = STRATA,
+    seed: int = 0,
+    min_per_stratum: int = 2,
+) -> pd.DataFrame:
+    """
+    Return a stratified random sample of `df` with `sample_weight` and `stratum_size` columns.
+
+    Each stratum keeps `fraction` of its rows, but at least `min_per_stratum` (or all of them if it is smaller).
+    The rows are selected with a single sort of random keys within the strata, i.e. there is no loop over strata.
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"fraction should be in (0, 1], not: {fraction}")
+    codes = _get_strata_codes(df, strata)
+    sizes = np.bincount(codes)
+    sample_sizes = np.minimum(sizes, np.maximum(min_per_stratum, np.round(fraction * sizes).astype(int)))
+    keys = np.random.default_rng(seed).random(len(df))
+    order = np.lexsort((keys, codes))
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    ranks = np.empty(len(df), dtype=np.int64)
+    ranks[order] = np.arange(len(df)) - starts[codes[order]]
+    keep = ranks < sample_sizes[codes]
+    kept_codes = codes[keep]
+    df = as_subset(df).where(keep).materialize().assign(
+        **{SAMPLE_WEIGHT: (sizes / sample_sizes)[kept_codes], STRATUM_SIZE: sizes[kept_codes]}
+    )
+    return df
+
+
+def get_sample_weights(df: pd.DataFrame) -> pd.Series:
+    """ Return the sampling weights of `df`; all ones if `df` is not a sample """
+    if SAMPLE_WEIGHT in df.columns:
+        return df[SAMPLE_WEIGHT]
+    return pd.Series(1.0, index=df.index, name=SAMPLE_WEIGHT)
+
+
+def _get_design(df: pd.DataFrame, strata: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Return the weights, the stratum of each row, and the population and sample size of each stratum """
+    weights = get_sample_weights(df).to_numpy(dtype=float)
+    codes = _get_strata_codes(df, strata)
+    if STRATUM_SIZE in df.columns:
+        population = np.zeros(codes.max() + 1 if len(codes) else 0)
+        population[codes] = df[STRATUM_SIZE].to_numpy(dtype=float)
+        # The design sample size, i.e. before any filtering of the sample
+        sample = np.zeros_like(population)
+        sample[codes] = np.round(population[codes] / weights)
+    else:
+        # Not a sample: every stratum is a census
+        population = np.bincount(codes).astype(float)
+        sample = population
+    return weights, codes, population, sample
+
+
+def _get_stratified_standard_errors(
+    sums: np.ndarray,
+    squares: np.ndarray,
+    population: np.ndarray,
+    sample: np.ndarray,
+) -> np.ndarray:
+    """ Return the standard errors from the (strata x estimators) sums and squared sums of the weighted residuals """
+    n = sample[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.where(n > 1, (squares - sums ** 2 / n) / (n - 1), 0)
+        fpc = np.where(population > 0, 1 - sample / population, 0)
+    total_variance = (fpc[:, None] * n * variance).sum(axis=0)
+    return np.sqrt(np.maximum(total_variance, 0))
+
+
+def _get_linearized_standard_errors(
+    residuals: np.ndarray,
+    weights: np.ndarray,
+    codes: np.ndarray,
+    population: np.ndarray,
+    sample: np.ndarray,
+) -> np.ndarray:
+    """
+    Return the standard errors of the weighted totals of the (rows x estimators) `residuals`.
+
+    The variance is the one of stratified sampling without replacement. Rows of the design that are not in `codes`
+    (e.g. filtered out) count as zeros, which is the usual domain estimation. Dividing the result by the total weight
+    of the domain gives the standard error of a ratio (e.g. a share) whose linearized residuals are `residuals`.
+    """
+    weighted = residuals * weights[:, None]
+    num_strata = len(population)
+    sums = np.stack([np.bincount(codes, column, minlength=num_strata) for column in weighted.T], axis=1)
+    squares = np.stack([np.bincount(codes, column ** 2, minlength=num_strata) for column in weighted.T], axis=1)
+    return _get_stratified_standard_errors(sums, squares, population, sample)
+
+
+def _get_grouped_standard_errors(
+    residuals: np.ndarray,
+    groups: np.ndarray,
+    num_groups: int,
+    weights: np.ndarray,
+    codes: np.ndarray,
+    population: np.ndarray,
+    sample: np.ndarray,
+) -> np.ndarray:
+    """
+    Like `_get_linearized_standard_errors()` with one estimator per group, when each row only has a residual
+    for its own group (e.g. a per group median). Rows with a negative group have none.
+
+    The (strata x groups) sums are a single `np.bincount()` of the combined codes, i.e. there is no loop
+    over the groups.
+    """
+    in_group = groups >= 0
+    cells = codes[in_group] * num_groups + groups[in_group]
+    weighted = residuals[in_group] * weights[in_group]
+    shape = (len(population), num_groups)
+    sums = np.bincount(cells, weighted, minlength=shape[0] * shape[1]).reshape(shape)
+    squares = np.bincount(cells, weighted ** 2, minlength=shape[0] * shape[1]).reshape(shape)
+    return _get_stratified_standard_errors(sums, squares, population, sample)
+
+
+def _get_z(confidence: float) -> float:
+    return scipy.stats.norm.ppf(0.5 + confidence / 2)
+
+
+def _get_value_count_estimates(
+    df: Union[pd.DataFrame, Subset],
+    values: pd.Series,
+    normalize: bool,
+    strata: Sequence[str],
+) -> Tuple[pd.Series, pd.Series]:
+    """ Return the estimated count (or share) of each value of `values` and its standard error """
+    weights, codes, population, sample = _get_design(df, strata)
+    value_codes, labels = pd.factorize(values.reindex(df.index), sort=True)
+    notna = value_codes >= 0
+    indicators = np.zeros((len(value_codes), len(labels)))
+    indicators[np.flatnonzero(notna), value_codes[notna]] = 1
+    estimates = weights @ indicators
+    if normalize:
+        total_weight = weights[notna].sum()
+        estimates = estimates / total_weight
+        residuals = np.where(notna[:, None], indicators - estimates, 0)
+        se = _get_linearized_standard_errors(residuals, weights, codes, population, sample) / total_weight
+    else:
+        se = _get_linearized_standard_errors(indicators, weights, codes, population, sample)
+    index = pd.Index(labels, name=values.name)
+    return pd.Series(estimates, index=index), pd.Series(se, index=index)
+
+
+def get_value_count_errors(
+    df: Union[pd.DataFrame, Subset],
+    values: pd.Series,
+    normalize: bool = False,
+    strata: Sequence[str] = STRATA,
+) -> pd.Series:
+    """
+    Return the standard error of the estimated count (or share, if `normalize`) of each value of `values`.
+
+    `values` is aligned on the index of `df`, e.g. one of its columns. All zeros if `df` is not a sample.
+    """
+    _, se = _get_value_count_estimates(df, values, normalize, strata)
+    return se
+
+
+def get_share_estimates(
+    df: Union[pd.DataFrame, Subset],
+    column: str,
+    strata: Sequence[str] = STRATA,
+    confidence: float = 0.95,
+) -> pd.DataFrame:
+    """ Return the estimated share (%) of each value of `column` with its standard error and confidence bounds """
+    shares, se = _get_value_count_estimates(df, df[column], True, strata)
+    labels, shares, se = shares.index, shares.to_numpy() * 100, se.to_numpy() * 100
+    z = _get_z(confidence)
+    result = pd.DataFrame(
+        {column: labels.astype(str), "share": shares, "se": se, "lower": shares - z * se, "upper": shares + z * se}
+    )
+    result = result.sort_values("share", ascending=False).reset_index(drop=True)
+    return result
+
+
+def get_median_estimate(
+    df: Union[pd.DataFrame, Subset],
+    column: str = "salary_threshold",
+    by: Optional[Union[str, List[str]]] = None,
+    strata: Sequence[str] = STRATA,
+    confidence: float = 0.95,
+) -> pd.DataFrame:
+    """
+    Return the estimated median of `column`, optionally per group, with Woodruff confidence bounds.
+
+    Woodruff's method maps the standard error of the estimated CDF at the median back to the value scale:
+    the bounds are the quantiles `0.5 -/+ z * se(F(median))`. All the groups are estimated at once, i.e. there is
+    no loop over the groups.
+    """
+    weights, codes, population, sample = _get_design(df, strata)
+    values = df[column].to_numpy(dtype=float)
+    if by is None:
+        groups = np.zeros(len(values), dtype=np.int64)
+        keys = pd.DataFrame(index=[0])
+    else:
+        by = [by] if isinstance(by, str) else list(by)
+        grouped = as_subset(df).materialize(by).groupby(by, sort=True, observed=True)
+        # The rows with a missing key are in no group
+        groups = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        keys = grouped.size().index.to_frame(index=False)
+    num_groups = len(keys)
+    groups = np.where(~np.isnan(values) & (weights > 0), groups, -1)
+    medians = get_weighted_quantiles(values, weights, 0.5, groups=groups, num_groups=num_groups)
+    in_group = groups >= 0
+    below = np.zeros(len(values))
+    below[in_group] = values[in_group] <= medians[groups[in_group]]
+    totals = np.bincount(groups[in_group], weights[in_group], minlength=num_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cdf = np.bincount(groups[in_group], (weights * below)[in_group], minlength=num_groups) / totals
+        residuals = below - cdf[np.maximum(groups, 0)]
+        se = _get_grouped_standard_errors(residuals, groups, num_groups, weights, codes, population, sample) / totals
+    z = _get_z(confidence)
+    bounds = {
+        name: get_weighted_quantiles(values, weights, 0.5 + sign * z * se, groups=groups, num_groups=num_groups)
+        for (name, sign) in (("lower", -1), ("upper", 1))
+    }
+    df = pd.concat([keys.reset_index(drop=True), pd.DataFrame(dict(median=medians, **bounds))], axis=1)
+    return df
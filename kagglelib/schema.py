@@ -0,0 +1,135 @@
+"""
+Parsed index of the survey questions.
+
+The header row of the Kaggle dataset holds the text of each column, e.g.
+
+    Q7_Part_1 -> "What programming languages do you use [...]? (Select all that apply) - Selected Choice - Python"
+
+The schema groups the columns per question id and records the type, the choices and the section of each
+question, so that lookups like "the columns of Q7" or "all the multi-select questions" are dictionary lookups.
+"""
+import collections
+import dataclasses
+import re
+
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+
+_COLUMN_PATTERN = re.compile(
+    r"^(?P<question>Q(?P<number>\d+)(?:_(?P<section>[AB]))?)(?P<part>_Part_\d+|_OTHER)?(?P<text>_TEXT)?$"
+)
+_SELECTED_CHOICE = " - Selected Choice"
+_TOKEN_PATTERN = re.compile(r"[a-z0-9+#]+")
+
+QUESTION_TYPES = ("single", "multi", "text")
+
+
+@dataclasses.dataclass(frozen=True)
+class Question:
+    id: str
+    number: int
+    type: str
+    text: str
+    columns: Tuple[str, ...]
+    choices: Tuple[str, ...] = ()
+    section: Optional[str] = None
+
+
+def _get_tokens(text: str) -> Set[str]:
+    return set(_TOKEN_PATTERN.findall(text.lower()))
+
+
+@dataclasses.dataclass(frozen=True)
+class QuestionSchema:
+    questions: Dict[str, Question]
+    column_index: Dict[str, str]
+    choice_index: Dict[str, str]
+    keyword_index: Dict[str, Tuple[str, ...]]
+
+    def __getitem__(self, question_id: str) -> Question:
+        try:
+            return self.questions[question_id]
+        except KeyError:
+            raise KeyError(f"Unknown question: {question_id}") from None
+
+    def get_columns(self, question_ids: Iterable[str]) -> List[str]:
+        return [column for question_id in question_ids for column in self[question_id].columns]
+
+    def get_question_ids(
+        self,
+        types: Optional[Sequence[str]] = None,
+        min_number: int = 0,
+        section: Optional[str] = None,
+    ) -> List[str]:
+        """ Return the ids of the questions of the given `types`, numbered at least `min_number` """
+        return [
+            question.id
+            for question in self.questions.values()
+            if (types is None or question.type in types)
+            and question.number >= min_number
+            and (section is None or question.section == section)
+        ]
+
+    def search(self, keywords: str) -> List[str]:
+        """ Return the ids of the questions whose text or choices contain all the `keywords` """
+        tokens = _get_tokens(keywords)
+        if not tokens:
+            return []
+        matches = set.intersection(*(set(self.keyword_index.get(token, ())) for token in tokens))
+        return [question_id for question_id in self.questions if question_id in matches]
+
+
+def build_question_schema(columns: Sequence[str], texts: Sequence[str]) -> QuestionSchema:
+    """ Build the schema from the column names and the question texts (i.e. the first row) of the Kaggle dataset """
+    grouped: Dict[str, List[Tuple[str, str, "re.Match[str]"]]] = collections.OrderedDict()
+    for (column, text) in zip(columns, texts):
+        match = _COLUMN_PATTERN.match(column)
+        if match is None:
+            continue
+        grouped.setdefault(match.group("question"), []).append((column, str(text), match))
+    questions = {}
+    choice_index = {}
+    for (question_id, entries) in grouped.items():
+        first_match = entries[0][2]
+        is_multi = any(match.group("part") for (_, _, match) in entries)
+        if is_multi:
+            question_type = "multi"
+        elif all(match.group("text") for (_, _, match) in entries):
+            question_type = "text"
+        else:
+            question_type = "single"
+        choices = []
+        for (column, text, match) in entries:
+            if is_multi and not match.group("text"):
+                choice = text.rsplit(" - ", 1)[-1].strip()
+                choices.append(choice)
+                choice_index[column] = choice
+        text = entries[0][1].split(_SELECTED_CHOICE)[0]
+        if is_multi and _SELECTED_CHOICE not in entries[0][1]:
+            text = text.rsplit(" - ", 1)[0]
+        questions[question_id] = Question(
+            id=question_id,
+            number=int(first_match.group("number")),
+            type=question_type,
+            text=text.strip(),
+            columns=tuple(column for (column, _, _) in entries),
+            choices=tuple(choices),
+            section=first_match.group("section"),
+        )
+    column_index = {column: question.id for question in questions.values() for column in question.columns}
+    keyword_index: Dict[str, List[str]] = collections.defaultdict(list)
+    for question in questions.values():
+        for token in sorted(_get_tokens(" ".join((question.text,) + question.choices))):
+            keyword_index[token].append(question.id)
+    schema = QuestionSchema(
+        questions=questions,
+        column_index=column_index,
+        choice_index=choice_index,
+        keyword_index={token: tuple(ids) for (token, ids) in keyword_index.items()},
+    )
+    return schema
@@ -0,0 +1,225 @@
+"""
+Local JSON query server for the survey aggregates.
+
+The unfiltered and the filtered datasets are loaded once and stay in memory.
+Identical concurrent requests share a single computation and the responses are kept in an LRU cache.
+
+```
+python -m kagglelib serve --port 8050
+curl "http://localhost:8050/value_counts?column=role&as_percentage=1"
+curl "http://localhost:8050/salary_medians?countries=USA,India"
+curl "http://localhost:8050/median_salary_comparison?column=ml_level&income_group=3"
+curl "http://localhost:8050/salary_distribution"
+curl "http://localhost:8050/participants"
+```
+"""
+import asyncio
+import collections
+import concurrent.futures
+import json
+import urllib.parse
+
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from .cache import get_cache_info_df
+from .kaggle import filter_df
+from .kaggle import get_salary_distribution
+from .kaggle import load_median_salary_comparison_df
+from .kaggle import load_participants_per_country_df
+from .kaggle import load_salary_medians_df
+from .kaggle import load_udf
+from .utils import get_value_count_comparison
+from .utils import multi_merge
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+QueryKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class QueryError(ValueError):
+    pass
+
+
+class UnknownEndpointError(LookupError):
+    pass
+
+
+def _get_list(params: Dict[str, str], name: str) -> Optional[List[str]]:
+    value = params.get(name)
+    return value.split(",") if value else None
+
+
+def _get_bool(params: Dict[str, str], name: str, default: bool) -> bool:
+    value = params.get(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "true", "yes")
+
+
+def _to_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    # NaN is not valid JSON
+    df = df.astype(object).where(pd.notnull(df), None)
+    return df.to_dict(orient="records")
+
+
+class SurveyQueryServer:
+    def __init__(self, cache_size: int = 256, workers: int = 4) -> None:
+        self.cache_size = cache_size
+        self.cache: "collections.OrderedDict[QueryKey, bytes]" = collections.OrderedDict()
+        self.in_flight: Dict[QueryKey, "asyncio.Future[bytes]"] = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.stats = collections.Counter()
+        self.udf: Optional[pd.DataFrame] = None
+        self.fds: Optional[pd.DataFrame] = None
+        self.endpoints: Dict[str, Callable[[Dict[str, str]], Any]] = {
+            "/value_counts": self.value_counts,
+            "/salary_medians": self.salary_medians,
+            "/median_salary_comparison": self.median_salary_comparison,
+            "/salary_distribution": self.salary_distribution,
+            "/participants": self.participants,
+            "/stats": self.get_stats,
+        }
+
+    def load(self) -> None:
+        self.udf = load_udf()
+        self.fds = filter_df(self.udf)
+
+    # Endpoints
+
+    def value_counts(self, params: Dict[str, str]) -> Any:
+        column = params.get("column")
+        if column not in self.udf.columns:
+            raise QueryError(f"Unknown column: {column}")
+        df = get_value_count_comparison(
+            self.udf[column], self.fds[column], as_percentage=_get_bool(params, "as_percentage", True),
+        )
+        return _to_records(df)
+
+    def salary_medians(self, params: Dict[str, str]) -> Any:
+        countries = _get_list(params, "countries")
+        if not countries:
+            raise QueryError("You must specify <countries>")
+        df = load_salary_medians_df(self.udf, self.fds, countries=countries)
+        return _to_records(df)
+
+    def median_salary_comparison(self, params: Dict[str, str]) -> Any:
+        column = params.get("column", "code_level")
+        if column not in ("code_level", "ml_level"):
+            raise QueryError(f"column should be either <code_level> or <ml_level>, not: {column}")
+        countries = _get_list(params, "countries")
+        income_group = params.get("income_group")
+        if not (countries or income_group):
+            raise QueryError("You must specify at least one of <income_group> and <countries>")
+        df = load_median_salary_comparison_df(
+            self.fds, self.udf, column=column, income_group=income_group, countries=countries
+        )
+        return _to_records(df)
+
+    def salary_distribution(self, params: Dict[str, str]) -> Any:
+        df = multi_merge(
+            [get_salary_distribution(self.udf, name="Unfiltered"), get_salary_distribution(self.fds, name="Filtered")],
+            on="salary",
+            how="outer",
+        )
+        return _to_records(df)
+
+    def participants(self, params: Dict[str, str]) -> Any:
+        min_no_participants = float(params.get("min_no_participants", 1))
+        df = load_participants_per_country_df(self.udf, self.fds, min_no_participants=min_no_participants)
+        return _to_records(df)
+
+    def get_stats(self, params: Dict[str, str]) -> Any:
+        stats = dict(self.stats, cached_responses=len(self.cache), in_flight=len(self.in_flight))
+        stats["loaders"] = _to_records(get_cache_info_df())
+        return stats
+
+    # Request handling
+
+    def _compute(self, path: str, params: Dict[str, str]) -> bytes:
+        result = self.endpoints[path](params)
+        return json.dumps(result, default=lambda o: o.item() if isinstance(o, np.generic) else str(o)).encode()
+
+    async def query(self, path: str, params: Dict[str, str]) -> bytes:
+        if path not in self.endpoints:
+            raise UnknownEndpointError(path)
+        if path == "/stats":
+            return self._compute(path, params)
+        key: QueryKey = (path, tuple(sorted(params.items())))
+        if key in self.cache:
+            self.stats["hits"] += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.in_flight:
+            # Somebody else is already computing the same thing; wait for their result
+            self.stats["merged"] += 1
+            return await asyncio.shield(self.in_flight[key])
+        self.stats["misses"] += 1
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.executor, self._compute, path, params)
+        self.in_flight[key] = future
+        try:
+            body = await future
+        finally:
+            del self.in_flight[key]
+        self.cache[key] = body
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return body
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            # Skip the headers; we don't need any of them
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            status, body = await self._respond(request_line)
+        except Exception as exc:  # keep the server alive
+            status, body = 500, json.dumps({"error": str(exc)}).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+        writer.close()
+
+    async def _respond(self, request_line: str) -> Tuple[int, bytes]:
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            return 400, json.dumps({"error": f"Malformed request: {request_line}"}).encode()
+        if method != "GET":
+            return 405, json.dumps({"error": f"Unsupported method: {method}"}).encode()
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            return 200, await self.query(url.path, params)
+        except UnknownEndpointError:
+            error = {"error": f"Unknown endpoint: {url.path}", "endpoints": list(self.endpoints)}
+            return 404, json.dumps(error).encode()
+        except (QueryError, ValueError) as exc:
+            return 400, json.dumps({"error": str(exc)}).encode()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8050) -> None:
+        loop = asyncio.get_event_loop()
+        # Load the data before accepting any connection
+        await loop.run_in_executor(self.executor, self.load)
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port} (endpoints: {', '.join(self.endpoints)})")
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(host: str = "127.0.0.1", port: int = 8050, cache_size: int = 256, workers: int = 4) -> None:
+    server = SurveyQueryServer(cache_size=cache_size, workers=workers)
+    asyncio.run(server.serve(host=host, port=port))
@@ -0,0 +1,146 @@
+"""
+Lazy subsets of the rows of a DataFrame.
+
+A `Subset` holds a base frame and a boolean mask of its rows. Filtering a subset only combines the masks,
+and the columns are only copied when they are accessed, i.e. chained segments don't copy the hundreds
+of columns of the survey that are never read.
+
+`Subset` supports the part of the DataFrame API that the filters use, i.e. `filter_df()`, `load_role_df()` and
+`get_complimentary_datasets()` return subsets when they are given one:
+
+```
+uds = kglib.Subset(kglib.load_udf())
+fds = kglib.filter_df(uds)
+ds = kglib.load_role_df(fds, "Data Scientist")
+ds[ds.country == "USA"][["age", "salary_threshold"]]  # Only these two columns are copied
+```
+"""
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+Mask = Union[pd.Series, pd.Index, np.ndarray]
+
+
+class Subset:
+    def __init__(self, base: pd.DataFrame, mask: Optional[Mask] = None) -> None:
+        if isinstance(base, Subset):
+            base, mask = base.base, (base._mask if mask is None else base._combine(mask))
+        elif mask is not None:
+            mask = Subset(base)._combine(mask)
+        self.base = base
+        # None means all the rows of `base`
+        self._mask: Optional[np.ndarray] = mask
+        self._positions: Optional[np.ndarray] = None
+        self._columns: Dict[str, pd.Series] = {}
+
+    @property
+    def positions(self) -> np.ndarray:
+        """ The positions of the rows in `base` """
+        if self._positions is None:
+            self._positions = np.arange(len(self.base)) if self._mask is None else np.flatnonzero(self._mask)
+        return self._positions
+
+    @property
+    def index(self) -> pd.Index:
+        return self.base.index if self._mask is None else self.base.index[self._mask]
+
+    @property
+    def columns(self) -> pd.Index:
+        return self.base.columns
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (len(self), len(self.base.columns))
+
+    @property
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    def __len__(self) -> int:
+        return len(self.base) if self._mask is None else int(self._mask.sum())
+
+    def __repr__(self) -> str:
+        return f"<Subset: {len(self)} of {len(self.base)} rows, {len(self.base.columns)} columns>"
+
+    def _combine(self, condition: Mask) -> np.ndarray:
+        """ Return the mask of `base` of the rows of this subset that satisfy `condition` """
+        if isinstance(condition, pd.Index):
+            selected = self.base.index.isin(condition)
+            return selected if self._mask is None else selected & self._mask
+        if isinstance(condition, pd.Series):
+            if not condition.index.equals(self.index):
+                # Align the labels; rows without a value are dropped
+                condition = condition.reindex(self.index)
+            condition = condition.fillna(False)
+        values = np.array(condition, dtype=bool)
+        if len(values) == len(self.base) and self._mask is None:
+            return values
+        if len(values) != len(self):
+            raise ValueError(f"The mask has {len(values)} rows; the subset has {len(self)} rows")
+        mask = np.zeros(len(self.base), dtype=bool)
+        mask[self.positions[values]] = True
+        return mask
+
+    def where(self, condition: Mask) -> "Subset":
+        """
+        Return the rows that satisfy `condition`.
+
+        `condition` is a boolean Series (aligned on the index), a boolean array with one value per row of the
+        subset, or an Index of the labels to keep.
+        """
+        return Subset(self.base, self._combine(condition))
+
+    def complement(self) -> "Subset":
+        """ Return the rows of `base` that are not in the subset """
+        mask = np.zeros(len(self.base), dtype=bool) if self._mask is None else ~self._mask
+        return Subset(self.base, mask)
+
+    def __and__(self, other: "Subset") -> "Subset":
+        if other.base is not self.base:
+            raise ValueError("Only subsets of the same frame can be combined")
+        if self._mask is None or other._mask is None:
+            return other if self._mask is None else self
+        return Subset(self.base, self._mask & other._mask)
+
+    def get_column(self, column: str) -> pd.Series:
+        if column not in self._columns:
+            sr = self.base[column]
+            self._columns[column] = sr if self._mask is None else sr.iloc[self.positions]
+        return self._columns[column]
+
+    def materialize(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """ Return the rows of the subset as a DataFrame, with only `columns` if given """
+        if columns is None:
+            if self._mask is None:
+                return self.base
+            return self.base.iloc[self.positions]
+        column_positions = self.base.columns.get_indexer(columns)
+        if (column_positions < 0).any():
+            raise KeyError(f"Unknown columns: {[c for (c, p) in zip(columns, column_positions) if p < 0]}")
+        if self._mask is None:
+            return self.base.iloc[:, column_positions]
+        return self.base.iloc[self.positions, column_positions]
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, str):
+            return self.get_column(key)
+        if isinstance(key, list) and all(isinstance(column, str) for column in key):
+            return self.materialize(key)
+        return self.where(key)
+
+    def __getattr__(self, name: str) -> pd.Series:
+        # Called for missing attributes only, e.g. `subset.salary`
+        if not name.startswith("_") and name != "base" and name in self.base.columns:
+            return self.get_column(name)
+        raise AttributeError(f"'Subset' object has no attribute '{name}'")
+
+
+def as_subset(df: Union[pd.DataFrame, Subset]) -> Subset:
+    return df if isinstance(df, Subset) else Subset(df)
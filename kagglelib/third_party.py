@@ -1,134 +1,433 @@
-import functools
+import dataclasses
+import hashlib
+import json
 
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
 from typing import Union
 
+import numpy as np
 import pandas as pd
 
+from .cache import cached_frame
+from .paths import CACHE
 from .paths import DATA
+from .utils import get_file_hash
 
+SOURCES_CACHE = CACHE / "sources"
 
-@functools.lru_cache(maxsize=1)
-def load_usd_eur_df() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "ecb_usd_euro_avg_exch_rate_filtered.csv",
+SURVEY_YEAR = 2020
+
+# The reference wages in order of preference
+REFERENCE_WAGE_SOURCES = ("eurostat", "wb_gni_pc_atlas", "wb_gdp_pc", "oecd_ppp", "ilo", "numbeo")
+
+_YEAR_SPAN = 10000
+
+
+@dataclasses.dataclass(frozen=True)
+class SourceSpec:
+    """
+    Declarative description of a reference dataset.
+
+    - `columns` are the names given to the columns selected by `usecols` (all columns if `usecols` is None).
+    - `multipliers` convert units, e.g. monthly to annual earnings.
+    - `currency` is the currency of the values; non USD values are converted using the rate of `year`.
+    - `year` is the reference year of the values; it is added as a column unless the file provides it.
+    - `transform` is an optional post-processing step for anything that does not fit the above.
+    """
+    name: str
+    filename: str
+    columns: Tuple[str, ...]
+    format: str = "csv"
+    usecols: Optional[Tuple[int, ...]] = None
+    index_col: Optional[str] = "country"
+    header: Optional[int] = 0
+    skiprows: Optional[int] = None
+    sheet_name: Optional[str] = None
+    multipliers: Tuple[Tuple[str, float], ...] = ()
+    currency: str = "USD"
+    year: Optional[int] = None
+    transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None
+
+
+def _fix_world_bank_groups(df: pd.DataFrame) -> pd.DataFrame:
+    df.income_group = df.income_group.str.replace(" income", "")
+    return df
+
+
+def _fix_eurostat_xlsx(df: pd.DataFrame) -> pd.DataFrame:
+    # The sheet ends with a few rows of footnotes and ":" denotes "not available"
+    df = df[df.index.notna()]
+    df = df.apply(pd.to_numeric, errors="coerce").dropna()
+    df = df.rename(
+        index={
+            "Germany (until 1990 former territory of the FRG)": "Germany",
+            "United Kingdom": "UK",
+            "United States": "USA",
+        }
+    )
+    return df
+
+
+REFERENCE_SOURCES: Dict[str, SourceSpec] = {}
+
+
+def register_source(spec: SourceSpec) -> SourceSpec:
+    if spec.format not in ("csv", "xlsx"):
+        raise ValueError(f"Unsupported format for source <{spec.name}>: {spec.format}")
+    REFERENCE_SOURCES[spec.name] = spec
+    return spec
+
+
+register_source(
+    SourceSpec(
+        name="usd_eur",
+        filename="ecb_usd_euro_avg_exch_rate_filtered.csv",
+        columns=("year", "rate"),
+        index_col="year",
         header=None,
         skiprows=5,
-        names=["year", "rate"],
-        index_col="year",
     )
+)
+register_source(
+    SourceSpec(
+        name="world_bank_groups",
+        filename="wb_country_income_groups.csv",
+        columns=("country", "income_group"),
+        transform=_fix_world_bank_groups,
+    )
+)
+register_source(
+    SourceSpec(
+        name="wb_gni_pc_atlas",
+        filename="wb_gni_pc_atlas_filtered.csv",
+        columns=("country", "wb_gni_pc_atlas"),
+        usecols=(0, 1),
+        year=2019,
+    )
+)
+register_source(
+    SourceSpec(
+        name="wb_gdp_pc",
+        filename="wb_gdp_pc_filtered.csv",
+        columns=("country", "wb_gdp_pc"),
+        usecols=(0, 1),
+        year=2019,
+    )
+)
+register_source(
+    SourceSpec(
+        name="eurostat",
+        filename="eurostat_gross_earnings_euros_2019_filtered.csv",
+        columns=("country", "eurostat"),
+        currency="EUR",
+        year=2019,
+    )
+)
+# Annual net earnings of a single person without children earning 100% of the average earning.
+register_source(
+    SourceSpec(
+        name="eurostat_net",
+        filename="eurostat_EARN_NT_NET.xlsx",
+        format="xlsx",
+        sheet_name="Sheet 12",
+        columns=("country", "eurostat_net"),
+        usecols=(0, 1),
+        header=None,
+        skiprows=11,
+        currency="EUR",
+        year=2019,
+        transform=_fix_eurostat_xlsx,
+    )
+)
+register_source(
+    SourceSpec(
+        name="oecd_ppp",
+        filename="oecd_ann_avg_wage_2019.csv",
+        columns=("country", "oecd_ppp"),
+        year=2019,
+    )
+)
+register_source(
+    SourceSpec(
+        name="numbeo",
+        filename="numbeo.csv",
+        columns=("country", "numbeo"),
+        multipliers=(("numbeo", 12),),
+        year=2020,
+    )
+)
+register_source(
+    SourceSpec(
+        name="ilo",
+        filename="ilo_mean_nom_wage_usd.csv",
+        columns=("country", "year", "ilo"),
+        usecols=(0, 5, 6),
+        multipliers=(("ilo", 12),),
+    )
+)
+
+
+def _get_read_kwargs(spec: SourceSpec) -> Dict[str, Any]:
+    kwargs: Dict[str, Any] = dict(header=spec.header, names=list(spec.columns))
+    if spec.usecols is not None:
+        kwargs.update(usecols=list(spec.usecols))
+    if spec.skiprows is not None:
+        kwargs.update(skiprows=spec.skiprows)
+    if spec.format == "xlsx":
+        kwargs.update(sheet_name=spec.sheet_name or 0)
+    return kwargs
+
+
+def read_source_df(spec: SourceSpec) -> pd.DataFrame:
+    """
+    Return the raw columns of a reference dataset.
+
+    Parsing XLSX files is slow, so they are only parsed once. The parsed columns are stored in
+    `SOURCES_CACHE` keyed by the hash of the file and of the read arguments.
+    """
+    path = DATA / spec.filename
+    kwargs = _get_read_kwargs(spec)
+    if spec.format == "csv":
+        return pd.read_csv(path, **kwargs)
+    key = hashlib.sha256(json.dumps([get_file_hash(path), kwargs], sort_keys=True).encode()).hexdigest()
+    cache_path = SOURCES_CACHE / f"{spec.name}-{key[:16]}.pkl"
+    if cache_path.exists():
+        return pd.read_pickle(cache_path)
+    df = pd.read_excel(path, **kwargs)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_pickle(cache_path)
     return df
 
 
-@functools.lru_cache(maxsize=1)
-def get_usd_eur_rate(year: int) -> Union[int, str, float]:
-    df = load_usd_eur_df()
-    rate = df.at[year, "rate"]
+@cached_frame(maxsize=None)
+def load_source_df(name: str) -> pd.DataFrame:
+    if name not in REFERENCE_SOURCES:
+        raise ValueError(f"Unknown reference source: {name}")
+    spec = REFERENCE_SOURCES[name]
+    df = read_source_df(spec)
+    if spec.index_col:
+        df = df.set_index(spec.index_col)
+    if spec.transform:
+        df = spec.transform(df)
+    if spec.multipliers:
+        df = df.assign(**{column: df[column] * multiplier for (column, multiplier) in spec.multipliers})
+    if spec.year is not None and "year" not in df.columns:
+        df = df.assign(year=spec.year)
+    if spec.currency != "USD":
+        rates = get_fx_rates(spec.currency, df.year.to_numpy())
+        df = df.assign(**{column: df[column] * rates for column in df.columns if column != "year"})
+    return df
+
+
+def load_usd_eur_df() -> pd.DataFrame:
+    return load_source_df("usd_eur")
+
+
+@cached_frame(maxsize=1, depends_on=[load_source_df])
+def load_fx_rates_df() -> pd.DataFrame:
+    """ Return the USD value of one unit of each currency, indexed by (currency, year) """
+    usd_eur = load_usd_eur_df()
+    df = pd.DataFrame({
+        "currency": "EUR",
+        "year": usd_eur.index.astype(int),
+        "usd_per_unit": usd_eur.rate.to_numpy(dtype=float),
+    })
+    df = df.set_index(["currency", "year"]).sort_index()
+    return df
+
+
+def get_fx_rates(
+    currencies: Union[str, Sequence[str], np.ndarray],
+    years: Union[int, Sequence[int], np.ndarray],
+) -> np.ndarray:
+    """
+    Return the USD value of one unit of `currencies` for each of the `years`.
+
+    Both arguments are broadcast against each other, so a whole column can be converted
+    with a single lookup, e.g. `get_fx_rates("EUR", df.year)`.
+    """
+    currencies, years = np.broadcast_arrays(np.asarray(currencies, dtype=object), np.asarray(years))
+    fx = load_fx_rates_df()
+    keys = pd.MultiIndex.from_arrays([currencies.ravel(), years.ravel().astype(int)])
+    positions = fx.index.get_indexer(keys)
+    rates = np.where(positions >= 0, fx.usd_per_unit.to_numpy()[positions], np.nan)
+    rates[currencies.ravel() == "USD"] = 1.0
+    if np.isnan(rates).any():
+        missing = sorted(set(keys[np.isnan(rates)]))
+        raise KeyError(f"Missing exchange rates for: {missing}")
+    return rates.reshape(currencies.shape)
+
+
+def get_usd_eur_rate(year: int) -> float:
+    rate = get_fx_rates("EUR", year).item()
     return rate
 
 
-@functools.lru_cache(maxsize=1)
 def load_world_bank_groups() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "wb_country_income_groups.csv",
-        header=0,
-        names=["country", "income_group"],
-        index_col="country",
-    )
-    df.income_group = df.income_group.str.replace(" income", "")
-    return df
+    return load_source_df("world_bank_groups")
 
 
-@functools.lru_cache(maxsize=1)
 def load_world_bank_gni_pc_atlas() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "wb_gni_pc_atlas_filtered.csv",
-        usecols = [0, 1],
-        header=0,
-        names=["country", "wb_gni_pc_atlas"],
-        index_col="country",
-    )
-    df = df.assign(year=2019)
-    return df
+    return load_source_df("wb_gni_pc_atlas")
 
 
-
-@functools.lru_cache(maxsize=1)
 def load_world_bank_gdp_pc() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "wb_gdp_pc_filtered.csv",
-        usecols = [0, 1],
-        header=0,
-        names=["country", "wb_gdp_pc"],
-        index_col="country",
-    )
-    df = df.assign(year=2019)
-    return df
+    return load_source_df("wb_gdp_pc")
 
 
-@functools.lru_cache(maxsize=1)
 def load_eurostat_df() -> pd.DataFrame:
-    usd_eur = get_usd_eur_rate(2019)
-    df = pd.read_csv(
-        DATA / "eurostat_gross_earnings_euros_2019_filtered.csv",
-        header=0,
-        names=["country", "eurostat"],
-        index_col="country",
-    )
-    df = df.assign(year=2019, eurostat=df.eurostat * usd_eur)
-    return df
+    return load_source_df("eurostat")
+
+
+def load_eurostat_net_df() -> pd.DataFrame:
+    return load_source_df("eurostat_net")
 
 
-@functools.lru_cache(maxsize=1)
 def load_oecd_df() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "oecd_ann_avg_wage_2019.csv",
-        header=0,
-        names=["country", "oecd_ppp"],
-        index_col="country",
-    )
-    df = df.assign(year=2019)
-    return df
+    return load_source_df("oecd_ppp")
 
 
-@functools.lru_cache(maxsize=1)
 def load_numbeo_df() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "numbeo.csv",
-        header=0,
-        names=["country", "numbeo"],
-        index_col="country",
-    )
-    df.numbeo = df.numbeo * 12
-    df = df.assign(year=2020)
+    return load_source_df("numbeo")
+
+
+def load_ilo_df(survey_year: int = SURVEY_YEAR) -> pd.DataFrame:
+    """ Return the latest ILO observation of each country that is not newer than `survey_year` """
+    df = load_source_df("ilo")
+    df = df[df.year <= survey_year].sort_values("year", kind="mergesort").groupby(level="country").tail(1)
     return df
 
 
-@functools.lru_cache(maxsize=1)
-def load_ilo_df() -> pd.DataFrame:
-    df = pd.read_csv(
-        DATA / "ilo_mean_nom_wage_usd.csv",
-        header=0,
-        usecols=[0, 5, 6],
-        names=["country", "year", "monthly"],
-    )
-    df = df.groupby("country").tail(1)
-    df = df.assign(ilo=df.monthly * 12)
-    df = df.drop(columns="monthly")
-    df = df.set_index("country")
+def build_reference_wages_panel_df(sources: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Return the reference wages in long format, i.e. one row per country, year and source.
+
+    `sources` maps the source name to a frame indexed by country, with a `year` column
+    and a value column named after the source.
+    """
+    frames = []
+    for (name, df) in sources.items():
+        frame = pd.DataFrame({
+            "country": df.index,
+            "year": df.year.to_numpy(),
+            "source": name,
+            "value": df[name].to_numpy(),
+        })
+        frames.append(frame)
+    panel = pd.concat(frames, ignore_index=True)
+    panel = panel.dropna(subset=["value"])
+    panel = panel.astype({"year": int})
+    # Sources may report the same year twice; keep the last one, like the original files do.
+    panel = panel.drop_duplicates(subset=["country", "source", "year"], keep="last").reset_index(drop=True)
+    return panel
+
+
+def load_reference_wages_panel_df() -> pd.DataFrame:
+    sources = {name: load_source_df(name) for name in REFERENCE_WAGE_SOURCES}
+    return build_reference_wages_panel_df(sources)
+
+
+def asof_join_reference_wages(
+    panel: pd.DataFrame,
+    countries: Sequence[str],
+    years: Union[int, Sequence[int]],
+    priority: Sequence[str] = REFERENCE_WAGE_SOURCES,
+) -> pd.DataFrame:
+    """
+    Return the reference wage of each (country, year) query.
+
+    For each query, we pick the closest observation that is not newer than the query year,
+    from the source with the highest priority that has such an observation.
+
+    The lookups are vectorized: the panel is sorted on a composite `(country, source, year)` integer key
+    and every query/source combination is resolved with a single `searchsorted()` call.
+    """
+    countries = np.asarray(countries, dtype=object)
+    years = np.broadcast_to(np.asarray(years, dtype=np.int64), countries.shape)
+    priority = np.asarray(priority, dtype=object)
+    panel = panel[panel.source.isin(priority)]
+    country_index = pd.Index(pd.unique(np.concatenate([panel.country.to_numpy(dtype=object), countries])))
+    num_sources = len(priority)
+    # Offset the years so that they always fit in `_YEAR_SPAN`
+    min_year = min(panel.year.min(), years.min()) if len(panel) else 0
+    panel_groups = country_index.get_indexer(panel.country) * num_sources + pd.Index(priority).get_indexer(panel.source)
+    panel_keys = panel_groups * _YEAR_SPAN + (panel.year.to_numpy() - min_year)
+    order = np.argsort(panel_keys, kind="mergesort")
+    # Append a sentinel, so that every position returned by `searchsorted()` is valid
+    panel_keys = np.append(panel_keys[order], -1)
+    panel_years = np.append(panel.year.to_numpy(dtype=float)[order], np.nan)
+    panel_values = np.append(panel.value.to_numpy(dtype=float)[order], np.nan)
+    # (queries x sources) matrices
+    query_groups = country_index.get_indexer(countries)[:, None] * num_sources + np.arange(num_sources)[None, :]
+    query_keys = query_groups * _YEAR_SPAN + (years[:, None] - min_year)
+    positions = np.searchsorted(panel_keys[:-1], query_keys, side="right") - 1
+    found = (positions >= 0) & (panel_keys[positions] // _YEAR_SPAN == query_groups)
+    positions = np.where(found, positions, -1)
+    # The first source, in order of priority, that has an observation
+    best = np.argmax(found, axis=1)
+    rows = np.arange(len(countries))
+    has_value = found[rows, best]
+    best_positions = positions[rows, best]
+    df = pd.DataFrame({
+        "country": countries,
+        "survey_year": years,
+        "source": np.where(has_value, priority[best], None),
+        "year": panel_years[best_positions],
+        "value": panel_values[best_positions],
+    })
     return df
 
 
-@functools.lru_cache(maxsize=1)
-def load_mean_salary_comparison_df():
-    income_group = load_world_bank_groups()
-    eurostat = load_eurostat_df()
-    wb_gni_pc_atlas = load_world_bank_gni_pc_atlas()
-    wb_gdp_pc = load_world_bank_gdp_pc()
-    oecd_ppp = load_oecd_df()
-    ilo = load_ilo_df()
-    numbeo = load_numbeo_df()
+def build_mean_salary_comparison_df(
+    income_group: pd.DataFrame,
+    eurostat: pd.DataFrame,
+    wb_gni_pc_atlas: pd.DataFrame,
+    wb_gdp_pc: pd.DataFrame,
+    oecd_ppp: pd.DataFrame,
+    ilo: pd.DataFrame,
+    numbeo: pd.DataFrame,
+    survey_year: int = SURVEY_YEAR,
+) -> pd.DataFrame:
+    sources = dict(
+        eurostat=eurostat,
+        wb_gni_pc_atlas=wb_gni_pc_atlas,
+        wb_gdp_pc=wb_gdp_pc,
+        oecd_ppp=oecd_ppp,
+        ilo=ilo,
+        numbeo=numbeo,
+    )
+    panel = build_reference_wages_panel_df(sources)
+    # The wide columns are kept for comparison purposes. For sources with multiple years (i.e. ILO)
+    # we show the latest observation that is not newer than the survey.
+    latest = asof_join_reference_wages(panel, panel.country.unique(), survey_year, priority=("ilo",))
+    ilo = latest.dropna(subset=["value"]).set_index("country").rename(columns={"value": "ilo"})
     df = pd.concat([income_group.income_group, eurostat.eurostat, wb_gni_pc_atlas.wb_gni_pc_atlas, wb_gdp_pc.wb_gdp_pc, oecd_ppp.oecd_ppp, ilo.ilo, numbeo.numbeo], axis="columns")
     df.index.name = "country"
-    df = df.assign(country_avg_salary=df.bfill(axis=1).iloc[:, 1])
+    avg_salary = asof_join_reference_wages(panel, df.index, survey_year, priority=REFERENCE_WAGE_SOURCES)
+    df = df.assign(
+        country_avg_salary=avg_salary.value.to_numpy(),
+        country_avg_salary_source=avg_salary.source.to_numpy(),
+        country_avg_salary_year=avg_salary.year.to_numpy(),
+    )
     df = df.reset_index(drop=False)
     return df
+
+
+@cached_frame(maxsize=4, depends_on=[load_source_df])
+def load_mean_salary_comparison_df(survey_year: int = SURVEY_YEAR):
+    df = build_mean_salary_comparison_df(
+        income_group=load_world_bank_groups(),
+        eurostat=load_eurostat_df(),
+        wb_gni_pc_atlas=load_world_bank_gni_pc_atlas(),
+        wb_gdp_pc=load_world_bank_gdp_pc(),
+        oecd_ppp=load_oecd_df(),
+        ilo=load_source_df("ilo"),
+        numbeo=load_numbeo_df(),
+        survey_year=survey_year,
+    )
+    return df
@@ -1,11 +1,123 @@
+import hashlib
+import pathlib
+
 from functools import reduce
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
+import natsort
+import numpy as np
 import pandas as pd
 
+from .subset import Subset
+from .subset import as_subset
+
+# The suffix of the standard error columns of `get_value_count_comparison()`
+SE_SUFFIX = " (se)"
+
+
+def get_value_counts(sr: pd.Series, normalize: bool = False, weights: Optional[pd.Series] = None) -> pd.Series:
+    """ Like `sr.value_counts()` but, if `weights` is given, sums up the weights instead of counting rows """
+    if weights is None:
+        vc = sr.value_counts(normalize)
+        # Categorical value counts include the categories that don't appear in `sr`
+        if isinstance(sr.dtype, pd.CategoricalDtype):
+            vc = vc[vc > 0]
+        return vc
+    vc = weights.groupby(sr, observed=True).sum().sort_values(ascending=False)
+    if normalize:
+        vc = vc / vc.sum()
+    return vc
+
+
+def get_label_order(labels: Union[pd.Series, pd.Index, np.ndarray], reverse: bool = False) -> List[Any]:
+    """
+    Return the unique labels in their natural order.
+
+    For ordered categoricals this is the order of the categories, i.e. no sorting is necessary.
+    """
+    if not isinstance(labels, (pd.Series, pd.Index)):
+        labels = pd.Series(labels)
+    if isinstance(labels.dtype, pd.CategoricalDtype) and labels.dtype.ordered:
+        present = set(labels.dropna().unique())
+        order = [label for label in labels.dtype.categories if label in present]
+    else:
+        order = natsort.natsorted(labels.dropna().unique())
+    return order[::-1] if reverse else order
+
+
+def get_weighted_quantiles(
+    values: np.ndarray,
+    weights: np.ndarray,
+    quantiles: Union[float, np.ndarray],
+    groups: Optional[np.ndarray] = None,
+    num_groups: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Return the weighted `quantiles` of `values`, one per group (`groups` are codes from 0 to `num_groups` - 1).
+
+    The quantile is the first value whose cumulative weight reaches that share of the total weight of its group.
+    If it reaches it exactly, the quantile is the midpoint of that value and the next one, i.e. with equal weights
+    the median is the usual one. NaN values, non-positive weights and negative codes are ignored; empty groups
+    get NaN. The groups are resolved with a single sort, i.e. there is no loop over the groups.
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    groups = np.zeros(len(values), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    if num_groups is None:
+        num_groups = int(groups.max()) + 1 if len(groups) else 1
+    valid = ~np.isnan(values) & (weights > 0) & (groups >= 0)
+    order = np.lexsort((values[valid], groups[valid]))
+    values, weights, groups = values[valid][order], weights[valid][order], groups[valid][order]
+    counts = np.bincount(groups, minlength=num_groups)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    cumulative = np.cumsum(weights)
+    offsets = np.concatenate([[0.0], cumulative])[starts]
+    totals = np.bincount(groups, weights, minlength=num_groups)
+    targets = offsets + np.clip(quantiles, 0, 1) * totals
+    # Tolerate the rounding errors of the cumulative sums
+    tolerance = 1e-9 * np.maximum(totals, 1)
+    positions = np.searchsorted(cumulative, targets - tolerance, side="left")
+    positions = np.clip(positions, starts, np.maximum(ends - 1, starts))
+    result = np.full(num_groups, np.nan)
+    filled = counts > 0
+    positions, ends = positions[filled], ends[filled]
+    following = np.minimum(positions + 1, ends - 1)
+    exact = np.abs(cumulative[positions] - targets[filled]) <= tolerance[filled]
+    result[filled] = np.where(exact, (values[positions] + values[following]) / 2, values[positions])
+    return result
+
+
+def get_weighted_median(
+    df: Union[pd.DataFrame, Subset],
+    column: str,
+    weights: pd.Series,
+    by: Optional[Union[str, List[str]]] = None,
+) -> Union[float, pd.Series]:
+    """
+    Return the weighted median of `column`, optionally per group; see `get_weighted_quantiles()`.
+
+    `weights` is aligned on the index of `df`; rows without a weight are left out.
+    With equal weights the result is the same as the one of `median()`.
+    """
+    dataset = as_subset(df)
+    values = dataset.get_column(column).to_numpy(dtype=float)
+    weight_values = weights.reindex(dataset.index).to_numpy(dtype=float)
+    if by is None:
+        return get_weighted_quantiles(values, weight_values, 0.5)[0]
+    keys = [by] if isinstance(by, str) else list(by)
+    grouped = dataset.materialize(keys).groupby(keys, sort=True, observed=True)
+    index = grouped.size().index
+    # The rows with a missing key are in no group
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    medians = get_weighted_quantiles(values, weight_values, 0.5, groups=codes, num_groups=len(index))
+    return pd.Series(medians, index=index, name=column)
+
 
 def get_value_count_df(
     df1: pd.DataFrame,
@@ -13,11 +125,13 @@ def get_value_count_df(
     column: str,
     perc: bool = True,
     label1: str = "Unfiltered",
-    label2: str = "Filtered"
+    label2: str = "Filtered",
+    weights1: Optional[pd.Series] = None,
+    weights2: Optional[pd.Series] = None,
 ):
     multiplier = 100 if perc else 1
-    vc1 = df1[column].value_counts(perc) * multiplier
-    vc2 = df2[column].value_counts(perc) * multiplier
+    vc1 = get_value_counts(df1[column], perc, weights1) * multiplier
+    vc2 = get_value_counts(df2[column], perc, weights2) * multiplier
     df = pd.DataFrame(
         {
             label1: (vc1.sort_index()).round(2),
@@ -45,17 +159,33 @@ def get_value_count_comparison(
     label1: str = "Unfiltered",
     label2: str = "Filtered",
     order: Optional[List[str]] = None,
+    weights1: Optional[pd.Series] = None,
+    weights2: Optional[pd.Series] = None,
+    design1: Optional[Union[pd.DataFrame, Subset]] = None,
+    design2: Optional[Union[pd.DataFrame, Subset]] = None,
 ):
+    """
+    Return the value counts (or percentages) of `sr1` and `sr2` side by side, with their relative difference.
+
+    `design1` and `design2` are opt-in: the frames that `sr1` and `sr2` come from, e.g. a preview of
+    `get_stratified_sample()`. For each one given, a `<label> (se)` column holds the design-based standard error
+    of the counts (or percentages); see `get_value_count_errors()`.
+    """
+    # sampling imports utils
+    from .sampling import get_value_count_errors
+
     multiplier = 100 if as_percentage else 1
-    vc1 = sr1.value_counts(as_percentage) * multiplier
-    vc2 = sr2.value_counts(as_percentage) * multiplier
-    df = pd.DataFrame(
-        {
-            label1: vc1.sort_index(),
-            label2: vc2.sort_index(),
-            "rel diff (%)": (vc2 - vc1) / vc1 * 100,
-        }
-    )
+    vc1 = get_value_counts(sr1, as_percentage, weights1) * multiplier
+    vc2 = get_value_counts(sr2, as_percentage, weights2) * multiplier
+    columns = {
+        label1: vc1.sort_index(),
+        label2: vc2.sort_index(),
+        "rel diff (%)": (vc2 - vc1) / vc1 * 100,
+    }
+    for (label, sr, design) in ((label1, sr1, design1), (label2, sr2, design2)):
+        if design is not None:
+            columns[f"{label}{SE_SUFFIX}"] = get_value_count_errors(design, sr, normalize=as_percentage) * multiplier
+    df = pd.DataFrame(columns)
     if as_percentage:
         df = df.round(2)
     if order:
@@ -67,6 +197,7 @@ def get_value_count_comparison(
 def stack_value_count_comparison(df: pd.DataFrame, stack_label: str):
     column: str = df.columns[0]
     df = df.drop(columns=["% diff", "rel diff (%)"], errors="ignore")
+    df = df.drop(columns=[name for name in df.columns if str(name).endswith(SE_SUFFIX)])
     df = df.set_index(column).stack().reset_index()
     df.columns = [column, "source", stack_label]
     return df
@@ -94,6 +225,42 @@ def stack_dataframe(
     return df
 
 
+def get_top_k_stacked(
+    df: pd.DataFrame,
+    k: int,
+    by: str = "max",
+    other_label: str = "Other",
+) -> pd.DataFrame:
+    """
+    Keep the top-`k` keys of a stacked dataframe and fold the rest into a single "Other (n)" key.
+
+    - `df` is stacked, i.e. its columns are `key`, `source` and `value` (e.g. `get_stacked_value_count_comparison()`).
+    - `by` is the measure used to rank the keys: either "max" or "sum" over the sources, or the name of a source.
+    - The values of the folded keys are summed per source, so this makes sense for counts and percentages.
+
+    The keys are selected with a partial sort. The result is ordered by the measure, with "Other (n)" last.
+    """
+    key, source, value = df.columns[0], df.columns[1], df.columns[-1]
+    wide = df.groupby([key, source])[value].sum(min_count=1).unstack(source).reindex(columns=df[source].unique())
+    if by in ("max", "sum"):
+        scores = getattr(wide, by)(axis=1)
+    elif by in wide.columns:
+        scores = wide[by]
+    else:
+        raise ValueError(f"by should be <max>, <sum> or one of {list(wide.columns)}, not: {by}")
+    if len(wide) <= k:
+        return df
+    scores = scores.fillna(-np.inf).to_numpy()
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="mergesort")]
+    rest = np.setdiff1d(np.arange(len(wide)), top)
+    top_df = wide.iloc[top]
+    other_df = wide.iloc[rest].sum(axis=0).to_frame(f"{other_label} ({len(rest)})").T
+    wide = pd.concat([top_df, other_df]).rename_axis(index=key, columns=source)
+    df = wide.stack(dropna=False).rename(value).reset_index()
+    return df
+
+
 def get_stacked_value_count_comparison(
     sr1: pd.Series,
     sr2: pd.Series,
@@ -102,15 +269,22 @@ def get_stacked_value_count_comparison(
     label1: str = "Unfiltered",
     label2: str = "Filtered",
     order: Optional[List[str]] = None,
+    weights1: Optional[pd.Series] = None,
+    weights2: Optional[pd.Series] = None,
 ) -> pd.DataFrame:
     value_count_df = get_value_count_comparison(
         sr1=sr1, sr2=sr2, as_percentage=as_percentage, label1=label1, label2=label2, order=order,
+        weights1=weights1, weights2=weights2,
     )
     stacked_df = stack_value_count_comparison(value_count_df, stack_label=stack_label)
     return stacked_df
 
 
-def get_complimentary_datasets(df: pd.DataFrame, filter: pd.Series) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def get_complimentary_datasets(
+    df: Union[pd.DataFrame, Subset],
+    filter: pd.Series,
+) -> Tuple[Union[pd.DataFrame, Subset], Union[pd.DataFrame, Subset]]:
+    """ Split `df` on `filter`. With a `Subset`, the two halves are subsets too, i.e. nothing is copied """
     df1 = df[filter]
     df2 = df[~filter]
     return df1, df2
@@ -118,3 +292,19 @@ def get_complimentary_datasets(df: pd.DataFrame, filter: pd.Series) -> Tuple[pd.
 
 def multi_merge(dataframes: List[pd.DataFrame], on=Union[str, List[str]], how: str = "inner"):
     return reduce(lambda df1, df2: pd.merge(df1, df2, on=on, how=how), dataframes)
+
+
+_FILE_HASHES: Dict[Tuple[str, int, int], str] = {}
+
+
+def get_file_hash(path: pathlib.Path) -> str:
+    # Hashing the survey takes a while, so we remember the hashes of files that haven't been modified.
+    stat = path.stat()
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _FILE_HASHES:
+        digest = hashlib.sha256()
+        with open(path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b""):
+                digest.update(chunk)
+        _FILE_HASHES[key] = digest.hexdigest()
+    return _FILE_HASHES[key]
@@ -0,0 +1,121 @@
+"""
+Post-stratification weights via iterative proportional fitting (raking).
+
+The respondents are cross-classified into a dense contingency array (e.g. country x age x gender).
+IPF rescales the array, one axis at a time, until its margins match the target margins.
+The weight of each respondent is the ratio of the fitted over the observed count of its cell.
+
+The target margins are the shares of the values of each column. No reference margins are shipped: take them
+from any frame with `get_target_margin()`, e.g. the unfiltered survey, or write them down explicitly.
+All the helpers that accept weights take them as a Series aligned on the index of their dataset.
+
+```
+# Re-weight the filtered respondents to the income groups and ages of all the respondents
+margins = {
+    "income_group": kglib.get_target_margin(uds, "income_group"),
+    "age": kglib.get_target_margin(uds, "age"),
+    "gender": pd.Series({"Man": 0.75, "Woman": 0.25}),
+}
+weights = kglib.rake_weights(fds, margins, trim=(0.2, 5))
+kglib.get_value_count_comparison(uds.role, fds.role, as_percentage=True, weights2=weights)
+kglib.load_median_salary_comparison_df(uds, fds, column="code_level", income_group="3", weights2=weights)
+```
+"""
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def get_target_margin(df: pd.DataFrame, column: str, weights: Optional[pd.Series] = None) -> pd.Series:
+    """ Return the (weighted) share of each value of `column`; handy for building margins from reference tables """
+    if weights is None:
+        margin = df[column].value_counts(normalize=True)
+    else:
+        margin = weights.groupby(df[column]).sum()
+        margin = margin / margin.sum()
+    return margin
+
+
+def _encode(df: pd.DataFrame, margins: Dict[str, pd.Series]) -> Tuple[np.ndarray, List[np.ndarray], Tuple[int, ...]]:
+    codes = []
+    targets = []
+    for (column, margin) in margins.items():
+        margin = margin[margin > 0]
+        column_codes = pd.Index(margin.index).get_indexer(df[column])
+        codes.append(column_codes)
+        targets.append(margin.to_numpy(dtype=float) / margin.sum())
+    shape = tuple(len(target) for target in targets)
+    codes = np.vstack(codes)
+    in_scope = (codes >= 0).all(axis=0)
+    cells = np.full(len(df), -1, dtype=np.int64)
+    cells[in_scope] = np.ravel_multi_index(codes[:, in_scope], shape)
+    return cells, targets, shape
+
+
+def fit_ipf(
+    seed: np.ndarray,
+    targets: List[np.ndarray],
+    max_iter: int = 100,
+    tol: float = 1e-8,
+) -> np.ndarray:
+    """
+    Fit an N-dimensional array to the target margins (expressed as shares) with IPF.
+
+    Each iteration is a handful of array reductions and broadcasts, i.e. there is no loop over the cells.
+    """
+    fitted = seed.astype(float) / seed.sum()
+    axes = tuple(range(fitted.ndim))
+    for _ in range(max_iter):
+        max_error = 0.0
+        for (axis, target) in enumerate(targets):
+            other_axes = axes[:axis] + axes[axis + 1:]
+            current = fitted.sum(axis=other_axes)
+            max_error = max(max_error, np.abs(current - target).max())
+            factors = np.divide(target, current, out=np.zeros_like(target), where=current > 0)
+            shape = [1] * fitted.ndim
+            shape[axis] = -1
+            fitted *= factors.reshape(shape)
+        if max_error < tol:
+            break
+    return fitted
+
+
+def rake_weights(
+    df: pd.DataFrame,
+    margins: Dict[str, pd.Series],
+    max_iter: int = 100,
+    tol: float = 1e-8,
+    trim: Optional[Tuple[float, float]] = None,
+) -> pd.Series:
+    """
+    Return respondent weights such that the weighted distribution of each column matches `margins`.
+
+    - `margins` maps a column of `df` to the target share (or count) of each of its values.
+    - Respondents whose value is missing from a margin are out of scope and get a weight of 0.
+    - `trim` optionally bounds the weights, e.g. `(0.2, 5)`. The bounds apply to the weights normalized
+      to a mean of 1. Clipping and raking alternate until the clipped weights match the margins again;
+      if the bounds can't be met together with the margins, the margins win.
+
+    The weights are normalized so that they sum up to the number of in-scope respondents.
+    """
+    cells, targets, shape = _encode(df, margins)
+    in_scope = cells >= 0
+    observed = np.bincount(cells[in_scope], minlength=int(np.prod(shape))).reshape(shape)
+    fitted = fit_ipf(observed, targets, max_iter=max_iter, tol=tol)
+    # `fitted` are shares, so scale the weights to a mean of 1 before comparing them with `trim`
+    cell_weights = np.divide(fitted * in_scope.sum(), observed, out=np.zeros(shape), where=observed > 0)
+    if trim is not None:
+        for _ in range(max_iter):
+            clipped = np.where(observed > 0, np.clip(cell_weights, *trim), 0.0)
+            fitted = fit_ipf(clipped * observed, targets, max_iter=max_iter, tol=tol)
+            cell_weights = np.divide(fitted * in_scope.sum(), observed, out=np.zeros(shape), where=observed > 0)
+            if np.abs(cell_weights - clipped).max() < tol:
+                break
+    weights = np.zeros(len(df))
+    weights[in_scope] = cell_weights.ravel()[cells[in_scope]]
+    weights *= in_scope.sum() / weights.sum()
+    return pd.Series(weights, index=df.index, name="weight")
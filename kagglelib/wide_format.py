@@ -0,0 +1,96 @@
+"""
+Streaming export of respondents in the original layout of the Kaggle dataset.
+
+The rows are copied from the raw CSV as they are, i.e. with the original column names, the question texts
+as the second header row and the original answer strings. The source is read and written in chunks of rows,
+so neither the source nor the output is ever fully in memory.
+
+```
+kglib.write_kaggle_csv(fds, "filtered_responses.csv.gz")
+python -m kagglelib export-csv filtered_responses.csv.gz
+```
+"""
+import csv
+import gzip
+import itertools
+import os
+import pathlib
+
+from typing import IO
+from typing import Optional
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from .paths import DATA
+from .subset import Subset
+
+KAGGLE_SURVEY_CSV = DATA / "kaggle_survey_2020_responses.csv"
+
+# The header rows of the source: the column names and the question texts
+_HEADER_ROWS = 2
+
+Rows = Union[pd.DataFrame, Subset, pd.Index, np.ndarray]
+
+
+def _get_positions(rows: Rows) -> np.ndarray:
+    """ Return the sorted positions of `rows` among the respondents; the index of `load_udf()` is the position """
+    index = rows.index if isinstance(rows, (pd.DataFrame, Subset)) else rows
+    positions = np.asarray(index)
+    if positions.dtype.kind not in "iu":
+        raise ValueError(f"The rows must be labeled by the index of load_udf(), not: {positions.dtype}")
+    return np.unique(positions)
+
+
+def _open(path: pathlib.Path, compression: Optional[str]) -> IO[str]:
+    if compression == "gzip":
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def write_kaggle_csv(
+    rows: Rows,
+    path: Union[str, pathlib.Path],
+    compression: Optional[str] = "infer",
+    chunksize: int = 5000,
+    source: Union[str, pathlib.Path] = KAGGLE_SURVEY_CSV,
+) -> int:
+    """
+    Write the respondents of `rows` (e.g. the result of `filter_df()`) in the original wide format to `path`.
+
+    - `compression` is `None`, "gzip", or "infer" from the suffix of `path`.
+    - The file is written to a temporary file that replaces `path` once it is complete.
+
+    Return the number of respondents written.
+    """
+    path = pathlib.Path(path)
+    if compression == "infer":
+        compression = "gzip" if path.suffix == ".gz" else None
+    if compression not in (None, "gzip"):
+        raise ValueError(f"compression should be one of <None>, <gzip> or <infer>, not: {compression}")
+    positions = _get_positions(rows)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    written = 0
+    try:
+        with open(source, newline="", encoding="utf-8") as src, _open(tmp_path, compression) as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst, lineterminator="\n")
+            writer.writerows(itertools.islice(reader, _HEADER_ROWS))
+            start = 0
+            # `positions` is sorted, so each chunk only needs the positions between its bounds
+            while written < len(positions):
+                chunk = list(itertools.islice(reader, chunksize))
+                if not chunk:
+                    break
+                first, last = np.searchsorted(positions, [start, start + len(chunk)])
+                writer.writerows(chunk[position - start] for position in positions[first:last])
+                written += last - first
+                start += len(chunk)
+        if written < len(positions):
+            raise ValueError(f"The source only has {start} respondents; the rows go up to {positions[-1]}")
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return written